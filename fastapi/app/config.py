@@ -29,10 +29,105 @@ class Settings(BaseSettings):
     S3_CLOUD_SECRET_KEY: Optional[str] = None
     S3_CLOUD_REGION: Optional[str] = None
     S3_BUCKET_NAME: Optional[str] = None
+    # Параллельная загрузка на S3: объектов одновременно, multipart для файлов крупнее порога,
+    # S3_UPLOAD_RETRIES - попыток каждого запроса к S3 (повторяет botocore),
+    # S3_RETRY_BACKOFF - задержка повторного скачивания объекта архива, не прошедшего проверку
+    S3_UPLOAD_CONCURRENCY: int = 16
+    S3_MULTIPART_THRESHOLD: int = 16 * 1024 * 1024
+    S3_MULTIPART_CHUNKSIZE: int = 16 * 1024 * 1024
+    S3_MULTIPART_CONCURRENCY: int = 4  # Потоков на части одного multipart объекта
+    S3_UPLOAD_RETRIES: int = 3
+    S3_RETRY_BACKOFF: float = 1.0
+    # Загружать custom_photo/original_photo на S3 сразу после водяного знака, параллельно анализу
+    S3_PIPELINED_UPLOAD: bool = True
+    S3_PIPELINE_WORKERS: int = 4  # Потоков загрузки на одну часть события
+    # Архив события: сколько объектов S3 скачивается параллельно (и держится в памяти)
+    ARCHIVE_FETCH_CONCURRENCY: int = 8
+    # Максимальный размер одного тома архива (2 ГБ) и сколько томов собирается параллельно
+    ARCHIVE_VOLUME_MAX_BYTES: int = 2 * 1024 * 1024 * 1024
+    ARCHIVE_PARALLEL_VOLUMES: int = 2
     
     # ML Models
     INSIGHTFACE_MODEL_PATH: Optional[str] = None  # Auto-download if None
-    
+    FACE_BATCH_SIZE: int = 8  # Сколько фото process_event_photos прогоняет через модели лиц за раз
+
+    # Обработка события делится на части, которые выполняются параллельно (chord)
+    PHOTO_CHUNK_SIZE: int = 25
+
+    # Колонки photos при обработке события пишутся пакетно: каждые DB_WRITE_BATCH_SIZE фото
+    # или DB_WRITE_BATCH_SECONDS секунд (и в конце части). Меньше PHOTO_CHUNK_SIZE, иначе
+    # часть сбрасывается только по времени и в конце
+    DB_WRITE_BATCH_SIZE: int = 10
+    DB_WRITE_BATCH_SECONDS: float = 5.0
+
+    # Контрольные точки шагов обработки фото: повторный запуск пропускает шаги, вход которых
+    # не изменился (analyses.force_reprocess=true - обработать все заново)
+    PHOTO_CHECKPOINTS_ENABLED: bool = True
+    PHOTO_CHECKPOINT_PATH: str = "/var/www/html/storage/app/processing_checkpoints"
+
+    # Сколько масок водяного знака (по одной на разрешение, ширина*высота байт) держать в памяти
+    WATERMARK_MASK_CACHE_SIZE: int = 4
+
+    # Журнал шагов анализа event_info.json.log сворачивается в event_info.json, когда он больше
+    # EVENT_INFO_COMPACT_BYTES или снимок старше EVENT_INFO_COMPACT_SECONDS
+    EVENT_INFO_COMPACT_BYTES: int = 1024 * 1024
+    EVENT_INFO_COMPACT_SECONDS: float = 10.0
+    # analyze_facesearch в event_info.json без векторов лиц: только faces_count, face_bboxes
+    # и embedding_ref (photoId в photos.face_encodings / бинарном хранилище события)
+    EVENT_INFO_SLIM_FACES: bool = True
+
+    # Прогресс обработки события в Redis (статусы шагов, сводка, pub/sub канал изменений)
+    EVENT_PROGRESS_ENABLED: bool = True
+    EVENT_PROGRESS_TTL: int = 7 * 24 * 3600
+    # SSE потоки прогресса: интервал keepalive без изменений и максимальная длительность потока
+    PROGRESS_STREAM_KEEPALIVE: float = 15.0
+    PROGRESS_STREAM_MAX_SECONDS: int = 3600
+
+    # Пул процессов для инференса InsightFace/EasyOCR (модели загружаются в каждом процессе)
+    ML_POOL_ENABLED: bool = True
+    ML_POOL_WORKERS: int = 4  # 0 = по числу CPU; каждый процесс держит свои копии моделей в памяти
+    ML_POOL_THREADS_PER_WORKER: int = 1
+    ML_POOL_TIMEOUT: int = 300  # Секунд на один вызов (батч лиц или одно фото для OCR)
+    # Декодировать JPEG для моделей сразу в нужном масштабе (PIL draft), для OCR - только яркость
+    ML_DRAFT_DECODE: bool = True
+    # Кэш результатов лиц/номеров по содержимому фото и сигнатуре модели (LRU на диске)
+    ML_CACHE_ENABLED: bool = True
+    ML_CACHE_PATH: str = "/var/www/html/storage/app/ml_cache"  # Не в public - это биометрия
+    ML_CACHE_MAX_BYTES: int = 2 * 1024 * 1024 * 1024
+
+    # ANN индекс лиц для поиска по всем событиям (event_id=None)
+    FACE_INDEX_PATH: str = "/var/www/html/storage/app/face_index"  # Не в public - это биометрия
+    FACE_ANN_ENABLED: bool = True
+    FACE_ANN_NLIST: int = 256  # Количество кластеров (inverted lists)
+    FACE_ANN_NPROBE: int = 16  # Сколько кластеров просматривать: больше = выше recall, медленнее
+    FACE_ANN_RERANK: int = 200  # Сколько фото-кандидатов переранжировать точным расстоянием
+    FACE_ANN_FLUSH_EVERY: int = 50  # Как часто process_event_photos сбрасывает дельту сегмента на диск
+    FACE_ANN_RETRAIN_GROWTH: float = 2.0  # Переобучать центроиды, когда векторов стало во столько раз больше
+
+    # Бинарные embeddings событий (.npy, читаются через memmap), путь хранится в events.face_embeddings_path
+    FACE_EMBEDDINGS_PATH: str = "/var/www/html/storage/app/face_embeddings"  # Не в public - это биометрия
+
+    # Синхронный поиск в процессе API (поле inline=true в /photos/search/*), иначе - через Celery.
+    # Выключен по умолчанию: каждый воркер uvicorn держит свою копию моделей (несколько ГБ),
+    # включать, только когда клиент отправляет inline=true
+    SEARCH_INLINE_ENABLED: bool = False
+    SEARCH_INLINE_FACE: bool = False  # Держать InsightFace загруженным в процессе API
+    SEARCH_INLINE_NUMBER: bool = False  # Держать EasyOCR загруженным в процессе API
+    SEARCH_INLINE_WAIT: float = 0.5  # Сколько секунд ждать занятую модель, прежде чем уйти в Celery
+
+    # Инвертированный индекс номеров для search_by_numbers (по файлу {event_id}.json на событие)
+    NUMBER_INDEX_PATH: str = "/var/www/html/storage/app/number_index"
+    NUMBER_INDEX_ENABLED: bool = True
+    NUMBER_INDEX_FLUSH_EVERY: int = 50  # Как часто process_event_photos сбрасывает номера в индекс
+
+    # Двухэтапный OCR номеров: текст детектируется один раз (сначала под лицами),
+    # варианты предобработки и распознаватель прогоняются только по найденным областям
+    OCR_TWO_STAGE: bool = True
+    OCR_MAX_TEXT_REGIONS: int = 20  # Сколько крупнейших текстовых областей распознавать на фото
+    # Детекция текста идет на кадре не больше этого (как canvas_size EasyOCR); мелкие области
+    # номеров вырезаются из полного разрешения, которое декодируется только для них
+    OCR_DETECT_MAX_SIDE: int = 2560
+
     # EASYOCR_LANGUAGES - используем Union для поддержки разных типов
     # и обрабатываем через валидатор до парсинга pydantic
     EASYOCR_LANGUAGES: Union[str, List[str]] = Field(default="en,ru")
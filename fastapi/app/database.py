@@ -3,7 +3,9 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from app.config import settings
 
-engine = create_engine(settings.DATABASE_URL, pool_pre_ping=True)
+# values_plus_batch: executemany UPDATE (пакетная запись колонок photos, utils.photo_writer)
+# уходит страницами execute_batch, а не отдельным запросом на каждую строку
+engine = create_engine(settings.DATABASE_URL, pool_pre_ping=True, executemany_mode='values_plus_batch')
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -36,6 +36,13 @@ app.include_router(photos.router, prefix=settings.API_PREFIX, tags=["photos"])
 app.include_router(tasks.router, prefix=settings.API_PREFIX, tags=["tasks"])
 
 
+@app.on_event("startup")
+async def warm_up_inline_search():
+    """Модели для синхронного поиска грузятся в фоне, чтобы не задерживать старт API"""
+    from utils.inline_search import warm_inline_search
+    warm_inline_search()
+
+
 @app.get("/")
 async def root():
     return {
@@ -1,4 +1,5 @@
-from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form
+from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form, Request
+from fastapi.responses import Response, StreamingResponse
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from app.database import get_db
@@ -85,7 +86,7 @@ async def get_event_info(event_id: str):
     Используется Laravel для polling статусов анализа
     """
     import json
-    import fcntl
+    from utils.event_info_store import read_event_info
     
     event_info_path = f"/var/www/html/storage/app/public/events/{event_id}/event_info.json"
     
@@ -97,63 +98,46 @@ async def get_event_info(event_id: str):
     
     while retry_count < max_retries:
         try:
-            with open(event_info_path, 'r', encoding='utf-8') as f:
-                # Пытаемся заблокировать файл для чтения
-                try:
-                    fcntl.flock(f, fcntl.LOCK_SH)  # Shared lock для чтения
-                except (AttributeError, OSError):
-                    pass
+            try:
+                # Снимок + еще не свернутые шаги из журнала event_info.json.log
+                event_info = read_event_info(event_info_path)
+                logger.info(f"Event info read for event {event_id}")
+                return event_info
                 
-                try:
-                    event_info = json.load(f)
-                    
-                    try:
-                        fcntl.flock(f, fcntl.LOCK_UN)
-                    except (AttributeError, OSError):
-                        pass
-                    
-                    logger.info(f"Event info read for event {event_id}")
-                    return event_info
-                    
-                except json.JSONDecodeError as e:
+            except json.JSONDecodeError as e:
+                logger.warning(f"Error parsing event_info.json for event {event_id} (attempt {retry_count + 1}): {e}")
+                
+                if retry_count < max_retries - 1:
+                    retry_count += 1
+                    import asyncio
+                    await asyncio.sleep(0.1)  # Небольшая задержка перед повтором
+                    continue
+                else:
+                    # Попытка восстановить частичные данные
+                    logger.error(f"Failed to parse event_info.json after {max_retries} attempts, trying recovery")
                     try:
-                        fcntl.flock(f, fcntl.LOCK_UN)
-                    except (AttributeError, OSError):
+                        # Пытаемся прочитать файл построчно и найти последнюю валидную запись
+                        with open(event_info_path, 'r', encoding='utf-8') as f:
+                            content = f.read()
+                        # Пытаемся найти последнюю закрывающую скобку
+                        last_brace = content.rfind('}')
+                        if last_brace > 0:
+                            # Пытаемся парсить до последней закрывающей скобки
+                            partial_content = content[:last_brace + 1]
+                            # Проверяем, что это валидный JSON
+                            try:
+                                partial_json = json.loads(partial_content)
+                                logger.warning(f"Returning partial event_info.json for event {event_id}")
+                                return partial_json
+                            except:
+                                pass
+                    except:
                         pass
                     
-                    logger.warning(f"Error parsing event_info.json for event {event_id} (attempt {retry_count + 1}): {e}")
-                    
-                    if retry_count < max_retries - 1:
-                        retry_count += 1
-                        import asyncio
-                        await asyncio.sleep(0.1)  # Небольшая задержка перед повтором
-                        continue
-                    else:
-                        # Попытка восстановить частичные данные
-                        logger.error(f"Failed to parse event_info.json after {max_retries} attempts, trying recovery")
-                        try:
-                            # Пытаемся прочитать файл построчно и найти последнюю валидную запись
-                            f.seek(0)
-                            content = f.read()
-                            # Пытаемся найти последнюю закрывающую скобку
-                            last_brace = content.rfind('}')
-                            if last_brace > 0:
-                                # Пытаемся парсить до последней закрывающей скобки
-                                partial_content = content[:last_brace + 1]
-                                # Проверяем, что это валидный JSON
-                                try:
-                                    partial_json = json.loads(partial_content)
-                                    logger.warning(f"Returning partial event_info.json for event {event_id}")
-                                    return partial_json
-                                except:
-                                    pass
-                        except:
-                            pass
-                        
-                        raise HTTPException(
-                            status_code=500, 
-                            detail=f"Error parsing event_info.json: {str(e)}. File may be corrupted. Please check the file manually."
-                        )
+                    raise HTTPException(
+                        status_code=500, 
+                        detail=f"Error parsing event_info.json: {str(e)}. File may be corrupted. Please check the file manually."
+                    )
         
         except HTTPException:
             raise
@@ -170,6 +154,118 @@ async def get_event_info(event_id: str):
     raise HTTPException(status_code=500, detail="Failed to read event_info.json after multiple attempts")
 
 
+@router.get("/events/{event_id}/progress")
+def get_event_progress(event_id: str, details: bool = False):
+    """
+    Сводка прогресса анализа события из Redis: статусы по секциям (processing/ready/error/pending)
+
+    Дешевле polling /event-info: не читает event_info.json. details=true добавляет статусы
+    каждой фотографии. Изменения публикуются в Redis канал event:{event_id}:updates.
+    """
+    from utils.event_progress import get_event_progress as read_event_progress
+
+    try:
+        progress = read_event_progress(event_id, details=details)
+    except Exception as e:
+        logger.error(f"Error reading progress for event {event_id}: {e}")
+        raise HTTPException(status_code=503, detail=f"Progress store is unavailable: {str(e)}")
+
+    if progress is None:
+        raise HTTPException(status_code=404, detail="No progress for this event")
+    return progress
+
+
+@router.get("/events/{event_id}/stream")
+async def stream_event_progress(event_id: str):
+    """
+    Поток прогресса анализа события (Server-Sent Events) вместо polling /event-info
+
+    Сообщения: progress - сводка как у /events/{event_id}/progress, step - шаг фотографии
+    (section, photo_id, status) по мере выполнения, finished - итог обработки (поток закрывается).
+    """
+    from utils.event_progress import get_event_progress as read_event_progress, updates_channel
+    from utils.progress_stream import format_sse, stream_channel
+
+    def initial():
+        try:
+            progress = read_event_progress(event_id)
+        except Exception as e:
+            return [format_sse({'event_id': event_id, 'error': str(e)}, event='error')], True
+        if progress is None:
+            # Обработка еще не запускалась: ждем событие started
+            return [format_sse({'event_id': event_id, 'state': None}, event='progress')], False
+        return [format_sse(progress, event='progress')], progress.get('state') in ('completed', 'error')
+
+    def on_message(message):
+        return [format_sse(message, event=message.get('type', 'step'))]
+
+    return StreamingResponse(
+        stream_channel(
+            updates_channel(event_id),
+            initial,
+            on_message,
+            lambda message: message.get('type') == 'finished'
+        ),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.get("/events/{event_id}/download")
+def download_event_photos(event_id: str, request: Request, kind: str = "original_photo", source: str = "auto"):
+    """
+    Скачать фотографии события zip архивом, собираемым на лету (без archive_event_photos)
+
+    kind - original_photo или custom_photo, source - auto (локальная папка, иначе S3), local, s3.
+    Байты архива не меняются между запросами, поэтому поддерживается докачка (Range, If-Range).
+    """
+    from utils.zip_stream import open_event_zip, parse_range
+
+    if not event_id or os.path.basename(event_id) != event_id or event_id in ('.', '..'):
+        raise HTTPException(status_code=400, detail="Invalid event id")
+
+    try:
+        stream = open_event_zip(event_id, kind, source)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error listing photos for zip download of event {event_id}: {e}", exc_info=True)
+        raise HTTPException(status_code=503, detail=f"Photo storage is unavailable: {str(e)}")
+
+    if stream is None:
+        raise HTTPException(status_code=404, detail="No photos to download")
+
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": stream.etag,
+        "Content-Disposition": f'attachment; filename="event_{event_id}_{kind}.zip"',
+    }
+
+    # If-Range с другим ETag: набор файлов изменился, докачивать нельзя - отдаем архив целиком
+    if_range = request.headers.get("if-range")
+    byte_range = None
+    if not if_range or if_range == stream.etag:
+        try:
+            byte_range = parse_range(request.headers.get("range"), stream.size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{stream.size}"})
+
+    if byte_range is None:
+        start, end, status_code = 0, stream.size, 200
+    else:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{stream.size}"
+    headers["Content-Length"] = str(end - start)
+
+    return StreamingResponse(
+        stream.iter_range(start, end),
+        status_code=status_code,
+        media_type="application/zip",
+        headers=headers
+    )
+
+
 @router.post("/events/{event_id}/process-cover")
 async def process_cover(
     event_id: str,
@@ -1,6 +1,8 @@
 from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Depends
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from typing import List, Optional
+from app.config import settings
 from app.database import get_db
 from tasks.face_search import search_similar_faces
 from tasks.number_search import search_by_numbers, extract_numbers
@@ -16,13 +18,34 @@ router = APIRouter()
 async def search_by_face(
     photo: UploadFile = File(...),
     event_id: Optional[str] = Form(None),
-    threshold: float = Form(0.6)
+    threshold: float = Form(0.6),
+    top_k: Optional[int] = Form(None),
+    inline: bool = Form(False),
+    db: Session = Depends(get_db)
 ):
-    """Поиск похожих фотографий по лицу"""
+    """
+    Поиск похожих фотографий по лицу
+    
+    inline=true: ответить сразу ({"task_id": null, "status": "completed", "result": ...}),
+    если модель и индекс события уже в памяти; иначе - обычная задача Celery
+    """
     if not photo.content_type or not photo.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="File must be an image")
     
-    logger.info(f"Search by face request: event_id={event_id}, threshold={threshold}")
+    logger.info(f"Search by face request: event_id={event_id}, threshold={threshold}, top_k={top_k}, inline={inline}")
+    content = await photo.read()
+    
+    fallback_reason = None
+    if inline and settings.SEARCH_INLINE_ENABLED:
+        from utils.inline_search import search_faces_inline
+        try:
+            result, fallback_reason = await run_in_threadpool(search_faces_inline, db, content, event_id, threshold, top_k)
+            if result is not None:
+                return {"task_id": None, "status": "completed", "result": result}
+        except Exception as e:
+            fallback_reason = f"error: {str(e)}"
+            logger.error(f"Inline face search failed, falling back to Celery: {str(e)}", exc_info=True)
+        logger.info(f"Inline face search unavailable ({fallback_reason}), starting Celery task")
     
     # Сохраняем временный файл в директорию uploads (не удаляем сразу)
     # Файл будет удален после завершения задачи Celery
@@ -37,21 +60,23 @@ async def search_by_face(
     
     try:
         # Сохраняем файл
-        content = await photo.read()
         with open(tmp_path, 'wb') as f:
             f.write(content)
         
         logger.info(f"Saved query image to: {tmp_path}")
         
         # Запускаем поиск (файл будет удален в задаче Celery после обработки)
-        results = search_similar_faces.delay(tmp_path, event_id, threshold)
+        results = search_similar_faces.delay(tmp_path, event_id, threshold, top_k)
         
         logger.info(f"Started search task: {results.id}, event_id={event_id}")
         
-        return {
+        response = {
             "task_id": results.id,
             "status": "processing"
         }
+        if fallback_reason:
+            response["inline_fallback"] = fallback_reason
+        return response
     except Exception as e:
         logger.error(f"Error in search_by_face: {str(e)}", exc_info=True)
         # Удаляем файл при ошибке
@@ -66,13 +91,32 @@ async def search_by_face(
 @router.post("/photos/search/number")
 async def search_by_number(
     photo: UploadFile = File(...),
-    event_id: Optional[str] = Form(None)
+    event_id: Optional[str] = Form(None),
+    inline: bool = Form(False),
+    db: Session = Depends(get_db)
 ):
-    """Поиск фотографий по номеру"""
+    """
+    Поиск фотографий по номеру
+    
+    inline=true: как в /photos/search/face
+    """
     if not photo.content_type or not photo.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="File must be an image")
     
-    logger.info(f"Search by number request: event_id={event_id}")
+    logger.info(f"Search by number request: event_id={event_id}, inline={inline}")
+    content = await photo.read()
+    
+    fallback_reason = None
+    if inline and settings.SEARCH_INLINE_ENABLED:
+        from utils.inline_search import search_numbers_inline
+        try:
+            result, fallback_reason = await run_in_threadpool(search_numbers_inline, db, content, event_id)
+            if result is not None:
+                return {"task_id": None, "status": "completed", "result": result}
+        except Exception as e:
+            fallback_reason = f"error: {str(e)}"
+            logger.error(f"Inline number search failed, falling back to Celery: {str(e)}", exc_info=True)
+        logger.info(f"Inline number search unavailable ({fallback_reason}), starting Celery task")
     
     # Сохраняем временный файл в директорию uploads (не удаляем сразу)
     uploads_dir = "/app/uploads"
@@ -86,7 +130,6 @@ async def search_by_number(
     
     try:
         # Сохраняем файл
-        content = await photo.read()
         with open(tmp_path, 'wb') as f:
             f.write(content)
         
@@ -97,10 +140,13 @@ async def search_by_number(
         
         logger.info(f"Started search task: {results.id}, event_id={event_id}")
         
-        return {
+        response = {
             "task_id": results.id,
             "status": "processing"
         }
+        if fallback_reason:
+            response["inline_fallback"] = fallback_reason
+        return response
     except Exception as e:
         logger.error(f"Error in search_by_number: {str(e)}", exc_info=True)
         # Удаляем файл при ошибке
@@ -1,4 +1,5 @@
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from celery.result import AsyncResult
 from tasks.celery_app import celery_app
 
@@ -8,6 +9,47 @@ router = APIRouter()
 @router.get("/tasks/{task_id}")
 async def get_task_status(task_id: str):
     """Получить статус задачи Celery"""
+    return task_status_response(task_id)
+
+
+@router.get("/tasks/{task_id}/stream")
+async def stream_task_status(task_id: str):
+    """
+    Поток состояния задачи (Server-Sent Events) вместо polling /tasks/{task_id}
+
+    Первое сообщение status - ответ /tasks/{task_id}, затем progress на каждое обновление
+    PROGRESS и status с итогом (SUCCESS/FAILURE/REVOKED), после которого поток закрывается.
+    """
+    from utils.progress_stream import (
+        TERMINAL_TASK_STATES, format_sse, stream_channel, task_channel, task_progress_message
+    )
+
+    def initial():
+        try:
+            status = task_status_response(task_id)
+        except HTTPException as e:
+            return [format_sse({'task_id': task_id, 'error': e.detail}, event='error')], True
+        return [format_sse(status, event='status')], status.get('state') in TERMINAL_TASK_STATES
+
+    def on_message(meta):
+        message = task_progress_message(task_id, meta)
+        event = 'progress' if message['state'] == 'PROGRESS' else 'status'
+        return [format_sse(message, event=event)]
+
+    return StreamingResponse(
+        stream_channel(
+            task_channel(task_id),
+            initial,
+            on_message,
+            lambda meta: meta.get('status') in TERMINAL_TASK_STATES
+        ),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def task_status_response(task_id: str) -> dict:
+    """Статус задачи в формате /tasks/{task_id}"""
     try:
         task_result = AsyncResult(task_id, app=celery_app)
     except Exception as e:
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Скрипт миграции embeddings из JSON face_encodings в бинарные sidecar файлы
+
+Для каждого события с лицами собирает матрицу embeddings из photos.face_encodings,
+сохраняет её в FACE_EMBEDDINGS_PATH и записывает путь в events.face_embeddings_path.
+Требует миграцию add_face_embeddings_path_to_events_table.
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.database import SessionLocal
+from utils.embedding_store import write_event_embedding_sidecar
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def backfill_embedding_sidecars(only_missing: bool = True):
+    """Создает sidecar для событий (по умолчанию - только для событий без него)"""
+    from sqlalchemy import text
+
+    db = SessionLocal()
+    try:
+        query = """
+            SELECT DISTINCT e.id FROM events e
+            JOIN photos p ON p.event_id = e.id
+            WHERE p.face_encodings IS NOT NULL
+        """
+        if only_missing:
+            query += " AND e.face_embeddings_path IS NULL"
+        event_ids = [str(row[0]) for row in db.execute(text(query)).fetchall()]
+        logger.info(f"Найдено {len(event_ids)} событий для миграции")
+
+        migrated = 0
+        error_count = 0
+        for event_id in event_ids:
+            try:
+                if write_event_embedding_sidecar(db, event_id):
+                    migrated += 1
+                else:
+                    error_count += 1
+            except Exception as e:
+                db.rollback()
+                error_count += 1
+                logger.error(f"Ошибка при миграции события {event_id}: {str(e)}", exc_info=True)
+
+        logger.info(f"Миграция завершена. Событий: {migrated}, ошибок: {error_count}")
+        return migrated, error_count
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    rebuild_all = "--all" in sys.argv
+    print(f"Начинаем миграцию embeddings в бинарные sidecar ({'все события' if rebuild_all else 'только без sidecar'})...")
+    migrated, errors = backfill_embedding_sidecars(only_missing=not rebuild_all)
+    print(f"Миграция завершена. Событий: {migrated}, ошибок: {errors}")
+    sys.exit(0 if errors == 0 else 1)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Скрипт полной перестройки ANN индекса лиц из таблицы photos
+
+Пересобирает сегменты всех событий по face_encodings и переобучает центроиды.
+Нужен при первом включении индекса на существующей базе и после смены FACE_ANN_NLIST.
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import settings
+from app.database import SessionLocal
+from utils.face_index import SEGMENTS_DIR, event_files, file_event_id, update_segment, maybe_train_centroids
+from utils.index_files import IndexLock
+import glob
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def build_face_index():
+    """Перестраивает сегменты всех событий и переобучает центроиды"""
+    from app.models import Photo
+
+    db = SessionLocal()
+    try:
+        event_ids = [
+            str(row[0]) for row in
+            db.query(Photo.event_id).filter(Photo.face_encodings.isnot(None)).distinct().all()
+        ]
+        logger.info(f"Найдено {len(event_ids)} событий с лицами")
+
+        built = 0
+        error_count = 0
+        with IndexLock(settings.FACE_INDEX_PATH):
+            # Сегменты и дельты удаленных событий больше не нужны
+            known = set(event_ids)
+            for path in glob.glob(os.path.join(settings.FACE_INDEX_PATH, SEGMENTS_DIR, "*.npz")):
+                if file_event_id(path) not in known:
+                    os.remove(path)
+                    logger.info(f"Удален файл индекса несуществующего события: {path}")
+
+            for event_id in event_ids:
+                try:
+                    rows = db.query(Photo.id, Photo.face_encodings).filter(
+                        Photo.event_id == event_id,
+                        Photo.face_encodings.isnot(None)
+                    ).yield_per(1000)
+                    updates = {
+                        str(photo_id): encodings if isinstance(encodings, list) else []
+                        for photo_id, encodings in rows
+                    }
+                    # Сегмент пересобирается с нуля, дельты уже учтены в face_encodings
+                    segment, deltas = event_files(settings.FACE_INDEX_PATH, event_id)
+                    for path in ([segment] if segment else []) + deltas:
+                        os.remove(path)
+                    count = update_segment(event_id, updates)
+                    built += 1
+                    logger.info(f"Событие {event_id}: {len(updates)} фото, {count} лиц в индексе")
+                except Exception as e:
+                    error_count += 1
+                    logger.error(f"Ошибка при индексации события {event_id}: {str(e)}", exc_info=True)
+
+            maybe_train_centroids(force=True)
+
+        logger.info(f"Перестройка завершена. Событий: {built}, ошибок: {error_count}")
+        return built, error_count
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    print("Начинаем перестройку ANN индекса лиц...")
+    built, errors = build_face_index()
+    print(f"Перестройка завершена. Событий: {built}, ошибок: {errors}")
+    sys.exit(0 if errors == 0 else 1)
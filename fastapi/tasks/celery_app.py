@@ -1,5 +1,5 @@
 from celery import Celery
-from celery.signals import task_failure, task_prerun, task_postrun
+from celery.signals import task_failure, task_prerun, task_postrun, worker_ready, worker_shutdown
 from celery.backends.redis import RedisBackend
 from app.config import settings
 import logging
@@ -157,6 +157,27 @@ def handle_task_prerun(sender=None, task_id=None, task=None, **kwargs):
         # Игнорируем ошибки при проверке - это не критично
         logger.debug(f"Ошибка при проверке результата задачи {task_id}: {str(e)}")
 
+# Пул ML процессов живет вместе с воркером
+@worker_ready.connect
+def handle_worker_ready(sender=None, **kwargs):
+    """Запускаем пул ML процессов при старте воркера, чтобы модели загрузились до первых задач"""
+    try:
+        from utils.ml_pool import warm_ml_pool
+        warm_ml_pool()
+    except Exception as e:
+        logger.error(f"Не удалось запустить пул ML процессов: {str(e)}", exc_info=True)
+
+
+@worker_shutdown.connect
+def handle_worker_shutdown(sender=None, **kwargs):
+    """Останавливаем пул ML процессов вместе с воркером"""
+    try:
+        from utils.ml_pool import shutdown_ml_pool
+        shutdown_ml_pool()
+    except Exception as e:
+        logger.warning(f"Ошибка при остановке пула ML процессов: {str(e)}")
+
+
 # Обработчик ошибок выполнения задач
 @task_failure.connect
 def handle_task_failure(sender=None, task_id=None, exception=None, traceback=None, einfo=None, **kwargs):
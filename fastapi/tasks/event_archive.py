@@ -1,7 +1,8 @@
 """
 Задача архивирования события
-Если у события статус archived, скачиваем все фотографии из S3, проверяем количество,
-удаляем папку на S3 и создаем архив
+Если у события статус archived, скачиваем все фотографии из S3 прямо в архив
+(тома по манифесту, повторный запуск дособирает архив) и проверяем количество
+(подробности - utils.event_archiver)
 """
 from celery import Task
 from tasks.celery_app import celery_app
@@ -10,15 +11,14 @@ import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import logging
-import zipfile
-import tempfile
-import shutil
+import threading
 from typing import Dict, List
 from datetime import datetime, timedelta
 
 from app.database import SessionLocal
 from app.models import Event, Photo
 from utils.s3_uploader import S3Uploader
+from utils.event_archiver import build_event_archive, list_objects
 
 logger = logging.getLogger(__name__)
 
@@ -43,10 +43,12 @@ def archive_event_photos(self, event_id: str):
     
     Процесс:
     1. Найти все фотографии события с S3 URL
-    2. Скачать папку original_photo с S3
-    3. Проверить что кол-во файлов скачанных равно кол-ву файлов на облаке
-    4. Если результат успешный, удалить папку на облаке
-    5. Файлы которые скачал запихнуть в архив
+    2. Скачать папку original_photo с S3 параллельно, сразу записывая файлы в тома архива
+       (JPEG/WebP без сжатия) и проверяя размер и MD5 каждого объекта; объекты,
+       уже записанные прошлым запуском (по манифесту), не скачиваются
+    3. Проверить что кол-во файлов в архиве равно кол-ву файлов на облаке; если часть
+       объектов не скачалась - статус partial, повторный запуск дособерет только их
+    4. Если результат успешный, удалить папку на облаке (отключено)
     """
     db = SessionLocal()
     s3_uploader = S3Uploader()
@@ -74,98 +76,59 @@ def archive_event_photos(self, event_id: str):
         
         logger.info(f"Starting archive for event {event_id}, photos count: {len(photos)}")
         
-        # Создаем временную директорию для скачанных файлов
-        temp_dir = tempfile.mkdtemp(prefix=f'event_archive_{event_id}_')
-        downloaded_files = []
+        if not s3_uploader.is_available():
+            logger.error("S3 uploader not available")
+            return {"error": "S3 uploader not available", "status": "failed"}
         
+        # Получаем список объектов в папке original_photo на S3
+        s3_prefix = f"hunter-photo/events/{event_id}/original_photo/"
         try:
-            # Скачиваем все файлы с S3
-            s3_prefix = f"hunter-photo/events/{event_id}/original_photo/"
-            s3_files_count = 0
-            downloaded_count = 0
+            s3_files = list_objects(s3_uploader, s3_prefix)
+        except Exception as e:
+            logger.error(f"Error listing S3 files: {e}")
+            return {"error": f"Error listing S3 files: {str(e)}", "status": "failed"}
+        s3_files_count = len(s3_files)
+        logger.info(f"Found {s3_files_count} files on S3 for event {event_id}")
+        
+        archive_dir = f"/var/www/html/storage/app/public/events/{event_id}"
+        
+        try:
+            # Объекты скачиваются параллельно и сразу пишутся в тома архива (без временной папки)
+            processed = 0
+            progress_lock = threading.Lock()
             
-            # Получаем список файлов на S3
-            if not s3_uploader.is_available():
-                logger.error("S3 uploader not available")
-                return {"error": "S3 uploader not available", "status": "failed"}
+            def on_entry(obj, error):
+                nonlocal processed
+                with progress_lock:
+                    processed += 1
+                    # Обновляем прогресс
+                    if processed % 10 == 0:
+                        self.on_progress(processed, s3_files_count)
             
-            try:
-                # Получаем список объектов в папке original_photo на S3
-                paginator = s3_uploader.s3_client.get_paginator('list_objects_v2')
-                pages = paginator.paginate(
-                    Bucket=s3_uploader.bucket_name,
-                    Prefix=s3_prefix
-                )
-                
-                s3_files = []
-                for page in pages:
-                    if 'Contents' in page:
-                        for obj in page['Contents']:
-                            # Пропускаем папки (объекты заканчивающиеся на /)
-                            if not obj['Key'].endswith('/'):
-                                s3_files.append(obj['Key'])
-                                s3_files_count += 1
-                
-                logger.info(f"Found {s3_files_count} files on S3 for event {event_id}")
-                
-                # Скачиваем каждый файл
-                for s3_key in s3_files:
-                    try:
-                        filename = os.path.basename(s3_key)
-                        local_path = os.path.join(temp_dir, filename)
-                        
-                        # Скачиваем файл
-                        s3_uploader.s3_client.download_file(
-                            s3_uploader.bucket_name,
-                            s3_key,
-                            local_path
-                        )
-                        
-                        downloaded_files.append(local_path)
-                        downloaded_count += 1
-                        
-                        # Обновляем прогресс
-                        if downloaded_count % 10 == 0:
-                            self.on_progress(downloaded_count, s3_files_count)
-                        
-                        logger.debug(f"Downloaded {s3_key} to {local_path}")
-                    except Exception as e:
-                        logger.error(f"Error downloading {s3_key}: {e}")
-                        continue
-                
-            except Exception as e:
-                logger.error(f"Error listing S3 files: {e}")
-                return {"error": f"Error listing S3 files: {str(e)}", "status": "failed"}
+            stats = build_event_archive(s3_uploader, event_id, s3_prefix, s3_files, archive_dir, on_entry)
+            archived_count = stats['archived']
+            archive_paths = stats['volumes']
             
             # Проверяем что количество файлов совпадает
-            if downloaded_count != s3_files_count:
+            if archived_count != s3_files_count:
                 logger.error(
-                    f"File count mismatch: downloaded={downloaded_count}, s3={s3_files_count}"
+                    f"File count mismatch: archived={archived_count}, s3={s3_files_count}, "
+                    f"missing files are kept in {stats['manifest_path']} for the next run"
                 )
-                # Очищаем временные файлы
-                shutil.rmtree(temp_dir, ignore_errors=True)
+                # Готовые тома остаются: повторный запуск скачает только недостающие объекты
                 return {
-                    "error": f"File count mismatch: downloaded={downloaded_count}, s3={s3_files_count}",
-                    "status": "failed"
+                    "error": f"File count mismatch: archived={archived_count}, s3={s3_files_count}",
+                    "status": "partial",
+                    "event_id": event_id,
+                    "files_downloaded": stats['downloaded'],
+                    "archive_paths": archive_paths,
+                    "failed_files": stats['missing']
                 }
             
-            logger.info(f"Successfully downloaded {downloaded_count} files, count matches")
-            
-            # Создаем архив
-            archive_path = f"/var/www/html/storage/app/public/events/{event_id}/archive_{event_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
-            archive_dir = os.path.dirname(archive_path)
-            
-            if not os.path.exists(archive_dir):
-                os.makedirs(archive_dir, mode=0o755, exist_ok=True)
-            
-            with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for local_file in downloaded_files:
-                    if os.path.exists(local_file):
-                        filename = os.path.basename(local_file)
-                        zipf.write(local_file, filename)
-                        logger.debug(f"Added {filename} to archive")
-            
-            logger.info(f"Archive created: {archive_path}")
+            logger.info(
+                f"Successfully archived {archived_count} files ({stats['downloaded']} downloaded now), count matches"
+            )
+            logger.info(f"Archive volumes: {archive_paths}")
             
             # НЕ удаляем папку original_photo на S3
             # Оригиналы нужны для повторного анализа событий
@@ -175,37 +138,34 @@ def archive_event_photos(self, event_id: str):
             # Раскомментируйте код ниже, если нужно удалять файлы с S3 после архивации:
             # try:
             #     # Удаляем все объекты в папке
-            #     for s3_key in s3_files:
+            #     for s3_file in s3_files:
             #         try:
             #             s3_uploader.s3_client.delete_object(
             #                 Bucket=s3_uploader.bucket_name,
-            #                 Key=s3_key
+            #                 Key=s3_file['key']
             #             )
-            #             logger.debug(f"Deleted {s3_key} from S3")
+            #             logger.debug(f"Deleted {s3_file['key']} from S3")
             #         except Exception as e:
-            #             logger.error(f"Error deleting {s3_key} from S3: {e}")
+            #             logger.error(f"Error deleting {s3_file['key']} from S3: {e}")
             #     
             #     logger.info(f"Deleted {len(s3_files)} files from S3")
             # except Exception as e:
             #     logger.error(f"Error deleting files from S3: {e}")
             #     # Не прерываем процесс, так как архив уже создан
             
-            # Очищаем временные файлы
-            shutil.rmtree(temp_dir, ignore_errors=True)
-            
             return {
                 "status": "completed",
                 "event_id": event_id,
-                "files_downloaded": downloaded_count,
-                "archive_path": archive_path,
+                "files_downloaded": stats['downloaded'],
+                "files_archived": archived_count,
+                "archive_path": archive_paths[0] if archive_paths else None,
+                "archive_paths": archive_paths,
+                "archive_bytes": sum(os.path.getsize(path) for path in archive_paths),
                 "s3_files_deleted": len(s3_files)
             }
             
         except Exception as e:
             logger.error(f"Error during archive process: {e}", exc_info=True)
-            # Очищаем временные файлы в случае ошибки
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir, ignore_errors=True)
             return {"error": str(e), "status": "failed"}
     
     finally:
@@ -5,8 +5,11 @@ import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from utils.face_recognition import get_face_recognition
+from utils.embedding_store import build_event_embedding_store
+from utils.face_index import get_face_ann_index
+from app.config import settings
 import os
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 
 class CallbackTask(Task):
@@ -22,14 +25,14 @@ class CallbackTask(Task):
 
 
 @celery_app.task(bind=True, base=CallbackTask)
-def search_similar_faces(self, query_image_path: str, event_id: str = None, threshold: float = 0.6):
+def search_similar_faces(self, query_image_path: str, event_id: str = None, threshold: float = 0.6, top_k: int = None):
     """
     Поиск похожих фотографий (InsightFace + cosine distance)
+
+    top_k: вернуть только top_k лучших совпадений (None - все прошедшие порог)
     """
     import logging
-    import numpy as np
     from app.database import SessionLocal
-    from app.models import Photo
 
     logger = logging.getLogger("search_similar_faces")
     logger.setLevel(logging.DEBUG)
@@ -39,7 +42,7 @@ def search_similar_faces(self, query_image_path: str, event_id: str = None, thre
     face_recognition = get_face_recognition()
 
     try:
-        logger.info(f"START search_similar_faces: event_id={event_id}, threshold={threshold}")
+        logger.info(f"START search_similar_faces: event_id={event_id}, threshold={threshold}, top_k={top_k}")
         logger.info(f"Query image: {query_image_path}")
         
         # Проверяем, что файл существует
@@ -60,185 +63,40 @@ def search_similar_faces(self, query_image_path: str, event_id: str = None, thre
         logger.debug(f"Query embedding dtype: {query_embedding.dtype}, shape: {query_embedding.shape}")
         logger.debug(f"Query embedding (first 5): {query_embedding[:5]}")
 
-        # ---- 2) Грузим фото из базы ----
-        # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Поле face_encodings имеет тип JSON (не JSONB)
-        # jsonb_array_length() не работает с JSON, поэтому используем фильтрацию в Python
-        # Это безопаснее и работает с любым типом JSON поля
-        
-        if event_id:
-            # Сначала проверяем все фотографии события для диагностики
-            all_photos_count = db.query(Photo).filter(Photo.event_id == event_id).count()
-            logger.info(f"Total photos in event {event_id}: {all_photos_count}")
-            
-            # Проверяем фотографии с has_faces=True
-            has_faces_true_count = db.query(Photo).filter(
-                Photo.event_id == event_id,
-                Photo.has_faces == True
-            ).count()
-            logger.info(f"Photos with has_faces=True in event {event_id}: {has_faces_true_count}")
-            
-            # Проверяем фотографии с face_encodings не NULL
-            has_encodings_not_null_count = db.query(Photo).filter(
-                Photo.event_id == event_id,
-                Photo.face_encodings.isnot(None)
-            ).count()
-            logger.info(f"Photos with face_encodings NOT NULL in event {event_id}: {has_encodings_not_null_count}")
-            
-            # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Загружаем все фотографии с face_encodings != None и фильтруем в Python
-            # Это работает с типом JSON (не требует JSONB)
-            all_photos = db.query(Photo).filter(
-                Photo.event_id == event_id,
-                Photo.face_encodings.isnot(None)
-            ).all()
-            
-            # Фильтруем в Python: проверяем, что face_encodings - это непустой список
-            photos_with_faces = []
-            for p in all_photos:
-                if p.face_encodings and isinstance(p.face_encodings, list) and len(p.face_encodings) > 0:
-                    photos_with_faces.append(p)
-            
-            has_encodings_count = len(photos_with_faces)
-            logger.info(f"Photos with face_encodings (non-empty array, Python filter) in event {event_id}: {has_encodings_count}")
-            
-            # Создаем запрос для выбранных фотографий
-            photo_ids = [p.id for p in photos_with_faces]
-            if photo_ids:
-                q = db.query(Photo).filter(Photo.id.in_(photo_ids))
-            else:
-                # Если нет фотографий, создаем пустой запрос
-                q = db.query(Photo).filter(Photo.id == None)  # Это вернет пустой результат
-        else:
-            # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Загружаем все фотографии с face_encodings != None и фильтруем в Python
-            all_photos = db.query(Photo).filter(Photo.face_encodings.isnot(None)).all()
-            photos_with_faces = [p for p in all_photos if p.face_encodings and isinstance(p.face_encodings, list) and len(p.face_encodings) > 0]
-            photo_ids = [p.id for p in photos_with_faces]
-            if photo_ids:
-                q = db.query(Photo).filter(Photo.id.in_(photo_ids))
-            else:
-                q = db.query(Photo).filter(Photo.id == None)
-
-        photos = q.all()
-        total_photos = len(photos)
-        logger.info(f"Loaded {total_photos} photos for comparison")
-        
-        # ВАЖНО: Логируем детали для диагностики
-        if total_photos == 0:
-            logger.warning(f"No photos found with faces! Event_id={event_id}")
-            if event_id:
-                # Показываем примеры фотографий для диагностики
-                sample_photos = db.query(Photo).filter(Photo.event_id == event_id).limit(5).all()
-                for sample in sample_photos:
-                    logger.warning(f"Sample photo {sample.id}: has_faces={sample.has_faces}, face_encodings={len(sample.face_encodings) if sample.face_encodings else 0}")
-
-        results = []
-
-        # ---- 3) Перебор фотографий ----
-        for idx, photo in enumerate(photos, start=1):
-
+        # ---- 2) Кандидаты из ANN индекса (поиск по всем событиям) ----
+        # Без event_id полный перебор растет вместе со всем архивом, поэтому сначала
+        # берем кандидатов из IVF индекса, а потом точно переранжируем только их
+        candidate_ids = None
+        if not event_id and settings.FACE_ANN_ENABLED:
             try:
-                # ---- Загружаем embeddings (из БД или файл) ----
-                emb_list = None
-
-                if photo.face_encodings:
-                    emb_list = photo.face_encodings  # SQLAlchemy сам десериализует JSON
-                    logger.debug(f"Photo {photo.id}: Loaded {len(emb_list) if emb_list else 0} embeddings from DB")
-
-                if not emb_list:
-                    emb_list = face_recognition.load_embeddings(photo.id)
-                    if emb_list:
-                        logger.debug(f"Photo {photo.id}: Loaded {len(emb_list)} embeddings from file")
-                        # Преобразуем numpy массивы в списки для дальнейшей обработки
-                        # ВАЖНО: Сохраняем точность float32
-                        emb_list = [emb.tolist() if hasattr(emb, 'tolist') else (list(emb) if not isinstance(emb, list) else emb) for emb in emb_list]
-
-                if not emb_list:
-                    logger.debug(f"Photo {photo.id}: no embeddings found")
-                    continue
-
-                # Преобразуем в numpy массивы с правильным типом
-                try:
-                    emb_list = [np.array(e, dtype=np.float32) for e in emb_list]
-                    # Проверяем, что все embeddings имеют правильную форму
-                    emb_list = [emb for emb in emb_list if emb.ndim == 1 and len(emb) > 0]
-                except Exception as e:
-                    logger.error(f"Photo {photo.id}: Error converting embeddings to numpy arrays: {str(e)}")
-                    continue
-
-                if not emb_list:
-                    logger.warning(f"Photo {photo.id}: No valid embeddings after conversion")
-                    continue
-
-                # Проверка длины - разные модели могут иметь разную размерность
-                # Проверяем только первую, остальные должны быть такой же
-                first_emb_len = len(emb_list[0])
-                if first_emb_len != len(query_embedding):
-                    logger.warning(
-                        f"Photo {photo.id}: embedding size mismatch "
-                        f"{first_emb_len} != {len(query_embedding)}. Skipping."
-                    )
-                    continue
-                
-                # Проверяем, что все embeddings имеют одинаковую длину
-                if not all(len(emb) == first_emb_len for emb in emb_list):
-                    logger.warning(f"Photo {photo.id}: Inconsistent embedding sizes, filtering...")
-                    emb_list = [emb for emb in emb_list if len(emb) == first_emb_len]
-                    if not emb_list:
-                        continue
-
-                logger.debug(f"Photo {photo.id}: {len(emb_list)} embeddings, dtype: {emb_list[0].dtype}, shape: {emb_list[0].shape}")
-                
-                # Нормализуем query_embedding один раз (вынесено из цикла для оптимизации)
-                query_norm = np.linalg.norm(query_embedding)
-                if query_norm == 0:
-                    logger.warning(f"Query embedding has zero norm, skipping photo {photo.id}")
-                    continue
-                query_embedding_normalized = query_embedding / query_norm
-                logger.debug(f"Query embedding normalized, norm: {np.linalg.norm(query_embedding_normalized):.6f}")
-
-                # ---- 4) Сравнение ----
-                best_distance = 99
-
-                for emb_idx, emb in enumerate(emb_list):
-                    # Нормализуем embedding из базы
-                    emb_norm = np.linalg.norm(emb)
-                    if emb_norm == 0:
-                        logger.warning(f"Photo {photo.id}, embedding {emb_idx + 1}: zero norm, skipping")
-                        continue
-                    emb_normalized = emb / emb_norm
-                    
-                    # Косинусное расстояние (1 - cosine similarity)
-                    # Используем прямое вычисление для точности
-                    cosine_similarity = np.dot(query_embedding_normalized, emb_normalized)
-                    # Ограничиваем значение в диапазоне [-1, 1] для избежания численных ошибок
-                    cosine_similarity = np.clip(cosine_similarity, -1.0, 1.0)
-                    dist = 1.0 - cosine_similarity
-                    
-                    logger.debug(f"Photo {photo.id}, embedding {emb_idx + 1}: distance={dist:.4f}, similarity={cosine_similarity:.4f}")
-
-                    if dist < best_distance:
-                        best_distance = dist
-
-                logger.debug(f"Photo {photo.id}: best_distance={best_distance:.4f}, threshold={threshold}")
-
-                if best_distance <= threshold:
-                    results.append({
-                        "photo_id": photo.id,
-                        "distance": float(best_distance),
-                        "similarity": 1.0 - best_distance
-                    })
-                    logger.info(f"Photo {photo.id}: MATCH found! distance={best_distance:.4f} <= threshold={threshold}")
-
-                # ---- progress ----
-                if idx % 20 == 0:
-                    self.on_progress(idx, total_photos)
-                    logger.info(f"Progress: {idx}/{total_photos} photos processed, {len(results)} matches found")
-
-            except Exception as e:
-                logger.error(f"Error comparing photo {photo.id}: {str(e)}", exc_info=True)
-                continue
+                # Кандидатов берем страницами: пока последний кандидат еще проходит порог,
+                # за ним могут быть другие совпадения - удваиваем число кандидатов
+                limit = settings.FACE_ANN_RERANK
+                while True:
+                    candidates = get_face_ann_index().search(query_embedding, candidates=limit)
+                    if candidates is None or len(candidates) < limit or candidates[-1][1] > threshold:
+                        break
+                    limit *= 2
+                if candidates is not None:
+                    candidate_ids = [photo_id for photo_id, _ in candidates]
+                    logger.info(f"ANN index returned {len(candidate_ids)} candidate photos for exact re-rank")
+                else:
+                    logger.info("ANN index is empty or incompatible, falling back to exact scan")
+            except Exception as ann_error:
+                logger.error(f"ANN index search failed, falling back to exact scan: {str(ann_error)}", exc_info=True)
+
+        # ---- 3) Собираем матрицу embeddings ----
+        # Одним запросом грузим только (id, face_encodings) и складываем все лица
+        # в непрерывную float32 матрицу нормализованных векторов
+        store = build_event_embedding_store(db, event_id, photo_ids=candidate_ids, dim=len(query_embedding))
+        logger.info(f"Loaded {store.photos_count} photos ({store.faces_count} faces) for comparison")
+
+        if store.photos_count == 0:
+            logger.warning(f"No photos found with faces! Event_id={event_id}")
 
-        # ---- 5) Сортировка ----
-        results.sort(key=lambda x: x["distance"])
+        # ---- 4) Точное сравнение: одно произведение матрица-вектор + top-k ----
+        results = store.search(query_embedding, threshold, top_k=top_k)
+        self.on_progress(store.photos_count, store.photos_count or 1)
 
         logger.info(f"FOUND {len(results)} similar faces")
         if results:
@@ -323,3 +181,19 @@ def extract_faces_with_bboxes(image_path: str) -> List[Dict]:
         logger.error(f"Error extracting faces with bboxes from {image_path}: {str(e)}", exc_info=True)
         return []
 
+
+def extract_faces_batch(image_paths: List[str]) -> List[Optional[List[Dict]]]:
+    """
+    Извлечь embeddings и bbox лиц для нескольких фотографий одним батчем
+
+    Returns: для каждого пути - список лиц или None, если фото не удалось обработать
+    """
+    import logging
+    logger = logging.getLogger(__name__)
+
+    try:
+        face_recognition = get_face_recognition()
+        return face_recognition.extract_faces_batch(image_paths)
+    except Exception as e:
+        logger.error(f"Error extracting faces for batch of {len(image_paths)} photos: {str(e)}", exc_info=True)
+        return [None] * len(image_paths)
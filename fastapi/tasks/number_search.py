@@ -5,7 +5,8 @@ import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from utils.number_recognition import get_number_recognition
-from typing import List, Dict
+from utils.number_index import get_event_number_index
+from typing import List, Dict, Optional
 
 
 class CallbackTask(Task):
@@ -51,107 +52,20 @@ def search_by_numbers(self, query_image_path: str, event_id: str = None):
             logger.warning("No numbers found in query image")
             return {"error": "No numbers found in query image", "results": []}
         
-        # Получаем все фотографии события
-        query = db.query(Photo)
-        if event_id:
-            query = query.filter(Photo.event_id == event_id)
+        # Совпадения ищутся по инвертированному индексу номеров события (exact, partial, similar)
+        number_index = get_event_number_index(db, event_id)
+        unique_results = number_index.search(query_numbers)
+        self.on_progress(number_index.photos_count, number_index.photos_count or 1)
         
-        photos = query.all()
-        results = []
-        
-        for idx, photo in enumerate(photos, 1):
-            try:
-                if not photo.numbers:
-                    continue
-                
-                # Проверяем совпадение номеров с улучшенным алгоритмом
-                photo_numbers = photo.numbers if isinstance(photo.numbers, list) else []
-                if not photo_numbers:
-                    continue
-                
-                # Флаг для отслеживания, найдено ли совпадение для этого фото
-                photo_matched = False
-                
-                for query_num in query_numbers:
-                    if photo_matched:
-                        break  # Уже нашли совпадение для этого фото
-                    
-                    # Очищаем запрос - только цифры
-                    query_clean = ''.join(c for c in str(query_num) if c.isdigit())
-                    if not query_clean or len(query_clean) < 1:
-                        continue
-                    
-                    for photo_num in photo_numbers:
-                        # Очищаем номер из фото - только цифры
-                        photo_clean = ''.join(c for c in str(photo_num) if c.isdigit())
-                        if not photo_clean or len(photo_clean) < 1:
-                            continue
-                        
-                        # Точное совпадение (самый приоритетный)
-                        if query_clean == photo_clean:
-                            results.append({
-                                "photo_id": photo.id,
-                                "matched_number": photo_num,
-                                "query_number": query_num,
-                                "match_type": "exact"
-                            })
-                            photo_matched = True
-                            break
-                        
-                        # Частичное совпадение (один номер содержит другой)
-                        # Это полезно для случаев, когда распознан неполный номер
-                        if len(query_clean) >= 2 and len(photo_clean) >= 2:
-                            # Проверяем, содержит ли один номер другой
-                            # Минимум 2 цифры должны совпадать
-                            if query_clean in photo_clean or photo_clean in query_clean:
-                                # Проверяем, что совпадающая часть достаточно длинная
-                                min_len = min(len(query_clean), len(photo_clean))
-                                if min_len >= 2:
-                                    results.append({
-                                        "photo_id": photo.id,
-                                        "matched_number": photo_num,
-                                        "query_number": query_num,
-                                        "match_type": "partial"
-                                    })
-                                    photo_matched = True
-                                break
-                        
-                        # Проверка схожести для номеров одинаковой длины (для опечаток OCR)
-                        if len(query_clean) == len(photo_clean) and len(query_clean) >= 3:
-                            # Вычисляем расстояние Хэмминга (количество разных позиций)
-                            differences = sum(1 for a, b in zip(query_clean, photo_clean) if a != b)
-                            # Для номеров длиной 3-4: допускаем 1 ошибку
-                            # Для номеров длиной 5-6: допускаем 2 ошибки
-                            # Для номеров длиной 7+: допускаем до 20% ошибок
-                            max_diff = 1 if len(query_clean) <= 4 else (2 if len(query_clean) <= 6 else max(1, len(query_clean) // 5))
-                            
-                            if differences <= max_diff:
-                                results.append({
-                                    "photo_id": photo.id,
-                                    "matched_number": photo_num,
-                                    "query_number": query_num,
-                                    "match_type": "similar"
-                                })
-                                photo_matched = True
-                                break
-                
-                # Обновляем прогресс
-                if idx % 10 == 0:
-                    self.on_progress(idx, len(photos))
-                    
-            except Exception as e:
-                print(f"Error processing photo {photo.id}: {str(e)}")
-                continue
-        
-        # Удаляем дубликаты результатов (если одно фото найдено несколько раз)
-        seen_photo_ids = set()
-        unique_results = []
-        for result in results:
-            if result["photo_id"] not in seen_photo_ids:
-                unique_results.append(result)
-                seen_photo_ids.add(result["photo_id"])
+        # Индекс мог пережить удаленные фотографии - оставляем только существующие
+        if unique_results:
+            existing_ids = {
+                str(row[0]) for row in
+                db.query(Photo.id).filter(Photo.id.in_([result["photo_id"] for result in unique_results])).all()
+            }
+            unique_results = [result for result in unique_results if result["photo_id"] in existing_ids]
         
-        logger.info(f"FOUND {len(unique_results)} photos with matching numbers (from {len(results)} total matches)")
+        logger.info(f"FOUND {len(unique_results)} photos with matching numbers (index of {number_index.photos_count} photos)")
         if unique_results:
             logger.info(f"Best matches: {unique_results[:5]}")
         
@@ -191,10 +105,10 @@ def search_by_numbers(self, query_image_path: str, event_id: str = None):
                 logger.warning(f"Failed to delete temporary file {query_image_path}: {str(e)}")
 
 
-def extract_numbers(image_path: str) -> List[str]:
-    """Извлечь номера с фотографии"""
+def extract_numbers(image_path: str, face_bboxes: Optional[List] = None) -> List[str]:
+    """Извлечь номера с фотографии (face_bboxes - bbox лиц, если уже известны)"""
     # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Используем singleton вместо создания нового экземпляра
     number_recognition = get_number_recognition()
-    numbers = number_recognition.extract(image_path)
+    numbers = number_recognition.extract(image_path, face_bboxes=face_bboxes)
     return numbers
 
@@ -3,8 +3,6 @@ from celery.exceptions import SoftTimeLimitExceeded, TimeLimitExceeded
 from tasks.celery_app import celery_app
 import sys
 import os
-import json
-import fcntl
 import traceback
 from datetime import datetime
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -12,14 +10,20 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from utils.image_processor import ImageProcessor
 from utils.exif_processor import EXIFProcessor
 from utils.watermark import WatermarkProcessor
+from utils.image_context import PhotoImage
 from utils.step_logger import StepLogger
+from app.config import settings
 from typing import Dict, List
 
 
 def update_event_info_json(event_info_path: str, photo_id: str, photo_name: str, analysis_type: str, data: dict, status: str = "ready"):
     """
     Обновляет event_info.json с результатами анализа
-    Использует атомарную запись через временный файл для предотвращения повреждения JSON
+    
+    Шаг дописывается в журнал event_info.json.log (utils.event_info_store), журнал
+    периодически сворачивается в event_info.json - файл не перечитывается на каждом шаге.
+    Статус шага также атомарно записывается в Redis (utils.event_progress) - из него
+    читает /events/{event_id}/progress
     
     Args:
         event_info_path: Путь к файлу event_info.json
@@ -29,152 +33,352 @@ def update_event_info_json(event_info_path: str, photo_id: str, photo_name: str,
         data: Данные анализа
         status: Статус обработки (ready, processing, error)
     """
+    from utils.event_info_store import append_event_info_record
+    from utils.event_progress import record_step
+    
+    if event_info_path:
+        # Каталог event_info.json назван по event_id
+        record_step(os.path.basename(os.path.dirname(event_info_path)), analysis_type, photo_id, status)
+    
     if not event_info_path or not os.path.exists(event_info_path):
         print(f"Warning: event_info.json not found at {event_info_path}")
         return
     
-    print(f"Updating event_info.json: photo_id={photo_id}, analysis_type={analysis_type}, status={status}")
+    try:
+        append_event_info_record(event_info_path, photo_id, photo_name, analysis_type, data, status)
+    except Exception as e:
+        print(f"Error updating event_info.json for photo {photo_id} ({analysis_type}): {e}")
+
+
+def face_event_info_data(face_encodings: List, face_bboxes: List, error: str = None) -> Dict:
+    """
+    Данные шага facesearch для event_info.json
+
+    С EVENT_INFO_SLIM_FACES векторы лиц не передаются вовсе: в запись попадают только
+    faces_count/face_bboxes (embedding_ref добавляет build_analysis_entry).
+    """
+    if settings.EVENT_INFO_SLIM_FACES:
+        data = {'faces_count': len(face_encodings), 'face_bboxes': face_bboxes}
+    elif face_encodings:
+        data = {'face_encodings': face_encodings, 'face_vector': face_encodings[0], 'face_bboxes': face_bboxes,
+                'faces_count': len(face_encodings)}
+    elif error:
+        data = {'face_encodings': [], 'face_vector': [], 'face_bboxes': []}
+    else:
+        data = {'face_encodings': [], 'face_vector': [], 'face_bboxes': [], 'faces_found': 0}
+    if error:
+        data['error'] = error
+    return data
+
+
+def save_face_search_result(db, photo_id, photo_name: str, faces_data, event_info_path: str,
+                            face_index_writer=None, step_logger=None, error: str = None, photo_writer=None):
+    """
+    Сохраняет результат поиска лиц фотографии в БД, ANN индекс и event_info.json
+    
+    Args:
+        faces_data: Список лиц (словари с embedding и bbox) из extract_faces_batch
+        error: Текст ошибки, если лица извлечь не удалось (сохраняется пустой результат)
+        photo_writer: PhotoWriteBuffer - колонки пишутся пакетно, без отдельного commit
+    """
+    import logging
+    from sqlalchemy import update
+    from app.models import Photo
     
-    max_retries = 3
-    retry_count = 0
+    logger = logging.getLogger(__name__)
     
-    while retry_count < max_retries:
+    # Преобразуем numpy массивы в списки Python для JSON
+    face_vectors = []
+    face_bboxes = []
+    for face_idx, face_data in enumerate(faces_data or []):
+        if not face_data or not isinstance(face_data, dict):
+            logger.warning(f"Face search: Invalid face_data at index {face_idx} for photo {photo_id}: {face_data}")
+            continue
+        emb = face_data.get('embedding')
+        bbox = face_data.get('bbox')
+        if emb is None or bbox is None:
+            logger.warning(f"Face search: embedding or bbox is None for face {face_idx + 1} in photo {photo_id}")
+            continue
+        face_vectors.append(emb.tolist() if hasattr(emb, 'tolist') else list(emb))
+        face_bboxes.append(bbox if isinstance(bbox, list) else list(bbox))
+    
+    # face_encodings - все лица, face_bboxes - [[x1, y1, x2, y2], ...], face_vec - первое лицо (для совместимости)
+    if face_vectors:
+        values = dict(face_encodings=face_vectors, face_bboxes=face_bboxes, face_vec=face_vectors[0], has_faces=True)
+    else:
+        values = dict(has_faces=False, face_encodings=[], face_vec=None, face_bboxes=[])
+    if photo_writer is not None:
+        photo_writer.set(photo_id, **values)
+        if not error:
+            photo_writer.mark_step(photo_id, 'facesearch')
+    else:
         try:
-            # Читаем текущий файл с блокировкой
-            with open(event_info_path, 'r', encoding='utf-8') as f:
-                # Пытаемся заблокировать файл для чтения
-                try:
-                    fcntl.flock(f, fcntl.LOCK_SH)  # Shared lock для чтения
-                except (AttributeError, OSError):
-                    pass
-                
-                try:
-                    event_info = json.load(f)
-                except json.JSONDecodeError as e:
-                    print(f"Error reading event_info.json (attempt {retry_count + 1}): {e}")
-                    if retry_count < max_retries - 1:
-                        retry_count += 1
-                        import time
-                        time.sleep(0.1)  # Небольшая задержка перед повтором
-                        continue
-                    else:
-                        print(f"Failed to read event_info.json after {max_retries} attempts")
-                        return
-                
-                try:
-                    fcntl.flock(f, fcntl.LOCK_UN)
-                except (AttributeError, OSError):
-                    pass
-            
-            # Инициализируем секции анализа если их нет
-            analysis_sections = {
-                'timeline': 'analyze_timeline',
-                'removeexif': 'analyze_removeexif',
-                'watermark': 'analyze_watermark',
-                'facesearch': 'analyze_facesearch',
-                'numbersearch': 'analyze_numbersearch'
-            }
-            
-            section_key = analysis_sections.get(analysis_type)
-            if not section_key:
-                print(f"Unknown analysis type: {analysis_type}")
-                return
-            
-            if section_key not in event_info:
-                event_info[section_key] = []
-            
-            # Ищем существующую запись для этой фотографии
-            existing_index = None
-            for idx, item in enumerate(event_info[section_key]):
-                if item.get('photoId') == photo_id or item.get('photoId') == photo_name:
-                    existing_index = idx
-                    break
-            
-            # Создаем или обновляем запись
-            analysis_entry = {
-                'photoId': photo_id,
-                'updated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'status': status
-            }
-            
-            # Добавляем данные анализа в зависимости от типа
-            if analysis_type == 'timeline':
-                analysis_entry['date'] = data.get('date', '')
-            elif analysis_type == 'removeexif':
-                analysis_entry['data'] = 'clear'
-            elif analysis_type == 'watermark':
-                analysis_entry['data'] = 'watermark_add'
-            elif analysis_type == 'facesearch':
-                # Убеждаемся, что списки сериализуемы
-                face_encodings = data.get('face_encodings', [])
-                face_vector = data.get('face_vector', [])
-                # Конвертируем numpy arrays в списки если нужно
-                if hasattr(face_encodings, 'tolist'):
-                    face_encodings = face_encodings.tolist()
-                if hasattr(face_vector, 'tolist'):
-                    face_vector = face_vector.tolist()
-                analysis_entry['face_encodings'] = face_encodings
-                analysis_entry['face_vector'] = face_vector
-            elif analysis_type == 'numbersearch':
-                # Сохраняем номера, если они есть, иначе null
-                numbers = data.get('numbers', [])
-                if numbers:
-                    analysis_entry['number'] = numbers
-                else:
-                    analysis_entry['number'] = None  # null если номеров нет
-            
-            if existing_index is not None:
-                event_info[section_key][existing_index] = analysis_entry
-            else:
-                event_info[section_key].append(analysis_entry)
-            
-            # Валидируем JSON перед записью
-            try:
-                json.dumps(event_info)  # Проверяем, что данные сериализуемы
-            except (TypeError, ValueError) as e:
-                print(f"Error validating JSON before write: {e}")
-                return
-            
-            # Атомарная запись через временный файл
-            temp_path = event_info_path + '.tmp'
-            with open(temp_path, 'w', encoding='utf-8') as f:
-                try:
-                    fcntl.flock(f, fcntl.LOCK_EX)  # Exclusive lock для записи
-                except (AttributeError, OSError):
-                    pass
-                
-                json.dump(event_info, f, indent=4, ensure_ascii=False)
-                f.flush()
-                os.fsync(f.fileno())  # Принудительная запись на диск
-                
-                try:
-                    fcntl.flock(f, fcntl.LOCK_UN)
-                except (AttributeError, OSError):
-                    pass
-            
-            # Атомарно заменяем оригинальный файл
-            os.replace(temp_path, event_info_path)
-            
-            print(f"Updated event_info.json: {section_key} for photo {photo_id}")
-            break  # Успешно обновлено, выходим из цикла
-            
+            db.execute(update(Photo).where(Photo.id == photo_id).values(**values))
+            db.commit()
+        except Exception as commit_error:
+            logger.error(f"Face search: Error committing to DB for photo {photo_id}: {str(commit_error)}", exc_info=True)
+            db.rollback()
+            raise
+    
+    if face_index_writer:
+        face_index_writer.add(photo_id, face_vectors)
+    
+    if error:
+        logger.info(f"Face search: Saved empty face data to DB for photo {photo_id} (error occurred)")
+        data, status = face_event_info_data([], [], error=error), 'error'
+    elif face_vectors:
+        logger.info(f"Face search: Saved {len(face_vectors)} embeddings and {len(face_bboxes)} bboxes to DB for photo {photo_id}")
+        data, status = face_event_info_data(face_vectors, face_bboxes), 'ready'
+    else:
+        logger.info(f"Face search: Saved has_faces=False to DB for photo {photo_id}")
+        data, status = face_event_info_data([], []), 'ready'
+    
+    if step_logger:
+        if error:
+            step_logger.error(f"Face search failed: {error}")
+        else:
+            step_logger.info(f"Found {len(face_vectors)} face(s) in photo")
+    
+    if os.path.exists(event_info_path):
+        update_event_info_json(event_info_path, str(photo_id), photo_name, 'facesearch', data, status)
+
+
+def flush_face_batch(db, pending: List[Dict], event_info_path: str, face_index_writer=None, photo_writer=None):
+    """
+    Прогоняет отложенные фотографии через пакетное извлечение лиц и сохраняет результаты
+    
+    pending: [{'photo_id', 'photo_name', 'path', 'step_logger'}, ...], очищается после обработки
+    """
+    import logging
+    import time
+    # Инференс идет в пуле процессов с заранее загруженными моделями
+    from utils.ml_pool import extract_faces_batch
+    
+    logger = logging.getLogger(__name__)
+    if not pending:
+        return
+    
+    batch = list(pending)
+    pending.clear()
+    
+    start_time = time.time()
+    batch_results = extract_faces_batch([item['path'] for item in batch])
+    elapsed_time = time.time() - start_time
+    logger.info(f"Face search: Batch of {len(batch)} photos processed in {elapsed_time:.2f} seconds")
+    
+    for item, faces_data in zip(batch, batch_results):
+        try:
+            error = "Face extraction failed" if faces_data is None else None
+            save_face_search_result(
+                db, item['photo_id'], item['photo_name'], faces_data, event_info_path,
+                face_index_writer, item.get('step_logger'), error=error, photo_writer=photo_writer
+            )
         except Exception as e:
-            print(f"Error updating event_info.json (attempt {retry_count + 1}): {e}")
-            if retry_count < max_retries - 1:
-                retry_count += 1
-                import time
-                time.sleep(0.1)
-                continue
+            logger.error(f"Face search error for photo {item['photo_id']}: {str(e)}", exc_info=True)
+            try:
+                save_face_search_result(
+                    db, item['photo_id'], item['photo_name'], [], event_info_path,
+                    face_index_writer, item.get('step_logger'), error=str(e), photo_writer=photo_writer
+                )
+            except Exception as save_error:
+                logger.error(f"Face search: Failed to save error state for photo {item['photo_id']}: {str(save_error)}")
+
+
+def run_number_search(db, photo, image_path: str, event_info_path: str, face_bboxes=None, step_logger=None,
+                      number_index_writer=None, photo_writer=None):
+    """
+    Распознает номера на фотографии и сохраняет их в БД, индекс номеров и event_info.json
+    
+    face_bboxes: bbox лиц фотографии - OCR сначала ищет текст в зонах под лицами
+    photo_writer: PhotoWriteBuffer - номера пишутся пакетно, без отдельного commit
+    Ошибки не пробрасываются: при ошибке сохраняется пустой список номеров
+    """
+    import logging
+    
+    logger = logging.getLogger(__name__)
+    
+    if step_logger:
+        step_logger.info(f"Starting number search for photo {photo.id}")
+        step_logger.info(f"Processed path: {image_path}")
+    logger.info(f"Photo {photo.id}: Starting number search, image_path={image_path}")
+    try:
+        # ВАЖНО: Добавляем таймаут для обработки номеров, чтобы избежать зависаний
+        import time
+
+        start_time = time.time()
+        logger.info(f"Photo {photo.id}: Calling extract_numbers, this may take up to 60 seconds...")
+
+        # EasyOCR выполняется в пуле процессов (utils.ml_pool), а не в потоке воркера
+        from utils.ml_pool import extract_numbers
+        numbers = extract_numbers(image_path, face_bboxes=face_bboxes)
+
+        elapsed_time = time.time() - start_time
+        logger.info(f"Photo {photo.id}: Number extraction completed in {elapsed_time:.2f} seconds")
+
+        # ВАЖНО: Если обработка заняла слишком много времени, логируем предупреждение
+        if elapsed_time > 30:
+            logger.warning(f"Photo {photo.id}: Number extraction took {elapsed_time:.2f} seconds (slow)")
+
+        # ВАЖНО: Если обработка заняла больше 60 секунд, это критично
+        if elapsed_time > 60:
+            logger.error(f"Photo {photo.id}: Number extraction took {elapsed_time:.2f} seconds (CRITICAL - very slow)")
+
+        if step_logger:
+            step_logger.info(f"Number search completed, found {len(numbers) if numbers else 0} numbers")
+            if numbers:
+                step_logger.info(f"Numbers found: {numbers}")
             else:
-                print(f"Failed to update event_info.json after {max_retries} attempts")
-                # Удаляем временный файл если он остался
-                temp_path = event_info_path + '.tmp'
-                if os.path.exists(temp_path):
-                    try:
-                        os.remove(temp_path)
-                    except:
-                        pass
-                return
+                step_logger.info("No numbers found")
+        logger.info(f"Photo {photo.id}: Number search completed, found {len(numbers) if numbers else 0} numbers")
+        if numbers:
+            logger.debug(f"Photo {photo.id}: Numbers found: {numbers}")
+        else:
+            logger.debug(f"Photo {photo.id}: No numbers found")
+
+        # Сохраняем номера в базу (даже если пустой список)
+        if photo_writer is not None:
+            photo_writer.set(photo.id, numbers=numbers if numbers else [])
+            photo_writer.mark_step(photo.id, 'numbersearch')
+        else:
+            photo.numbers = numbers if numbers else []
+
+            logger.info(f"Number search: Before commit - photo.numbers={photo.numbers}, count={len(numbers) if numbers else 0}")
+
+            # ВАЖНО: Явно сохраняем изменения в БД
+            try:
+                db.add(photo)  # Явно добавляем объект в сессию
+                db.commit()  # ВАЖНО: Коммитим сразу после сохранения номеров
+                db.refresh(photo)  # Обновляем объект из БД
+                logger.info(f"Number search: After commit - photo.numbers={photo.numbers}, count={len(photo.numbers) if photo.numbers else 0}")
+            except Exception as commit_error:
+                logger.error(f"Number search: Error committing to DB: {str(commit_error)}", exc_info=True)
+                db.rollback()
+                raise
+
+        logger.info(f"Number search: Saved {len(numbers) if numbers else 0} numbers to DB for photo {photo.id}")
+        if number_index_writer:
+            number_index_writer.add(photo.id, numbers or [])
+
+        # Обновляем event_info.json для number_search (всегда, даже если номеров нет)
+        if os.path.exists(event_info_path):
+            photo_name = getattr(photo, 'original_name', None) or f"photo_{photo.id}"
+            # Если номеров нет, передаем пустой список (будет сохранен как null в JSON)
+            update_event_info_json(
+                event_info_path,
+                str(photo.id),
+                photo_name,
+                'numbersearch',
+                {'numbers': numbers if numbers else []},
+                'ready'
+            )
+            logger.info(f"Photo {photo.id}: Updated event_info.json for number_search")
+    except Exception as e:
+        if step_logger:
+            step_logger.error(f"Error in number search: {str(e)}", exc_info=True)
+        logger.error(f"Photo {photo.id}: Error in number search: {str(e)}", exc_info=True)
+        # Сохраняем пустой список номеров в случае ошибки
+        if photo_writer is not None:
+            photo_writer.set(photo.id, numbers=[])
+        else:
+            photo.numbers = []
+            db.commit()  # ВАЖНО: Коммитим даже при ошибке, чтобы сохранить пустой список
+        logger.info(f"Number search: Saved empty numbers list to DB for photo {photo.id} (error occurred)")
+        if number_index_writer:
+            number_index_writer.add(photo.id, [])
+
+        # Обновляем event_info.json с ошибкой
+        if os.path.exists(event_info_path):
+            photo_name = getattr(photo, 'original_name', None) or f"photo_{photo.id}"
+            update_event_info_json(
+                event_info_path,
+                str(photo.id),
+                photo_name,
+                'numbersearch',
+                {'numbers': [], 'error': str(e)},
+                'error'
+            )
+            logger.error(f"Photo {photo.id}: Updated event_info.json for number_search with error")
+
+
+def replay_face_search_result(photo, event_info_path: str, face_index_writer=None):
+    """
+    Шаг поиска лиц пропущен по контрольной точке: данные лиц уже в БД, заново
+    пополняются только ANN индекс и event_info.json
+    """
+    face_encodings = photo.face_encodings or []
+    face_bboxes = photo.face_bboxes or []
+    if face_index_writer:
+        face_index_writer.add(photo.id, face_encodings)
+    if os.path.exists(event_info_path):
+        photo_name = getattr(photo, 'original_name', None) or f"photo_{photo.id}"
+        data = face_event_info_data(face_encodings, face_bboxes)
+        update_event_info_json(event_info_path, str(photo.id), photo_name, 'facesearch', data, 'ready')
+
+
+def replay_number_search_result(photo, event_info_path: str, number_index_writer=None):
+    """Шаг поиска номеров пропущен по контрольной точке: номера берутся из БД"""
+    numbers = photo.numbers or []
+    if number_index_writer:
+        number_index_writer.add(photo.id, numbers)
+    if os.path.exists(event_info_path):
+        photo_name = getattr(photo, 'original_name', None) or f"photo_{photo.id}"
+        update_event_info_json(event_info_path, str(photo.id), photo_name, 'numbersearch', {'numbers': numbers}, 'ready')
+
+
+def flush_number_batch(db, pending: List[Dict], event_info_path: str, number_index_writer=None, photo_writer=None):
+    """
+    Распознает номера на фото, которые ждали результатов поиска лиц (bbox уже сохранены в БД
+    или ждут записи в photo_writer)
+    
+    pending: [{'photo_id', 'path', 'step_logger'}, ...], очищается после обработки
+    """
+    import logging
+    from app.models import Photo
+    
+    logger = logging.getLogger(__name__)
+    batch = list(pending)
+    pending.clear()
+    
+    for item in batch:
+        # Объект уже в сессии части - запрос к БД не нужен
+        photo = db.get(Photo, item['photo_id'])
+        if not photo:
+            logger.error(f"Number search: Photo {item['photo_id']} not found in database, skipping")
+            continue
+        face_bboxes = photo_writer.get(photo.id, 'face_bboxes', photo.face_bboxes) if photo_writer else photo.face_bboxes
+        run_number_search(db, photo, item['path'], event_info_path, face_bboxes, item.get('step_logger'),
+                          number_index_writer, photo_writer)
+
+
+def report_event_progress(task_id: str, total: int, done: int = 1) -> int:
+    """
+    Учитывает обработанные фото в общем счетчике события и обновляет PROGRESS задачи task_id
+    
+    Части события выполняются параллельно на разных воркерах, поэтому прогресс
+    суммируется в Redis (INCRBY), а не считается по индексу внутри части.
+    Returns: сколько фото события обработано на данный момент
+    """
+    import logging
+    logger = logging.getLogger(__name__)
+    
+    try:
+        client = celery_app.backend.client
+        key = f"event_progress:{task_id}"
+        current = client.incrby(key, done)
+        client.expire(key, 86400)
+        celery_app.backend.store_result(
+            task_id,
+            {
+                'progress': int((min(current, total) / total) * 100) if total else 100,
+                'current': min(current, total),
+                'total': total
+            },
+            'PROGRESS'
+        )
+        return current
+    except Exception as e:
+        logger.warning(f"Failed to report event progress for task {task_id}: {str(e)}")
+        return 0
 
 
 class CallbackTask(Task):
@@ -196,6 +400,12 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
     """
     Обработка всех фотографий события
     
+    Задача готовит событие и делит фотографии на части по PHOTO_CHUNK_SIZE:
+    части обрабатываются параллельно задачами process_photo_chunk, затем chord
+    вызывает finalize_event_processing (embeddings, S3, проверка event_info.json).
+    Задача заменяется chord'ом, поэтому итоговый результат и прогресс доступны
+    по её task_id, как и раньше.
+    
     analyses: {
         'timeline': bool,
         'remove_exif': bool,
@@ -208,7 +418,7 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
     from app.database import SessionLocal
     from app.models import Photo, Event
     from utils.task_logger import get_task_logger
-    from celery.exceptions import SoftTimeLimitExceeded, TimeLimitExceeded
+    from celery import chord, group
     
     import logging
     logger = logging.getLogger(__name__)
@@ -253,7 +463,7 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
     # Нормализуем все значения analyses
     analyses_normalized = {}
     for key, value in analyses.items():
-        if key in ('timeline', 'remove_exif', 'watermark', 'face_search', 'number_search'):
+        if key in ('timeline', 'remove_exif', 'watermark', 'face_search', 'number_search', 'force_reprocess'):
             analyses_normalized[key] = normalize_bool(value)
         else:
             analyses_normalized[key] = value
@@ -261,20 +471,7 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
     analyses = analyses_normalized
     logger.info(f"Normalized analyses: {analyses}")
     
-    # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Предварительная инициализация InsightFace для диагностики
-    # Это поможет увидеть, инициализируется ли модель при старте задачи
-    # ВАЖНО: Используем нормализованные значения analyses
-    if analyses.get('face_search', False):
-        try:
-            task_logger.error("INSIGHTFACE - Предварительная инициализация при старте задачи")
-            logger.error("INSIGHTFACE - Предварительная инициализация при старте задачи")
-            from utils.face_recognition import get_face_recognition
-            face_recognition = get_face_recognition()
-            task_logger.error(f"INSIGHTFACE - Модель инициализирована, model exists: {hasattr(face_recognition, 'model') and face_recognition.model is not None}")
-            logger.error(f"INSIGHTFACE - Модель инициализирована, model exists: {hasattr(face_recognition, 'model') and face_recognition.model is not None}")
-        except Exception as init_error:
-            task_logger.error(f"INSIGHTFACE - Ошибка при предварительной инициализации: {str(init_error)}", exc_info=True)
-            logger.error(f"INSIGHTFACE - Ошибка при предварительной инициализации: {str(init_error)}", exc_info=True)
+    # Модели (InsightFace, EasyOCR) загружаются в воркерах частей, координатору они не нужны
     
     db = SessionLocal()
     
@@ -384,87 +581,246 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
         if not event:
             raise ValueError(f"Event {event_id} not found")
         
-        # Определяем путь к директории события (используется в разных местах)
-        event_dir = f"/var/www/html/storage/app/public/events/{event_id}"
-        
-        image_processor = ImageProcessor()
-        exif_processor = EXIFProcessor()
-        watermark_processor = WatermarkProcessor()
-        
-        logger.info(f"Initialized processors for event {event_id}")
+        if analyses.get('face_search', False):
+            from utils.embedding_store import invalidate_event_embedding_sidecar
+            # Пока лица пересчитываются, поиск по событию идет по face_encodings из БД
+            invalidate_event_embedding_sidecar(db, event_id)
         
         # Инициализируем все фотографии в секциях анализа (если event_info.json существует)
         # Это нужно для того, чтобы каждая фотография имела запись на каждом шаге анализа
         if os.path.exists(event_info_path):
             try:
-                with open(event_info_path, 'r', encoding='utf-8') as f:
-                    event_info_init = json.load(f)
+                # Журнал прошлого запуска сворачивается вместе с перезаписью снимка, под его блокировкой
+                from utils.event_info_store import slim_face_entries, update_event_info
                 
-                # Инициализируем записи для всех фотографий в каждой секции анализа
-                for photo in photo_list:
-                    photo_id = str(photo.id)
+                def init_sections(event_info_init):
+                    if settings.EVENT_INFO_SLIM_FACES:
+                        # Векторы лиц прошлых запусков тоже убираем из снимка
+                        slimmed = slim_face_entries(event_info_init)
+                        if slimmed:
+                            logger.info(f"Removed face vectors from {slimmed} analyze_facesearch entries of event {event_id}")
                     
-                    # Инициализируем для каждого типа анализа, который будет выполняться
-                    if analyses.get('number_search', False):
-                        section_key = 'analyze_numbersearch'
-                        if section_key not in event_info_init:
-                            event_info_init[section_key] = []
+                    # Инициализируем записи для всех фотографий в каждой секции анализа
+                    for photo in photo_list:
+                        photo_id = str(photo.id)
                         
-                        # Проверяем, есть ли уже запись для этой фотографии
-                        existing = any(item.get('photoId') == photo_id for item in event_info_init[section_key])
-                        if not existing:
-                            # Создаем начальную запись со статусом processing
-                            event_info_init[section_key].append({
-                                'photoId': photo_id,
-                                'updated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                                'status': 'processing',
-                                'number': None  # null пока не обработано
-                            })
+                        # Инициализируем для каждого типа анализа, который будет выполняться
+                        if analyses.get('number_search', False):
+                            section_key = 'analyze_numbersearch'
+                            if section_key not in event_info_init:
+                                event_info_init[section_key] = []
+                            
+                            # Проверяем, есть ли уже запись для этой фотографии
+                            existing = any(item.get('photoId') == photo_id for item in event_info_init[section_key])
+                            if not existing:
+                                # Создаем начальную запись со статусом processing
+                                event_info_init[section_key].append({
+                                    'photoId': photo_id,
+                                    'updated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                                    'status': 'processing',
+                                    'number': None  # null пока не обработано
+                                })
                 
                 # Сохраняем обновленный event_info.json
-                temp_path = event_info_path + '.tmp'
-                with open(temp_path, 'w', encoding='utf-8') as f:
-                    json.dump(event_info_init, f, indent=4, ensure_ascii=False)
-                os.replace(temp_path, event_info_path)
+                update_event_info(event_info_path, init_sections)
                 print(f"Initialized analysis sections for {len(photo_list)} photos")
             except Exception as e:
                 print(f"Warning: Failed to initialize analysis sections: {e}")
         
-        # Инициализируем счетчики для обновления event_info.json каждые 5 фотографий
-        update_counter = 0
-        update_interval = 5
-        
         # ВАЖНО: Обновляем total на основе реального количества фотографий
         total = len(photo_list)
-        logger.info(f"Starting to process {total} photos for event {event_id}")
+        photo_ids = [str(photo.id) for photo in photo_list]
+        chunk_size = max(1, settings.PHOTO_CHUNK_SIZE)
+        chunks = [photo_ids[i:i + chunk_size] for i in range(0, total, chunk_size)]
+        logger.info(f"Dispatching {total} photos for event {event_id} in {len(chunks)} chunks of up to {chunk_size}")
         logger.info(f"Analyses configuration: {analyses}")
         
-        # Счетчик успешно обработанных фотографий
-        successfully_processed = 0
-        failed_photos = []
+        # Сбрасываем общий счетчик прогресса (на случай повторного запуска с тем же task_id)
+        try:
+            celery_app.backend.client.delete(f"event_progress:{self.request.id}")
+        except Exception as counter_error:
+            logger.warning(f"Failed to reset progress counter: {str(counter_error)}")
         
-        # ВАЖНО: Таймаут на обработку одной фотографии (5 минут)
-        # Если обработка одной фотографии занимает больше 5 минут, пропускаем её
-        PHOTO_PROCESSING_TIMEOUT = 300  # 5 минут
+        # Состояние шагов в Redis: секции в терминах update_event_info_json
+        from utils.event_progress import init_event_progress
+        progress_sections = [
+            section for section, analysis_key in (
+                ('timeline', 'timeline'),
+                ('removeexif', 'remove_exif'),
+                ('watermark', 'watermark'),
+                ('facesearch', 'face_search'),
+                ('numbersearch', 'number_search'),
+            )
+            if analyses.get(analysis_key, False)
+        ]
+        init_event_progress(event_id, self.request.id, total, progress_sections)
         
         # Обновляем прогресс в начале
-        self.on_progress(0, total)
+        self.on_progress(0, total or 1)
         logger.info(f"Progress: 0/{total} (0%)")
         
-        for idx, photo in enumerate(photo_list, 1):
+        finalize = finalize_event_processing.s(event_id, analyses, photo_ids)
+        if chunks:
+            workflow = chord(group(
+                process_photo_chunk.s(event_id, analyses, chunk, self.request.id, total, chunk_index * chunk_size)
+                for chunk_index, chunk in enumerate(chunks)
+            ), finalize)
+        else:
+            # Нет фотографий - сразу завершаем (chord с пустой группой не нужен)
+            workflow = finalize.clone(args=([],))
+    
+    except Exception as e:
+        error_msg = f"КРИТИЧЕСКАЯ ОШИБКА в process_event_photos для события {event_id}"
+        logger.error(f"ERROR in process_event_photos for event {event_id}: {str(e)}", exc_info=True)
+        task_logger.critical(error_msg, exc_info=True, event_id=event_id, error=str(e))
+        
+        # Получаем информацию об ошибке для сериализации
+        error_type = type(e).__name__
+        error_message = str(e)
+        error_traceback = traceback.format_exc()
+        
+        # Сохраняем информацию об ошибке в метаданные задачи
+        self.update_state(
+            state='FAILURE',
+            meta={
+                'error': error_message,
+                'error_type': error_type,
+                'event_id': event_id,
+                'traceback': error_traceback
+            }
+        )
+        
+        from utils.event_progress import finish_event_progress
+        finish_event_progress(event_id, 'error', error=error_message)
+        
+        # ВАЖНО: Не пробрасываем исключение, а возвращаем словарь с ошибкой
+        # Это позволяет избежать проблем с сериализацией исключений в JSON backend
+        return {
+            "status": "error",
+            "error": error_message,
+            "error_type": error_type,
+            "event_id": event_id,
+            "traceback": error_traceback,
+            "total_processed": 0,
+            "successfully_processed": 0,
+            "failed_count": 0,
+        }
+    finally:
+        db.close()
+        try:
+            task_logger.close()
+        except Exception as close_error:
+            logger.warning(f"Error closing task logger: {str(close_error)}")
+    
+    # ВАЖНО: replace() вне try - он завершает задачу исключением Ignore.
+    # Последняя задача chord'а (finalize) получает task_id этой задачи, поэтому Laravel
+    # увидит SUCCESS только после завершения всей обработки
+    raise self.replace(workflow)
+
+
+@celery_app.task(bind=True, base=CallbackTask)
+def process_photo_chunk(self, event_id: str, analyses: Dict[str, bool], photo_ids: List[str],
+                        parent_task_id: str, total: int, chunk_offset: int = 0):
+    """
+    Обработка части фотографий события (задача из группы chord'а process_event_photos)
+    
+    analyses уже нормализованы в process_event_photos. Прогресс суммируется по всем
+    частям и пишется в состояние parent_task_id - его отслеживает Laravel.
+    
+    Returns: {'successfully_processed': int, 'failed_photos': [...]} для finalize_event_processing
+    """
+    import json
+    from app.database import SessionLocal
+    from app.models import Photo
+    from utils.task_logger import get_task_logger
+    from utils.photo_checkpoints import content_hash
+    
+    import logging
+    logger = logging.getLogger(__name__)
+    
+    task_logger = get_task_logger("process_photo_chunk", self.request.id)
+    task_logger.log_task_start(event_id=event_id, analyses=analyses, photos=len(photo_ids), offset=chunk_offset)
+    
+    # Колонки фото пишет PhotoWriteBuffer: его commit не должен сбрасывать загруженные фото части,
+    # иначе каждое следующее фото перечитывается из БД отдельным SELECT
+    db = SessionLocal(expire_on_commit=False)
+    
+    # Счетчик успешно обработанных фотографий
+    successfully_processed = 0
+    failed_photos = []
+    photo_writer = None
+    s3_pipeline = None
+    
+    try:
+        event_info_path = f"/var/www/html/storage/app/public/events/{event_id}/event_info.json"
+        event_dir = f"/var/www/html/storage/app/public/events/{event_id}"
+        
+        # Сохраняем порядок фотографий, заданный координатором
+        photos = db.query(Photo).filter(Photo.id.in_(photo_ids)).all()
+        photo_order = {photo_id: position for position, photo_id in enumerate(photo_ids)}
+        photo_list = sorted(photos, key=lambda p: photo_order.get(str(p.id), 0))
+        if len(photo_list) < len(photo_ids):
+            logger.warning(f"Chunk at offset {chunk_offset}: {len(photo_ids) - len(photo_list)} photos not found in database")
+        
+        image_processor = ImageProcessor()
+        exif_processor = EXIFProcessor()
+        watermark_processor = WatermarkProcessor()
+        
+        # ANN индекс лиц для поиска по всем событиям пополняется по мере обработки
+        face_index_writer = None
+        # Фото, ожидающие пакетного извлечения лиц, и поиска номеров по их bbox
+        pending_faces = []
+        pending_numbers = []
+        if analyses.get('face_search', False):
+            from utils.face_index import FaceIndexWriter
+            face_index_writer = FaceIndexWriter(event_id)
+        # Индекс номеров для search_by_numbers пополняется так же
+        number_index_writer = None
+        if analyses.get('number_search', False):
+            from utils.number_index import NumberIndexWriter
+            number_index_writer = NumberIndexWriter(event_id)
+        # Отметки выполненных шагов: повторный запуск пропускает шаги с тем же входным файлом
+        checkpoints = None
+        if settings.PHOTO_CHECKPOINTS_ENABLED and not analyses.get('force_reprocess', False):
+            from utils.photo_checkpoints import CheckpointStore
+            checkpoints = CheckpointStore(event_id)
+            try:
+                loaded = checkpoints.load(photo_ids)
+                logger.info(f"Chunk at offset {chunk_offset}: loaded {loaded} step checkpoints")
+            except Exception as checkpoint_error:
+                logger.error(f"Failed to load step checkpoints for event {event_id}: {str(checkpoint_error)}", exc_info=True)
+                checkpoints = None
+        # Колонки photos (пути, лица, номера) пишутся пакетно, отметки шагов - после них
+        from utils.photo_writer import PhotoWriteBuffer
+        photo_writer = PhotoWriteBuffer(db, checkpoints=checkpoints)
+        # Загрузка готовых файлов на S3 параллельно с анализом (finalize догрузит остальное)
+        if settings.S3_PIPELINED_UPLOAD:
+            from utils.s3_uploader import S3Uploader, S3UploadPipeline
+            s3_uploader = S3Uploader()
+            if s3_uploader.is_available():
+                s3_pipeline = S3UploadPipeline(event_id, s3_uploader)
+        
+        logger.info(f"Initialized processors for event {event_id}, chunk at offset {chunk_offset}")
+        
+        # Инициализируем счетчики для обновления event_info.json каждые 5 фотографий
+        update_counter = 0
+        update_interval = 5
+        
+        logger.info(f"Starting to process {len(photo_list)} photos (offset {chunk_offset} of {total}) for event {event_id}")
+        
+        # ВАЖНО: Таймаут на обработку одной фотографии (5 минут)
+        # Если обработка одной фотографии занимает больше 5 минут, пропускаем её
+        PHOTO_PROCESSING_TIMEOUT = 300  # 5 минут
+        
+        for idx, photo in enumerate(photo_list, chunk_offset + 1):
             photo_start_time = None
+            photo_image = None
             try:
                 import time
                 photo_start_time = time.time()
                 
-                # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Перезагружаем объект photo из БД перед обработкой
-                # Это гарантирует, что мы работаем с актуальными данными и объект отслеживается сессией
-                photo_id = photo.id
-                db.expire_all()  # Сбрасываем кэш всех объектов
-                photo = db.query(Photo).filter(Photo.id == photo_id).first()
-                if not photo:
-                    logger.error(f"Photo {photo_id} not found in database, skipping")
-                    continue
+                # Объект загружен запросом части и отслеживается сессией; изменения колонок
+                # копятся в photo_writer, поэтому перечитывать строку перед каждым фото не нужно
                 
                 # ВАЖНО: Проверяем таймаут перед началом обработки
                 # Если уже прошло слишком много времени, пропускаем фотографию
@@ -473,13 +829,6 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                     # (это косвенная проверка, основная проверка будет после обработки)
                     pass
                 
-                # Обновляем прогресс в начале обработки каждой фотографии
-                # Это помогает видеть, что задача не зависла
-                try:
-                    self.on_progress(idx - 1, total)
-                except Exception as progress_error:
-                    logger.warning(f"Failed to update progress at start of photo {idx}: {str(progress_error)}")
-                
                 logger.info(f"Processing photo {idx}/{total}: photo_id={photo.id}")
                 logger.info(f"Progress: {idx}/{total} ({(idx/total*100):.1f}%)")
                 
@@ -575,6 +924,9 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                 
                 logger.info(f"Photo {photo.id}: Found file at {photo_path}, proceeding with processing")
                 
+                # Файл декодируется один раз: EXIF, поворот, водяной знак и WebP работают с одними пикселями
+                photo_image = PhotoImage(photo_path, exif_processor)
+                
                 # ВАЖНО: Порядок выполнения анализов критичен!
                 # 1. Сначала извлекаем EXIF данные (timeline) - ДО удаления EXIF
                 # 2. Потом удаляем EXIF и поворачиваем изображение
@@ -593,11 +945,12 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                         step_logger_timeline.info(f"Starting timeline extraction for photo {photo.id}")
                         step_logger_timeline.info(f"Photo path: {photo_path}")
                     logger.info(f"Photo {photo.id}: Extracting EXIF datetime BEFORE removing EXIF")
+                    created_at_exif = None
                     try:
                         # Используем оригинальный photo_path (из upload), так как EXIF еще не удален
                         if step_logger_timeline:
                             step_logger_timeline.info(f"Extracting EXIF data from: {photo_path}")
-                        exif_data = exif_processor.extract_exif(photo_path)
+                        exif_data = photo_image.exif()
                         if step_logger_timeline:
                             step_logger_timeline.info(f"EXIF data extracted: {exif_data}")
                         logger.debug(f"Photo {photo.id}: EXIF data extracted: {exif_data}")
@@ -612,20 +965,17 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                                     if parsed_datetime:
                                         # Сохраняем в created_at_exif в стандартном формате "YYYY-MM-DD HH:MM:SS"
                                         formatted_datetime = parsed_datetime.strftime("%Y-%m-%d %H:%M:%S")
-                                        if hasattr(photo, 'created_at_exif'):
-                                            photo.created_at_exif = formatted_datetime
+                                        created_at_exif = formatted_datetime
                                         
                                         logger.info(f"Photo {photo.id}: Parsed EXIF datetime: {datetime_str} -> {formatted_datetime}")
                                     else:
                                         # Если парсинг не удался, сохраняем оригинальную строку
-                                        if hasattr(photo, 'created_at_exif'):
-                                            photo.created_at_exif = datetime_str
+                                        created_at_exif = datetime_str
                                         logger.warning(f"Photo {photo.id}: Could not parse datetime, saved as-is: {datetime_str}")
                                 except Exception as e:
                                     logger.error(f"Photo {photo.id}: Error parsing datetime '{datetime_str}': {str(e)}", exc_info=True)
                                     # Если не удалось преобразовать, сохраняем оригинальную строку
-                                    if hasattr(photo, 'created_at_exif'):
-                                        photo.created_at_exif = datetime_str
+                                    created_at_exif = datetime_str
                         else:
                             logger.warning(f"Photo {photo.id}: No datetime found in EXIF data: {exif_data}")
                         
@@ -635,8 +985,8 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                             photo_name = getattr(photo, 'original_name', None) or f"photo_{photo.id}"
                             timeline_data = {}
                             if exif_data and 'datetime' in exif_data and exif_data['datetime']:
-                                if hasattr(photo, 'created_at_exif') and photo.created_at_exif:
-                                    timeline_data['date'] = photo.created_at_exif
+                                if created_at_exif:
+                                    timeline_data['date'] = created_at_exif
                                 else:
                                     timeline_data['date'] = exif_data['datetime']
                             
@@ -650,7 +1000,9 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                             )
                             logger.info(f"Photo {photo.id}: Updated event_info.json for timeline with data: {timeline_data}")
                         
-                        db.commit()
+                        # Дата пишется в photos пакетно вместе с остальными колонками фото
+                        if created_at_exif and hasattr(photo, 'created_at_exif'):
+                            photo_writer.set(photo.id, created_at_exif=created_at_exif)
                         update_counter += 1
                         if step_logger_timeline:
                             step_logger_timeline.info(f"Timeline extraction completed successfully")
@@ -679,7 +1031,25 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                 
                 step_logger_remove_exif = StepLogger(str(event_id), str(photo.id), "remove_exif") if should_remove_exif else None
                 
-                if should_remove_exif:
+                # Контрольная точка: original_path уже указывает на результат removeexif с тем же содержимым
+                source_hash = content_hash(photo_path) if checkpoints else None
+                removeexif_checkpoint = checkpoints.get(photo.id, 'removeexif') if checkpoints and should_remove_exif else None
+                if removeexif_checkpoint and not (
+                    photo.original_path == removeexif_checkpoint['output'].get('path')
+                    and source_hash == removeexif_checkpoint['output'].get('hash')
+                ):
+                    removeexif_checkpoint = None
+                
+                if removeexif_checkpoint:
+                    processed_path = photo_path
+                    original_photo_path = photo_path
+                    checkpoint_input = source_hash
+                    logger.info(f"Photo {photo.id}: EXIF already removed ({photo.original_path}), skipping")
+                    if os.path.exists(event_info_path):
+                        photo_name = getattr(photo, 'original_name', None) or f"photo_{photo.id}"
+                        update_event_info_json(event_info_path, str(photo.id), photo_name, 'removeexif', {}, 'ready')
+                    update_counter += 1
+                elif should_remove_exif:
                     if step_logger_remove_exif:
                         step_logger_remove_exif.info(f"Starting EXIF removal and rotation for photo {photo.id}")
                         step_logger_remove_exif.info(f"Input photo path: {photo_path}")
@@ -702,15 +1072,10 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                     
                     logger.info(f"Photo {photo.id}: Normalizing EXIF orientation and saving to {original_photo_path}")
                     # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Применяем EXIF ориентацию ОДИН РАЗ в начале пайплайна
-                    # Сначала копируем файл в original_photo, потом нормализуем ориентацию
                     try:
-                        import shutil
-                        # Копируем файл в original_photo
-                        shutil.copy2(photo_path, original_photo_path)
-                        logger.info(f"Photo {photo.id}: Copied to {original_photo_path}")
-                        
-                        # Нормализуем ориентацию (применяет EXIF и удаляет его)
-                        exif_processor.normalize_orientation(original_photo_path)
+                        # Нормализуем ориентацию (применяет EXIF и удаляет его) и сохраняем в original_photo;
+                        # повернутые пиксели остаются в photo_image для водяного знака и WebP
+                        photo_image.normalize(original_photo_path)
                         
                         processed_path = original_photo_path
                         if step_logger_remove_exif:
@@ -725,20 +1090,11 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                     
                     # Обновляем original_path в базе данных (относительный путь)
                     relative_original_path = f"events/{event_id}/original_photo/{unique_filename}"
-                    # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Используем update() для гарантированного сохранения
-                    try:
-                        from sqlalchemy import update
-                        update_stmt = update(Photo).where(Photo.id == photo.id).values(
-                            original_path=relative_original_path
-                        )
-                        db.execute(update_stmt)
-                        db.commit()
-                        db.refresh(photo)
-                        logger.info(f"Photo {photo.id}: Updated original_path={photo.original_path} in DB")
-                    except Exception as commit_error:
-                        logger.error(f"Photo {photo.id}: Error committing original_path to DB: {str(commit_error)}", exc_info=True)
-                        db.rollback()
-                        raise
+                    photo_writer.set(photo.id, original_path=relative_original_path)
+                    logger.info(f"Photo {photo.id}: Queued original_path={relative_original_path} for DB")
+                    checkpoint_input = content_hash(original_photo_path) if checkpoints else None
+                    photo_writer.mark_step(photo.id, 'removeexif', input_hash=source_hash,
+                                           path=relative_original_path, hash=checkpoint_input)
                     
                     # Обновляем event_info.json для remove_exif
                     if os.path.exists(event_info_path):
@@ -757,104 +1113,100 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                     # Если remove_exif отключен, используем оригинальный файл
                     processed_path = photo_path
                     original_photo_path = photo_path
+                    checkpoint_input = source_hash
                     logger.info(f"Photo {photo.id}: EXIF removal skipped, using original file")
                 
+                # Вход шагов анализа - файл после removeexif
+                if checkpoints:
+                    checkpoints.set_input(photo.id, checkpoint_input)
+                
                 # ШАГ 3: Нанесение водяного знака (всегда выполняется, если watermark включен или не указан)
                 watermark_enabled = analyses.get('watermark', True)
                 logger.info(f"Photo {photo.id}: watermark={watermark_enabled}")
                 
-                # Файл должен быть сохранен в папку custom_photo
-                custom_photo_dir = os.path.join(event_dir, "custom_photo")
+                # Результат прошлого запуска для того же файла и режима водяного знака уже на месте
+                watermark_input = f"{checkpoint_input}:watermark={int(bool(watermark_enabled))}" if checkpoint_input else None
+                watermark_checkpoint = checkpoints.done(photo.id, 'watermark', watermark_input) if checkpoints else None
+                if watermark_checkpoint and not (
+                    photo.custom_path == watermark_checkpoint['output'].get('path')
+                    and os.path.exists(f"/var/www/html/storage/app/public/{photo.custom_path}")
+                ):
+                    watermark_checkpoint = None
                 
-                # Создаем папку custom_photo если её нет
-                if not os.path.exists(custom_photo_dir):
-                    os.makedirs(custom_photo_dir, mode=0o755, exist_ok=True)
+                if watermark_checkpoint:
+                    logger.info(f"Photo {photo.id}: Watermark already done for this file ({photo.custom_path}), skipping")
+                else:
+                    # Файл должен быть сохранен в папку custom_photo
+                    custom_photo_dir = os.path.join(event_dir, "custom_photo")
+                
+                    # Создаем папку custom_photo если её нет
+                    if not os.path.exists(custom_photo_dir):
+                        os.makedirs(custom_photo_dir, mode=0o755, exist_ok=True)
                 
-                # Генерируем уникальное имя файла для custom_photo (WebP формат)
-                import uuid
-                custom_filename = f"{uuid.uuid4()}.webp"
-                custom_photo_path = os.path.join(custom_photo_dir, custom_filename)
+                    # Генерируем уникальное имя файла для custom_photo (WebP формат)
+                    import uuid
+                    custom_filename = f"{uuid.uuid4()}.webp"
+                    custom_photo_path = os.path.join(custom_photo_dir, custom_filename)
                 
-                if watermark_enabled:
-                    logger.info(f"Photo {photo.id}: Adding watermark, processed_path={processed_path}, custom_photo_path={custom_photo_path}")
-                    # Проверяем, что исходный файл существует
-                    if not os.path.exists(processed_path):
-                        logger.error(f"Photo {photo.id}: processed_path does not exist: {processed_path}")
-                        raise FileNotFoundError(f"processed_path not found: {processed_path}")
+                    if watermark_enabled:
+                        logger.info(f"Photo {photo.id}: Adding watermark, processed_path={processed_path}, custom_photo_path={custom_photo_path}")
+                        # Проверяем, что исходный файл существует
+                        if not os.path.exists(processed_path):
+                            logger.error(f"Photo {photo.id}: processed_path does not exist: {processed_path}")
+                            raise FileNotFoundError(f"processed_path not found: {processed_path}")
                     
-                    # Наносим водяной знак и конвертируем в WebP
-                    watermarked_path = watermark_processor.add_watermark(
-                        processed_path,
-                        text=f"hunter-photo.ru",
-                        output_path=custom_photo_path
-                    )
-                    logger.info(f"Photo {photo.id}: watermark_processor.add_watermark returned: {watermarked_path}")
+                        # Наносим водяной знак и конвертируем в WebP
+                        watermarked_path = watermark_processor.add_watermark(
+                            processed_path,
+                            text=f"hunter-photo.ru",
+                            output_path=custom_photo_path,
+                            image=photo_image.pixels()
+                        )
+                        logger.info(f"Photo {photo.id}: watermark_processor.add_watermark returned: {watermarked_path}")
                     
-                    # Если watermark не вернул путь, используем наш
-                    if not watermarked_path:
-                        logger.warning(f"Photo {photo.id}: watermark_processor returned None, using custom_photo_path")
-                        watermarked_path = custom_photo_path
-                        # Конвертируем в WebP если watermark не сделал этого
-                        if not watermarked_path.endswith('.webp'):
-                            logger.info(f"Photo {photo.id}: Converting to WebP: {watermarked_path}")
-                            # Используем глобальный image_processor, уже созданный выше
-                            watermarked_path = image_processor.convert_to_webp(watermarked_path)
-                            logger.info(f"Photo {photo.id}: convert_to_webp returned: {watermarked_path}")
-                else:
-                    logger.info(f"Photo {photo.id}: Watermark disabled, converting to WebP: {processed_path} -> {custom_photo_path}")
-                    # Проверяем, что исходный файл существует
-                    if not os.path.exists(processed_path):
-                        logger.error(f"Photo {photo.id}: processed_path does not exist: {processed_path}")
-                        raise FileNotFoundError(f"processed_path not found: {processed_path}")
+                        # Если watermark не вернул путь, используем наш
+                        if not watermarked_path:
+                            logger.warning(f"Photo {photo.id}: watermark_processor returned None, using custom_photo_path")
+                            watermarked_path = custom_photo_path
+                            # Конвертируем в WebP если watermark не сделал этого
+                            if not watermarked_path.endswith('.webp'):
+                                logger.info(f"Photo {photo.id}: Converting to WebP: {watermarked_path}")
+                                # Используем глобальный image_processor, уже созданный выше
+                                watermarked_path = image_processor.convert_to_webp(watermarked_path)
+                                logger.info(f"Photo {photo.id}: convert_to_webp returned: {watermarked_path}")
+                    else:
+                        logger.info(f"Photo {photo.id}: Watermark disabled, converting to WebP: {processed_path} -> {custom_photo_path}")
+                        # Проверяем, что исходный файл существует
+                        if not os.path.exists(processed_path):
+                            logger.error(f"Photo {photo.id}: processed_path does not exist: {processed_path}")
+                            raise FileNotFoundError(f"processed_path not found: {processed_path}")
                     
-                    # Без водяного знака, просто конвертируем в WebP
-                    # Используем глобальный image_processor, уже созданный выше
-                    watermarked_path = image_processor.convert_to_webp(processed_path, output_path=custom_photo_path)
-                    logger.info(f"Photo {photo.id}: convert_to_webp returned: {watermarked_path}")
+                        # Без водяного знака, просто конвертируем в WebP
+                        # Используем глобальный image_processor, уже созданный выше
+                        watermarked_path = image_processor.convert_to_webp(processed_path, output_path=custom_photo_path,
+                                                                           image=photo_image.pixels())
+                        logger.info(f"Photo {photo.id}: convert_to_webp returned: {watermarked_path}")
                     
-                    # Перемещаем в custom_photo если нужно
-                    if watermarked_path != custom_photo_path:
-                        logger.info(f"Photo {photo.id}: Moving {watermarked_path} to {custom_photo_path}")
-                        import shutil
-                        shutil.move(watermarked_path, custom_photo_path)
-                        watermarked_path = custom_photo_path
+                        # Перемещаем в custom_photo если нужно
+                        if watermarked_path != custom_photo_path:
+                            logger.info(f"Photo {photo.id}: Moving {watermarked_path} to {custom_photo_path}")
+                            import shutil
+                            shutil.move(watermarked_path, custom_photo_path)
+                            watermarked_path = custom_photo_path
                 
-                # Сохраняем относительный путь для custom_path
-                relative_custom_path = f"events/{event_id}/custom_photo/{custom_filename}"
+                    # Сохраняем относительный путь для custom_path
+                    relative_custom_path = f"events/{event_id}/custom_photo/{custom_filename}"
                 
-                # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Проверяем, что файл действительно создан
-                if not os.path.exists(custom_photo_path):
-                    logger.error(f"Photo {photo.id}: custom_photo file not created: {custom_photo_path}")
-                    raise FileNotFoundError(f"custom_photo file not found: {custom_photo_path}")
+                    # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Проверяем, что файл действительно создан
+                    if not os.path.exists(custom_photo_path):
+                        logger.error(f"Photo {photo.id}: custom_photo file not created: {custom_photo_path}")
+                        raise FileNotFoundError(f"custom_photo file not found: {custom_photo_path}")
                 
-                logger.info(f"Photo {photo.id}: custom_photo file created successfully: {custom_photo_path}, size: {os.path.getsize(custom_photo_path)} bytes")
+                    logger.info(f"Photo {photo.id}: custom_photo file created successfully: {custom_photo_path}, size: {os.path.getsize(custom_photo_path)} bytes")
                 
-                # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Перезагружаем объект из БД перед обновлением
-                db.expire(photo)  # Сбрасываем кэш объекта
-                photo = db.query(Photo).filter(Photo.id == photo.id).first()
-                if not photo:
-                    logger.error(f"Photo {photo.id}: Photo not found in DB after reload")
-                    raise ValueError(f"Photo {photo.id} not found in database")
-                
-                # Используем update() для гарантированного сохранения
-                try:
-                    from sqlalchemy import update
-                    update_stmt = update(Photo).where(Photo.id == photo.id).values(
-                        custom_path=relative_custom_path,
-                        custom_name=custom_filename
-                    )
-                    result = db.execute(update_stmt)
-                    db.commit()
-                    logger.info(f"Photo {photo.id}: Update statement executed, rows affected: {result.rowcount}")
-                    
-                    # Перезагружаем объект из БД для проверки
-                    db.expire(photo)
-                    photo = db.query(Photo).filter(Photo.id == photo.id).first()
-                    logger.info(f"Photo {photo.id}: After commit - custom_path={photo.custom_path}, custom_name={photo.custom_name}")
-                except Exception as commit_error:
-                    logger.error(f"Photo {photo.id}: Error committing custom_name to DB: {str(commit_error)}", exc_info=True)
-                    db.rollback()
-                    raise
+                    photo_writer.set(photo.id, custom_path=relative_custom_path, custom_name=custom_filename)
+                    logger.info(f"Photo {photo.id}: Queued custom_path={relative_custom_path} for DB")
+                    photo_writer.mark_step(photo.id, 'watermark', input_hash=watermark_input, path=relative_custom_path)
                 
                 # Обновляем event_info.json для watermark
                 if os.path.exists(event_info_path):
@@ -869,13 +1221,31 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                     )
                 update_counter += 1
                 
+                # Файлы фото готовы: загрузка на S3 идет параллельно с анализом лиц и номеров
+                if s3_pipeline is not None:
+                    custom_relative = photo_writer.get(photo.id, 'custom_path', photo.custom_path)
+                    for kind, full_path in (
+                        ('custom_photo', f"/var/www/html/storage/app/public/{custom_relative}" if custom_relative else None),
+                        ('original_photo', original_photo_path),
+                    ):
+                        if full_path and os.path.exists(full_path):
+                            s3_pipeline.submit(photo.id, kind, full_path)
+                
+                # Лица и номера читают файл после removeexif в процессах ML пула - пиксели больше не нужны
+                # (водяной знак нанесен на них на месте)
+                photo_image.close()
+                
                 # 4. Поиск лиц (если требуется)
                 face_search_enabled = analyses.get('face_search', False)
                 logger.info(f"Photo {photo.id}: face_search={face_search_enabled}")
                 
                 step_logger_face = StepLogger(str(event_id), str(photo.id), "face_search") if face_search_enabled else None
                 
-                if face_search_enabled:
+                if face_search_enabled and checkpoints and photo.has_faces is not None \
+                        and checkpoints.done(photo.id, 'facesearch'):
+                    logger.info(f"Photo {photo.id}: Faces already extracted from this file, skipping")
+                    replay_face_search_result(photo, event_info_path, face_index_writer)
+                elif face_search_enabled:
                     # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Используем original_photo_path для детекции лиц
                     # Это файл после нормализации EXIF, но до watermark (JPEG, не WebP)
                     face_detection_path = original_photo_path if 'original_photo_path' in locals() else processed_path
@@ -900,318 +1270,26 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                         step_logger_face.info(f"Original photo path: {original_photo_path if 'original_photo_path' in locals() else 'N/A'}")
                     logger.info(f"Photo {photo.id}: Starting face search")
                     logger.info(f"Photo {photo.id}: Face detection path: {face_detection_path}, exists: {os.path.exists(face_detection_path)}, size: {os.path.getsize(face_detection_path) if os.path.exists(face_detection_path) else 0} bytes")
-                    from tasks.face_search import extract_faces_with_bboxes
-                    import logging
-                    logger = logging.getLogger(__name__)
-                    
                     # Проверяем, что файл существует
                     if not os.path.exists(face_detection_path):
                         logger.error(f"Face search: File not found: {face_detection_path} for photo {photo.id}")
-                        # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Используем update() для гарантированного сохранения
-                        from sqlalchemy import update
-                        update_stmt = update(Photo).where(Photo.id == photo.id).values(
-                            has_faces=False,
-                            face_encodings=[],
-                            face_vec=None,
-                            face_bboxes=[]
-                        )
-                        db.execute(update_stmt)
-                        db.commit()
+                        photo_writer.set(photo.id, has_faces=False, face_encodings=[], face_vec=None, face_bboxes=[])
                         logger.info(f"Face search: Saved empty face data to DB for photo {photo.id} (file not found)")
+                        face_index_writer.add(photo.id, [])
                     else:
-                        try:
-                            logger.info(f"Face search: Starting extraction for photo {photo.id}, path: {face_detection_path}")
-                            logger.info(f"Face search: File info - exists: {os.path.exists(face_detection_path)}, size: {os.path.getsize(face_detection_path)} bytes, ext: {os.path.splitext(face_detection_path)[1]}")
-                            
-                            # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Добавляем таймаут для обработки лиц, чтобы избежать зависаний
-                            import time
-                            from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
-                            
-                            start_time = time.time()
-                            logger.info(f"Face search: Calling extract_faces_with_bboxes for photo {photo.id} with 60s timeout, path: {face_detection_path}...")
-                            
-                            # Используем ThreadPoolExecutor для таймаута
-                            faces_data = None
-                            timeout_seconds = 60  # Увеличиваем таймаут до 60 секунд
-                            
-                            try:
-                                def extract_faces():
-                                    task_logger.error(f"INSIGHTFACE - Запуск для фото {photo.id}")
-                                    logger.error(f"INSIGHTFACE - Запуск для фото {photo.id}")
-                                    task_logger.info(f"INSIGHTFACE - Путь к файлу: {face_detection_path}")
-                                    logger.info(f"INSIGHTFACE - Путь к файлу: {face_detection_path}")
-                                    result = extract_faces_with_bboxes(face_detection_path)
-                                    task_logger.error(f"INSIGHTFACE - Завершен для фото {photo.id}, найдено лиц: {len(result) if result else 0}")
-                                    logger.error(f"INSIGHTFACE - Завершен для фото {photo.id}, найдено лиц: {len(result) if result else 0}")
-                                    return result
-                                
-                                task_logger.error(f"INSIGHTFACE - Запуск анализа для фото {photo.id} через ThreadPoolExecutor")
-                                logger.error(f"INSIGHTFACE - Запуск анализа для фото {photo.id} через ThreadPoolExecutor")
-                                with ThreadPoolExecutor(max_workers=1) as executor:
-                                    future = executor.submit(extract_faces)
-                                    faces_data = future.result(timeout=timeout_seconds)
-                                task_logger.error(f"INSIGHTFACE - Анализ завершен для фото {photo.id}, результат получен")
-                                logger.error(f"INSIGHTFACE - Анализ завершен для фото {photo.id}, результат получен")
-                                    
-                            except FuturesTimeoutError:
-                                logger.error(f"Face search: Timeout after {timeout_seconds}s for photo {photo.id}")
-                                faces_data = []
-                            except Exception as timeout_error:
-                                logger.error(f"Face search: Error during extraction for photo {photo.id}: {str(timeout_error)}", exc_info=True)
-                                faces_data = []
-                            
-                            elapsed_time = time.time() - start_time
-                            logger.info(f"Face search: Extraction completed in {elapsed_time:.2f} seconds for photo {photo.id}")
-                            if elapsed_time > 30:
-                                logger.warning(f"Face search: Slow extraction for photo {photo.id} - took {elapsed_time:.2f} seconds")
-                            
-                            # Защита от None - extract_faces_with_bboxes может вернуть None в случае ошибки
-                            if faces_data is None:
-                                logger.warning(f"Face search: extract_faces_with_bboxes returned None for photo {photo.id}")
-                                faces_data = []
-                            
-                            # ВАЖНО: Логируем результат извлечения лиц для диагностики
-                            logger.info(f"Face search: extract_faces_with_bboxes returned {len(faces_data) if faces_data else 0} face(s) for photo {photo.id}")
-                            if faces_data:
-                                logger.info(f"Face search: faces_data type={type(faces_data)}, first face keys={list(faces_data[0].keys()) if faces_data and len(faces_data) > 0 and isinstance(faces_data[0], dict) else 'N/A'}")
-                            
-                            if faces_data and len(faces_data) > 0:
-                                if step_logger_face:
-                                    step_logger_face.info(f"Found {len(faces_data)} face(s) in photo")
-                                logger.info(f"Face search: Found {len(faces_data)} face(s) in photo {photo.id}")
-                                photo.has_faces = True
-                                
-                                # Преобразуем numpy массивы в списки Python для JSON
-                                face_vectors = []
-                                face_bboxes = []
-                                
-                                for face_idx, face_data in enumerate(faces_data):
-                                    # Защита от None или отсутствующих ключей
-                                    if not face_data or not isinstance(face_data, dict):
-                                        logger.warning(f"Face search: Invalid face_data at index {face_idx} for photo {photo.id}: {face_data}")
-                                        continue
-                                    
-                                    emb = face_data.get('embedding')
-                                    bbox = face_data.get('bbox')
-                                    
-                                    # Проверяем, что embedding и bbox не None
-                                    if emb is None:
-                                        logger.warning(f"Face search: embedding is None for face {face_idx + 1} in photo {photo.id}")
-                                        continue
-                                    
-                                    if bbox is None:
-                                        logger.warning(f"Face search: bbox is None for face {face_idx + 1} in photo {photo.id}")
-                                        continue
-                                    
-                                    # Логируем информацию о каждом найденном лице
-                                    import numpy as np
-                                    if isinstance(emb, np.ndarray):
-                                        logger.debug(f"Face search: Photo {photo.id}, face {face_idx + 1}: embedding dtype={emb.dtype}, shape={emb.shape}, bbox={bbox}")
-                                    else:
-                                        logger.debug(f"Face search: Photo {photo.id}, face {face_idx + 1}: embedding type={type(emb)}, bbox={bbox}")
-                                    
-                                    # Конвертируем embedding в список (для JSON сохранения)
-                                    try:
-                                        if hasattr(emb, 'tolist'):
-                                            face_vectors.append(emb.tolist())
-                                        elif isinstance(emb, (list, tuple)):
-                                            face_vectors.append(list(emb))
-                                        else:
-                                            if isinstance(emb, np.ndarray):
-                                                face_vectors.append(emb.tolist())
-                                            else:
-                                                face_vectors.append(list(emb))
-                                        
-                                        # Сохраняем bbox (уже список)
-                                        face_bboxes.append(bbox)
-                                    except Exception as emb_error:
-                                        logger.error(f"Face search: Error converting embedding for face {face_idx + 1} in photo {photo.id}: {str(emb_error)}")
-                                        continue
-                                
-                                # Сохраняем embeddings и bbox в БД
-                                # face_encodings - список всех найденных лиц (embeddings)
-                                # face_bboxes - список координат bounding boxes [[x1, y1, x2, y2], ...]
-                                # face_vec - первое лицо как основной вектор (для совместимости)
-                                
-                                # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Убеждаемся, что данные сериализуемы
-                                # Конвертируем numpy arrays в списки Python
-                                face_vectors_serializable = []
-                                for vec in face_vectors:
-                                    if hasattr(vec, 'tolist'):
-                                        face_vectors_serializable.append(vec.tolist())
-                                    else:
-                                        face_vectors_serializable.append(list(vec))
-                                
-                                face_bboxes_serializable = []
-                                for bbox in face_bboxes:
-                                    if isinstance(bbox, list):
-                                        face_bboxes_serializable.append(bbox)
-                                    else:
-                                        face_bboxes_serializable.append(list(bbox))
-                                
-                                photo.face_encodings = face_vectors_serializable
-                                photo.face_bboxes = face_bboxes_serializable
-                                photo.face_vec = face_vectors_serializable[0] if face_vectors_serializable else None
-                                photo.has_faces = True  # Явно устанавливаем флаг
-                                
-                                logger.info(f"Face search: Before commit - photo.has_faces={photo.has_faces}, face_encodings count={len(face_vectors_serializable)}, face_bboxes count={len(face_bboxes_serializable)}")
-                                logger.debug(f"Face search: Sample face_bboxes[0]={face_bboxes_serializable[0] if face_bboxes_serializable else 'N/A'}")
-                                
-                                # ВАЖНО: Явно сохраняем изменения в БД
-                                # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Используем update() для гарантированного сохранения
-                                try:
-                                    from sqlalchemy import update
-                                    import json as json_module
-                                    
-                                    # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Перезагружаем объект из БД перед обновлением
-                                    db.expire(photo)
-                                    photo = db.query(Photo).filter(Photo.id == photo.id).first()
-                                    if not photo:
-                                        logger.error(f"Face search: Photo {photo.id} not found in DB after reload")
-                                        raise ValueError(f"Photo {photo.id} not found in database")
-                                    
-                                    # Обновляем через SQL для гарантии сохранения
-                                    # ВАЖНО: SQLAlchemy автоматически сериализует JSON поля, передаем списки напрямую
-                                    update_stmt = update(Photo).where(Photo.id == photo.id).values(
-                                        face_encodings=face_vectors_serializable if face_vectors_serializable else None,
-                                        face_bboxes=face_bboxes_serializable if face_bboxes_serializable else None,
-                                        face_vec=face_vectors_serializable[0] if face_vectors_serializable else None,
-                                        has_faces=True
-                                    )
-                                    result = db.execute(update_stmt)
-                                    db.commit()
-                                    logger.info(f"Face search: Update statement executed, rows affected: {result.rowcount}")
-                                    
-                                    # Перезагружаем объект из БД для проверки
-                                    db.expire(photo)
-                                    photo = db.query(Photo).filter(Photo.id == photo.id).first()
-                                    logger.info(f"Face search: After commit - photo.has_faces={photo.has_faces}, face_encodings count={len(photo.face_encodings) if photo.face_encodings else 0}, face_bboxes count={len(photo.face_bboxes) if photo.face_bboxes else 0}")
-                                    if photo.face_bboxes:
-                                        logger.debug(f"Face search: After commit - face_bboxes[0]={photo.face_bboxes[0] if photo.face_bboxes else 'N/A'}")
-                                except Exception as commit_error:
-                                    logger.error(f"Face search: Error committing to DB: {str(commit_error)}", exc_info=True)
-                                    db.rollback()
-                                    raise
-                                
-                                logger.info(f"Face search: Saved {len(face_vectors)} embeddings and {len(face_bboxes)} bboxes to DB for photo {photo.id}")
-                                logger.debug(f"Face search: Photo {photo.id} - First embedding length: {len(face_vectors[0]) if face_vectors else 0}, First bbox: {face_bboxes[0] if face_bboxes else 'N/A'}")
-                                
-                                # Обновляем event_info.json для face_search
-                                if os.path.exists(event_info_path):
-                                    photo_name = getattr(photo, 'original_name', None) or f"photo_{photo.id}"
-                                    update_event_info_json(
-                                        event_info_path,
-                                        str(photo.id),
-                                        photo_name,
-                                        'facesearch',
-                                        {
-                                            'face_encodings': face_vectors,  # Список всех найденных лиц
-                                            'face_vector': face_vectors[0] if face_vectors else []  # Первое лицо как основной вектор
-                                        },
-                                        'ready'
-                                    )
-                                update_counter += 1
-                            else:
-                                # ВАЖНО: Логируем детали, почему лица не найдены
-                                logger.warning(f"Face search: No faces found in photo {photo.id}")
-                                logger.warning(f"Face search: processed_path={processed_path}, file_exists={os.path.exists(processed_path) if processed_path else False}")
-                                
-                                # Проверяем, что файл существует и доступен
-                                if face_detection_path and os.path.exists(face_detection_path):
-                                    file_size = os.path.getsize(face_detection_path)
-                                    logger.warning(f"Face search: File exists but no faces found, path={face_detection_path}, size={file_size} bytes")
-                                    logger.warning(f"Face search: File extension: {os.path.splitext(face_detection_path)[1]}")
-                                
-                                # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Используем update() для гарантированного сохранения
-                                from sqlalchemy import update
-                                update_stmt = update(Photo).where(Photo.id == photo.id).values(
-                                    has_faces=False,
-                                    face_encodings=[],
-                                    face_vec=None,
-                                    face_bboxes=[]
-                                )
-                                db.execute(update_stmt)
-                                db.commit()
-                                logger.info(f"Face search: Saved has_faces=False to DB for photo {photo.id}")
-                                
-                                # ВАЖНО: Обновляем event_info.json даже если лиц не найдено
-                                if os.path.exists(event_info_path):
-                                    photo_name = getattr(photo, 'original_name', None) or f"photo_{photo.id}"
-                                    update_event_info_json(
-                                        event_info_path,
-                                        str(photo.id),
-                                        photo_name,
-                                        'facesearch',
-                                        {
-                                            'face_encodings': [],
-                                            'face_vector': [],
-                                            'faces_found': 0
-                                        },
-                                        'ready'
-                                    )
-                                    logger.info(f"Photo {photo.id}: Updated event_info.json for face_search (no faces found)")
-                        except Exception as e:
-                            logger.error(f"Face search error for photo {photo.id}: {str(e)}", exc_info=True)
-                            # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Используем update() для гарантированного сохранения
-                            from sqlalchemy import update
-                            update_stmt = update(Photo).where(Photo.id == photo.id).values(
-                                has_faces=False,
-                                face_encodings=[],
-                                face_vec=None,
-                                face_bboxes=[]
-                            )
-                            db.execute(update_stmt)
-                            db.commit()
-                            logger.info(f"Face search: Saved empty face data to DB for photo {photo.id} (error occurred)")
-                            
-                            # Обновляем event_info.json с ошибкой
-                            if os.path.exists(event_info_path):
-                                photo_name = getattr(photo, 'original_name', None) or f"photo_{photo.id}"
-                                update_event_info_json(
-                                    event_info_path,
-                                    str(photo.id),
-                                    photo_name,
-                                    'facesearch',
-                                    {
-                                        'face_encodings': [],
-                                        'face_vector': [],
-                                        'error': str(e)
-                                    },
-                                    'error'
-                                )
-                                logger.error(f"Photo {photo.id}: Updated event_info.json for face_search with error")
-                        
-                        # ВАЖНО: Обновляем event_info.json ВСЕГДА, даже если была ошибка выше
-                        # Это гарантирует, что задача будет отмечена как выполненная
-                        if os.path.exists(event_info_path):
-                            photo_name = getattr(photo, 'original_name', None) or f"photo_{photo.id}"
-                            # Проверяем, не обновили ли мы уже выше
-                            try:
-                                with open(event_info_path, 'r', encoding='utf-8') as f:
-                                    event_info_check = json.load(f)
-                                section_key = 'analyze_facesearch'
-                                if section_key in event_info_check:
-                                    existing = any(item.get('photoId') == str(photo.id) for item in event_info_check[section_key])
-                                    if not existing:
-                                        # Если записи нет, создаем её
-                                        update_event_info_json(
-                                            event_info_path,
-                                            str(photo.id),
-                                            photo_name,
-                                            'facesearch',
-                                            {
-                                                'face_encodings': [],
-                                                'face_vector': [],
-                                                'faces_found': 0
-                                },
-                                'ready'
-                            )
-                                        logger.info(f"Photo {photo.id}: Created missing event_info.json entry for face_search")
-                            except Exception as check_error:
-                                logger.warning(f"Photo {photo.id}: Could not check event_info.json: {str(check_error)}")
-                        
+                        # Лица считаются батчами (FACE_BATCH_SIZE фото за один прогон моделей):
+                        # фото откладывается, результат сохраняет flush_face_batch
+                        pending_faces.append({
+                            'photo_id': photo.id,
+                            'photo_name': getattr(photo, 'original_name', None) or f"photo_{photo.id}",
+                            'path': face_detection_path,
+                            'step_logger': step_logger_face
+                        })
+                        if len(pending_faces) >= settings.FACE_BATCH_SIZE:
+                            flush_face_batch(db, pending_faces, event_info_path, face_index_writer, photo_writer)
+                            flush_number_batch(db, pending_numbers, event_info_path, number_index_writer, photo_writer)
                         update_counter += 1
-                        logger.info(f"Photo {photo.id}: Face search processing completed")
+                        logger.info(f"Photo {photo.id}: Queued for batched face search ({len(pending_faces)} pending)")
                 
                 # 5. Поиск номеров (если требуется)
                 number_search_enabled = analyses.get('number_search', False)
@@ -1219,100 +1297,28 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                 
                 step_logger_number = StepLogger(str(event_id), str(photo.id), "number_search") if number_search_enabled else None
                 
-                if number_search_enabled:
-                    if step_logger_number:
-                        step_logger_number.info(f"Starting number search for photo {photo.id}")
-                        step_logger_number.info(f"Processed path: {processed_path}")
-                    logger.info(f"Photo {photo.id}: Starting number search, processed_path={processed_path}")
-                    try:
-                        # ВАЖНО: Добавляем таймаут для обработки номеров, чтобы избежать зависаний
-                        import time
-                        
-                        start_time = time.time()
-                        logger.info(f"Photo {photo.id}: Calling extract_numbers, this may take up to 60 seconds...")
-                        
-                        from tasks.number_search import extract_numbers
-                        numbers = extract_numbers(processed_path)
-                        
-                        elapsed_time = time.time() - start_time
-                        logger.info(f"Photo {photo.id}: Number extraction completed in {elapsed_time:.2f} seconds")
-                        
-                        # ВАЖНО: Если обработка заняла слишком много времени, логируем предупреждение
-                        if elapsed_time > 30:
-                            logger.warning(f"Photo {photo.id}: Number extraction took {elapsed_time:.2f} seconds (slow)")
-                        
-                        # ВАЖНО: Если обработка заняла больше 60 секунд, это критично
-                        if elapsed_time > 60:
-                            logger.error(f"Photo {photo.id}: Number extraction took {elapsed_time:.2f} seconds (CRITICAL - very slow)")
-                        
-                        if step_logger_number:
-                            step_logger_number.info(f"Number search completed, found {len(numbers) if numbers else 0} numbers")
-                            if numbers:
-                                step_logger_number.info(f"Numbers found: {numbers}")
-                            else:
-                                step_logger_number.info("No numbers found")
-                        logger.info(f"Photo {photo.id}: Number search completed, found {len(numbers) if numbers else 0} numbers")
-                        if numbers:
-                            logger.debug(f"Photo {photo.id}: Numbers found: {numbers}")
-                        else:
-                            logger.debug(f"Photo {photo.id}: No numbers found")
-                        
-                        # Сохраняем номера в базу (даже если пустой список)
-                        photo.numbers = numbers if numbers else []
-                        
-                        logger.info(f"Number search: Before commit - photo.numbers={photo.numbers}, count={len(numbers) if numbers else 0}")
-                        
-                        # ВАЖНО: Явно сохраняем изменения в БД
-                        try:
-                            db.add(photo)  # Явно добавляем объект в сессию
-                            db.commit()  # ВАЖНО: Коммитим сразу после сохранения номеров
-                            db.refresh(photo)  # Обновляем объект из БД
-                            logger.info(f"Number search: After commit - photo.numbers={photo.numbers}, count={len(photo.numbers) if photo.numbers else 0}")
-                        except Exception as commit_error:
-                            logger.error(f"Number search: Error committing to DB: {str(commit_error)}", exc_info=True)
-                            db.rollback()
-                            raise
-                        
-                        logger.info(f"Number search: Saved {len(numbers) if numbers else 0} numbers to DB for photo {photo.id}")
-                        
-                        # Обновляем event_info.json для number_search (всегда, даже если номеров нет)
-                        if os.path.exists(event_info_path):
-                            photo_name = getattr(photo, 'original_name', None) or f"photo_{photo.id}"
-                            # Если номеров нет, передаем пустой список (будет сохранен как null в JSON)
-                            update_event_info_json(
-                                event_info_path,
-                                str(photo.id),
-                                photo_name,
-                                'numbersearch',
-                                {'numbers': numbers if numbers else []},
-                                'ready'
-                            )
-                            logger.info(f"Photo {photo.id}: Updated event_info.json for number_search")
-                        update_counter += 1
-                    except Exception as e:
-                        if step_logger_number:
-                            step_logger_number.error(f"Error in number search: {str(e)}", exc_info=True)
-                        logger.error(f"Photo {photo.id}: Error in number search: {str(e)}", exc_info=True)
-                        # Сохраняем пустой список номеров в случае ошибки
-                        photo.numbers = []
-                        db.commit()  # ВАЖНО: Коммитим даже при ошибке, чтобы сохранить пустой список
-                        logger.info(f"Number search: Saved empty numbers list to DB for photo {photo.id} (error occurred)")
-                        
-                        # Обновляем event_info.json с ошибкой
-                        if os.path.exists(event_info_path):
-                            photo_name = getattr(photo, 'original_name', None) or f"photo_{photo.id}"
-                            update_event_info_json(
-                                event_info_path,
-                                str(photo.id),
-                                photo_name,
-                                'numbersearch',
-                                {'numbers': [], 'error': str(e)},
-                                'error'
-                            )
-                            logger.error(f"Photo {photo.id}: Updated event_info.json for number_search with error")
+                if number_search_enabled and checkpoints and photo.numbers is not None \
+                        and checkpoints.done(photo.id, 'numbersearch'):
+                    logger.info(f"Photo {photo.id}: Numbers already recognized on this file, skipping")
+                    replay_number_search_result(photo, event_info_path, number_index_writer)
+                    update_counter += 1
+                elif number_search_enabled:
+                    # Номер ищется под лицами, поэтому фото из незавершенного батча лиц
+                    # ждет flush_face_batch; остальные используют уже сохраненные bbox
+                    if any(item['photo_id'] == photo.id for item in pending_faces):
+                        pending_numbers.append({
+                            'photo_id': photo.id,
+                            'path': processed_path,
+                            'step_logger': step_logger_number
+                        })
+                        logger.info(f"Photo {photo.id}: Number search deferred until its face batch is processed")
+                    else:
+                        run_number_search(db, photo, processed_path, event_info_path,
+                                          photo_writer.get(photo.id, 'face_bboxes', photo.face_bboxes),
+                                          step_logger_number, number_index_writer, photo_writer)
                     update_counter += 1
                 
-                db.commit()
+                photo_writer.maybe_flush()
                 
                 # Проверяем общее время обработки фотографии
                 if photo_start_time:
@@ -1330,36 +1336,21 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                 logger.info(f"Progress update: {idx}/{total} ({progress_percent}%) - Successfully processed: {successfully_processed}")
                 task_logger.log_progress(idx, total, successfully_processed=successfully_processed)
                 try:
-                    self.on_progress(idx, total)
+                    report_event_progress(parent_task_id, total)
                 except Exception as progress_error:
                     logger.error(f"Failed to update progress: {str(progress_error)}")
                     task_logger.error("Ошибка обновления прогресса", exc_info=True, error=str(progress_error))
                 
-                # ВАЖНО: Периодически обновляем event_info.json для отслеживания прогресса
-                # Это помогает видеть прогресс даже если задача зависнет
+                # Периодически логируем прогресс по секциям из сводки Redis (utils.event_progress):
+                # event_info.json не перечитываем - он растет вместе с событием
                 if idx % 10 == 0 or idx == total:
                     try:
-                        if os.path.exists(event_info_path):
-                            # Обновляем общий прогресс в event_info.json
-                            with open(event_info_path, 'r', encoding='utf-8') as f:
-                                event_info = json.load(f)
-                            
-                            # Обновляем прогресс для каждого типа анализа
-                            for analysis_type in ['analyze_removeexif', 'analyze_watermark', 'analyze_facesearch', 'analyze_numbersearch']:
-                                if analysis_type in event_info:
-                                    section_data = event_info[analysis_type]
-                                    ready_count = sum(1 for item in section_data if item.get('status') == 'ready')
-                                    total_count = len(section_data)
-                                    progress_pct = int((ready_count / total_count * 100)) if total_count > 0 else 0
-                                    logger.debug(f"Progress for {analysis_type}: {ready_count}/{total_count} ({progress_pct}%)")
-                            
-                            # Сохраняем обновленный event_info.json
-                            temp_path = event_info_path + '.tmp'
-                            with open(temp_path, 'w', encoding='utf-8') as f:
-                                json.dump(event_info, f, indent=4, ensure_ascii=False)
-                            os.replace(temp_path, event_info_path)
+                        from utils.event_progress import get_event_progress
+                        event_progress = get_event_progress(event_id)
+                        for section, counts in ((event_progress or {}).get('sections') or {}).items():
+                            logger.debug(f"Progress for {section}: {counts['ready']}/{event_progress['total']} ({counts['progress']}%)")
                     except Exception as checkpoint_error:
-                        logger.warning(f"Failed to create checkpoint: {str(checkpoint_error)}")
+                        logger.warning(f"Failed to read event progress: {str(checkpoint_error)}")
                 
                 # Обновляем event_info.json каждые 5 фотографий (если счетчик достиг интервала)
                 if update_counter >= update_interval and os.path.exists(event_info_path):
@@ -1403,7 +1394,7 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                 try:
                     progress_percent = int((idx / total) * 100)
                     logger.warning(f"Progress update after error: {idx}/{total} ({progress_percent}%) - Failed photos: {len(failed_photos)}")
-                    self.on_progress(idx, total)
+                    report_event_progress(parent_task_id, total)
                 except Exception as progress_error:
                     logger.error(f"Failed to update progress after error: {str(progress_error)}")
                 
@@ -1417,9 +1408,148 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                 # ВАЖНО: Продолжаем обработку следующих фотографий, не останавливаем весь процесс
                 logger.info(f"Continuing to next photo after error in photo {photo.id}. Total failed so far: {len(failed_photos)}")
                 continue
+            finally:
+                # Декодированный кадр (десятки МБ) не держим дольше обработки фото
+                if photo_image is not None:
+                    photo_image.close()
+        
+        # Досчитываем последний неполный батч лиц (и ждавшие его номера) и сбрасываем буферы
+        flush_face_batch(db, pending_faces, event_info_path, face_index_writer, photo_writer)
+        flush_number_batch(db, pending_numbers, event_info_path, number_index_writer, photo_writer)
+        photo_writer.flush()
+        if face_index_writer:
+            face_index_writer.flush()
+        if number_index_writer:
+            number_index_writer.flush()
+        
+        # Дожидаемся загрузок на S3, начатых во время анализа
+        s3_urls = s3_pipeline.results() if s3_pipeline is not None else {}
+        
+        logger.info(f"Chunk at offset {chunk_offset} completed: {successfully_processed} processed, {len(failed_photos)} failed")
+        return {
+            "status": "completed",
+            "chunk_offset": chunk_offset,
+            "photos": len(photo_ids),
+            "successfully_processed": successfully_processed,
+            "failed_photos": failed_photos,
+            "s3_urls": s3_urls,
+        }
+    
+    except SoftTimeLimitExceeded as e:
+        logger.warning(f"SOFT TIMEOUT in process_photo_chunk for event {event_id} (offset {chunk_offset}): {str(e)}")
+        task_logger.warning("Мягкий таймаут при обработке части события", exc_info=True, event_id=event_id, error=str(e))
+        # Уже выполненные шаги сохраняем, чтобы их записи в event_info.json совпадали с БД
+        if photo_writer is not None:
+            photo_writer.flush()
+        # Незавершенные загрузки не ждем - их догрузит finalize_event_processing
+        s3_urls = s3_pipeline.results(wait=False) if s3_pipeline is not None else {}
+        # Возвращаем то, что успели: finalize_event_processing завершит событие с остальными частями
+        return {
+            "status": "soft_timeout",
+            "chunk_offset": chunk_offset,
+            "photos": len(photo_ids),
+            "successfully_processed": successfully_processed,
+            "failed_photos": failed_photos,
+            "s3_urls": s3_urls,
+        }
+    
+    except Exception as e:
+        logger.error(f"ERROR in process_photo_chunk for event {event_id} (offset {chunk_offset}): {str(e)}", exc_info=True)
+        task_logger.critical("Ошибка при обработке части события", exc_info=True, event_id=event_id, error=str(e))
+        if photo_writer is not None:
+            try:
+                db.rollback()
+                photo_writer.flush()
+            except Exception as flush_error:
+                logger.error(f"Failed to flush photo writes for event {event_id}: {str(flush_error)}")
+        s3_urls = s3_pipeline.results(wait=False) if s3_pipeline is not None else {}
+        # Не пробрасываем исключение: упавшая часть не должна отменять finalize всего события
+        return {
+            "status": "error",
+            "chunk_offset": chunk_offset,
+            "photos": len(photo_ids),
+            "error": str(e),
+            "error_type": type(e).__name__,
+            "successfully_processed": successfully_processed,
+            "failed_photos": failed_photos,
+            "s3_urls": s3_urls,
+        }
+    finally:
+        db.close()
+        try:
+            task_logger.log_task_end(success=True)
+            task_logger.close()
+        except Exception as close_error:
+            logger.warning(f"Error closing task logger: {str(close_error)}")
+
+
+@celery_app.task(bind=True, base=CallbackTask)
+def finalize_event_processing(self, chunk_results: List[Dict], event_id: str, analyses: Dict[str, bool], photo_ids: List[str]):
+    """
+    Завершение обработки события - callback chord'а process_event_photos
+    
+    Сохраняет бинарные embeddings, загружает фотографии на S3 и проверяет event_info.json.
+    Выполняется под task_id исходной process_event_photos, поэтому его результат
+    Laravel получает как результат обработки события.
+    """
+    from app.database import SessionLocal
+    from app.models import Photo
+    from utils.task_logger import get_task_logger
+    
+    import logging
+    logger = logging.getLogger(__name__)
+    
+    task_logger = get_task_logger("finalize_event_processing", self.request.id)
+    task_logger.log_task_start(event_id=event_id, chunks=len(chunk_results or []))
+    
+    db = SessionLocal()
+    
+    # Собираем итоги частей
+    chunk_results = [result for result in (chunk_results or []) if isinstance(result, dict)]
+    successfully_processed = sum(result.get('successfully_processed', 0) for result in chunk_results)
+    failed_photos = [photo for result in chunk_results for photo in result.get('failed_photos', [])]
+    total = len(photo_ids)
+    # Файлы, загруженные на S3 частями во время анализа
+    pipelined_urls = {}
+    for result in chunk_results:
+        for photo_id, urls in (result.get('s3_urls') or {}).items():
+            pipelined_urls.setdefault(str(photo_id), {}).update(urls)
+    
+    try:
+        event_info_path = f"/var/www/html/storage/app/public/events/{event_id}/event_info.json"
+        event_dir = f"/var/www/html/storage/app/public/events/{event_id}"
         
-        # После завершения всех анализов загружаем фотографии на S3
-        # ВАЖНО: Загрузка на S3 происходит ТОЛЬКО после завершения всех анализов всех фотографий
+        for result in chunk_results:
+            if result.get('status') != 'completed':
+                logger.warning(f"Chunk at offset {result.get('chunk_offset')} finished with status {result.get('status')}: {result.get('error', '')}")
+        
+        photo_list = db.query(Photo).filter(Photo.id.in_(photo_ids)).all() if photo_ids else []
+        
+        # Все части завершены: сворачиваем журнал шагов; дальше event_info.json меняется
+        # только через update_event_info - под блокировкой снимка
+        from utils.event_info_store import compact_event_info, read_event_info, update_event_info
+        try:
+            compact_event_info(event_info_path)
+        except Exception as compact_error:
+            logger.error(f"Failed to compact event_info.json log for event {event_id}: {str(compact_error)}", exc_info=True)
+        
+        # Сохраняем бинарные embeddings события и сливаем дельты ANN индекса, записанные частями
+        if analyses.get('face_search', False):
+            try:
+                from utils.embedding_store import write_event_embedding_sidecar
+                write_event_embedding_sidecar(db, event_id)
+            except Exception as sidecar_error:
+                logger.error(f"Failed to write embedding sidecar for event {event_id}: {str(sidecar_error)}", exc_info=True)
+
+            if settings.FACE_ANN_ENABLED:
+                try:
+                    from utils.face_index import compact_segment
+                    compact_segment(event_id)
+                except Exception as index_error:
+                    logger.error(f"Failed to compact face index segment for event {event_id}: {str(index_error)}", exc_info=True)
+        
+        # После завершения всех анализов загружаем на S3 фотографии, которые части не успели загрузить
+        # (S3_PIPELINED_UPLOAD); удаление локальных файлов - только после проверки всех объектов
         print(f"All photos processed ({total} total). Starting S3 upload for event {event_id}...")
         print(f"Event directory: {event_dir}")
         
@@ -1433,8 +1563,7 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                 # Читаем event_info.json для получения данных о фотографиях
                 if os.path.exists(event_info_path):
                     print(f"Reading event_info.json from: {event_info_path}")
-                    with open(event_info_path, 'r', encoding='utf-8') as f:
-                        event_info = json.load(f)
+                    event_info = read_event_info(event_info_path)
                     
                     # Получаем данные о фотографиях
                     photos_data = event_info.get('photo', {})
@@ -1495,41 +1624,39 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                         logger.info(f"All required analyses are complete for event {event_id}. Proceeding with S3 upload.")
                         print("All required analyses are complete, proceeding with S3 upload")
                     
-                    # Загружаем на S3 (передаем db сессию для получения актуальных путей)
-                    logger.info(f"Starting S3 upload for event {event_id}...")
+                    # Загружаем на S3 (передаем db сессию для получения актуальных путей);
+                    # файлы, загруженные частями во время анализа, повторно не загружаются
+                    logger.info(f"Starting S3 upload for event {event_id} ({len(pipelined_urls)} photos already uploaded during analysis)...")
                     print("Starting S3 upload for all photos...")
-                    s3_urls = s3_uploader.upload_event_photos(event_id, photos_data, db)
+                    uploaded_files = []
+                    s3_urls = s3_uploader.upload_event_photos(event_id, photos_data, db,
+                                                              uploaded=pipelined_urls, verified=uploaded_files)
                     print(f"S3 upload completed. Uploaded {len(s3_urls)} photos.")
                     
                     # Обновляем event_info.json с S3 URL
                     if s3_urls:
                         # Добавляем секцию s3_data в event_info.json
-                        if 's3_data' not in event_info:
-                            event_info['s3_data'] = {}
-                        
-                        for photo_id, urls in s3_urls.items():
-                            event_info['s3_data'][photo_id] = {
-                                'custom_url': urls.get('custom_url'),
-                                'original_url': urls.get('original_url')
-                            }
+                        def add_s3_data(event_info):
+                            s3_data = event_info.setdefault('s3_data', {})
+                            for photo_id, urls in s3_urls.items():
+                                s3_data[photo_id] = {
+                                    'custom_url': urls.get('custom_url'),
+                                    'original_url': urls.get('original_url')
+                                }
                         
                         # Сохраняем обновленный event_info.json
-                        temp_path = event_info_path + '.tmp'
-                        with open(temp_path, 'w', encoding='utf-8') as f:
-                            json.dump(event_info, f, indent=4, ensure_ascii=False)
-                            f.flush()
-                            os.fsync(f.fileno())
-                        os.replace(temp_path, event_info_path)
+                        event_info = update_event_info(event_info_path, add_s3_data)
                         
                         print(f"S3 URLs added to event_info.json for {len(s3_urls)} photos")
                         
                         # Обновляем базу данных с S3 URL
                         print(f"Updating database with S3 URLs for {len(s3_urls)} photos...")
-                        updated_count = 0
-                        from sqlalchemy import update
+                        # Одна пакетная запись (executemany UPDATE) и один commit на все фото
+                        from utils.photo_writer import PhotoWriteBuffer
+                        url_writer = PhotoWriteBuffer(db, flush_every=len(s3_urls))
+                        known_ids = {str(photo.id) for photo in photo_list}
                         for photo_id, urls in s3_urls.items():
-                            photo = db.query(Photo).filter(Photo.id == photo_id).first()
-                            if photo:
+                            if str(photo_id) in known_ids:
                                 update_values = {}
                                 if urls.get('custom_url'):
                                     update_values['s3_custom_url'] = urls['custom_url']
@@ -1537,16 +1664,12 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                                     update_values['s3_original_url'] = urls['original_url']
                                 
                                 if update_values:
-                                    # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Используем update() для гарантированного сохранения
-                                    update_stmt = update(Photo).where(Photo.id == photo_id).values(**update_values)
-                                    db.execute(update_stmt)
-                                    db.commit()
-                                    updated_count += 1
-                                    print(f"Updated photo {photo_id} with S3 URLs (custom: {bool(urls.get('custom_url'))}, original: {bool(urls.get('original_url'))})")
+                                    url_writer.set(photo_id, **update_values)
                                 else:
                                     print(f"Warning: Photo {photo_id} has no S3 URLs to update")
                             else:
                                 print(f"Warning: Photo {photo_id} not found in database")
+                        updated_count = url_writer.flush()
                         
                         print(f"Database updated: {updated_count} photos updated with S3 URLs out of {len(s3_urls)} uploaded.")
                         
@@ -1558,7 +1681,14 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
                                 all_uploaded = False
                                 break
                         
+                        # Локальные файлы удаляются, только если каждый объект есть на S3 с тем же размером
+                        unverified_keys = []
                         if all_uploaded and len(s3_urls) == len(photos_data):
+                            unverified_keys = s3_uploader.verify_many(uploaded_files)
+                            if unverified_keys:
+                                logger.error(f"{len(unverified_keys)} S3 objects failed verification for event {event_id}, keeping local files: {unverified_keys[:10]}")
+                        
+                        if all_uploaded and len(s3_urls) == len(photos_data) and not unverified_keys:
                             print(f"All photos uploaded to S3. Cleaning up local files for event {event_id}...")
                             try:
                                 # Удаляем папки upload, original_photo, custom_photo
@@ -1598,62 +1728,59 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
         if os.path.exists(event_info_path):
             try:
                 logger.info(f"Performing final event_info.json validation for event {event_id}")
-                # Читаем текущий event_info.json
-                with open(event_info_path, 'r', encoding='utf-8') as f:
-                    event_info_final = json.load(f)
-                
-                # Проверяем, что все фотографии обработаны для каждого типа анализа
+                # Проверка и запись идут под блокировкой снимка, поверх еще не свернутого журнала
                 missing_entries = []
-                for photo in photo_list:
-                    photo_id = str(photo.id)
-                    photo_name = getattr(photo, 'original_name', None) or f"photo_{photo.id}"
+                
+                def complete_sections(event_info_final):
+                    # Проверяем, что все фотографии обработаны для каждого типа анализа
+                    missing_entries.clear()
+                    for photo in photo_list:
+                        photo_id = str(photo.id)
+                        photo_name = getattr(photo, 'original_name', None) or f"photo_{photo.id}"
                     
-                    # Проверяем каждую секцию анализа в зависимости от включенных анализов
-                    analysis_sections = []
-                    # ВАЖНО: Timeline временно отключен
-                    # if analyses.get('timeline', False):
-                    #     analysis_sections.append(('timeline', 'analyze_timeline'))
-                    if analyses.get('remove_exif', True):
-                        analysis_sections.append(('removeexif', 'analyze_removeexif'))
-                    if analyses.get('watermark', True):
-                        analysis_sections.append(('watermark', 'analyze_watermark'))
-                    if analyses.get('face_search', False):
-                        analysis_sections.append(('facesearch', 'analyze_facesearch'))
-                    if analyses.get('number_search', False):
-                        analysis_sections.append(('numbersearch', 'analyze_numbersearch'))
+                        # Проверяем каждую секцию анализа в зависимости от включенных анализов
+                        analysis_sections = []
+                        # ВАЖНО: Timeline временно отключен
+                        # if analyses.get('timeline', False):
+                        #     analysis_sections.append(('timeline', 'analyze_timeline'))
+                        if analyses.get('remove_exif', True):
+                            analysis_sections.append(('removeexif', 'analyze_removeexif'))
+                        if analyses.get('watermark', True):
+                            analysis_sections.append(('watermark', 'analyze_watermark'))
+                        if analyses.get('face_search', False):
+                            analysis_sections.append(('facesearch', 'analyze_facesearch'))
+                        if analyses.get('number_search', False):
+                            analysis_sections.append(('numbersearch', 'analyze_numbersearch'))
                     
-                    for analysis_type, section_key in analysis_sections:
-                        if section_key not in event_info_final:
-                            event_info_final[section_key] = []
+                        for analysis_type, section_key in analysis_sections:
+                            if section_key not in event_info_final:
+                                event_info_final[section_key] = []
                         
-                        # Проверяем, есть ли запись для этой фотографии
-                        existing = any(item.get('photoId') == photo_id for item in event_info_final[section_key])
-                        if not existing:
-                            logger.warning(f"Missing entry in {section_key} for photo {photo_id}, creating it")
-                            missing_entries.append((section_key, photo_id, photo_name))
-                            event_info_final[section_key].append({
-                                'photoId': photo_id,
-                                'photoName': photo_name,
-                                'status': 'ready',
-                                'updated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                            })
-                
-                # ВАЖНО: Обновляем photo_count в event_info.json на основе реального количества фотографий
-                event_info_final['photo_count'] = len(photo_list)
-                logger.info(f"Updated photo_count in event_info.json: {len(photo_list)}")
+                            # Проверяем, есть ли запись для этой фотографии
+                            existing = any(item.get('photoId') == photo_id for item in event_info_final[section_key])
+                            if not existing:
+                                logger.warning(f"Missing entry in {section_key} for photo {photo_id}, creating it")
+                                missing_entries.append((section_key, photo_id, photo_name))
+                                event_info_final[section_key].append({
+                                    'photoId': photo_id,
+                                    'photoName': photo_name,
+                                    'status': 'ready',
+                                    'updated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                                })
                 
-                # Сохраняем обновленный event_info.json если были добавлены записи или обновлен photo_count
-                if missing_entries or 'photo_count' not in event_info_final or event_info_final.get('photo_count') != len(photo_list):
+                    # ВАЖНО: Обновляем photo_count в event_info.json на основе реального количества фотографий
+                    count_changed = event_info_final.get('photo_count') != len(photo_list)
+                    event_info_final['photo_count'] = len(photo_list)
+                    
+                    # Сохраняем обновленный event_info.json если были добавлены записи или обновлен photo_count
+                    if not missing_entries and not count_changed:
+                        logger.info("All entries present in event_info.json, no update needed")
+                        return False
                     logger.info(f"Updating event_info.json: {len(missing_entries)} missing entries, photo_count={len(photo_list)}")
-                    temp_path = event_info_path + '.tmp'
-                    with open(temp_path, 'w', encoding='utf-8') as f:
-                        json.dump(event_info_final, f, indent=4, ensure_ascii=False)
-                        f.flush()
-                        os.fsync(f.fileno())
-                    os.replace(temp_path, event_info_path)
-                    logger.info(f"Final event_info.json update completed: added {len(missing_entries)} missing entries, photo_count={len(photo_list)}")
-                else:
-                    logger.info(f"All entries present in event_info.json, no update needed")
+                    return True
+                
+                update_event_info(event_info_path, complete_sections)
+                logger.info(f"Final event_info.json validation completed: {len(missing_entries)} missing entries added, photo_count={len(photo_list)}")
             except Exception as final_update_error:
                 logger.error(f"Error in final event_info.json validation: {str(final_update_error)}", exc_info=True)
         
@@ -1669,8 +1796,7 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
         # Это критично для того, чтобы Laravel не пометил задачи как завершенные преждевременно
         if os.path.exists(event_info_path):
             try:
-                with open(event_info_path, 'r', encoding='utf-8') as f:
-                    final_event_info = json.load(f)
+                final_event_info = read_event_info(event_info_path)
                 
                 # Проверяем каждую секцию анализа
                 all_sections_complete = True
@@ -1690,6 +1816,12 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
             except Exception as final_check_error:
                 logger.error(f"Error in final completion check: {str(final_check_error)}", exc_info=True)
         
+        from utils.event_progress import finish_event_progress
+        finish_event_progress(
+            event_id, 'completed',
+            successfully_processed=successfully_processed, failed_count=len(failed_photos)
+        )
+        
         return {
             "status": "completed",
             "total_processed": total,
@@ -1703,8 +1835,8 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
     
     except SoftTimeLimitExceeded as e:
         # ВАЖНО: Обрабатываем мягкий таймаут - сохраняем прогресс и позволяем задаче завершиться gracefully
-        error_msg = f"МЯГКИЙ ТАЙМАУТ в process_event_photos для события {event_id} - задача будет завершена"
-        logger.warning(f"SOFT TIMEOUT in process_event_photos for event {event_id}: {str(e)}")
+        error_msg = f"МЯГКИЙ ТАЙМАУТ в finalize_event_processing для события {event_id} - задача будет завершена"
+        logger.warning(f"SOFT TIMEOUT in finalize_event_processing for event {event_id}: {str(e)}")
         task_logger.warning(error_msg, exc_info=True, event_id=event_id, error=str(e))
         
         # Сохраняем текущий прогресс в метаданные
@@ -1729,17 +1861,17 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
         # Это позволит продолжить обработку при следующем запуске
         return {
             "status": "soft_timeout",
-            "total_processed": idx - 1 if 'idx' in locals() else 0,
-            "successfully_processed": successfully_processed if 'successfully_processed' in locals() else 0,
-            "failed_count": len(failed_photos) if 'failed_photos' in locals() else 0,
+            "total_processed": total,
+            "successfully_processed": successfully_processed,
+            "failed_count": len(failed_photos),
             "event_id": event_id,
-            "message": f"Задача прервана по мягкому таймауту. Обработано {idx - 1 if 'idx' in locals() else 0} из {total if 'total' in locals() else 0} фотографий."
+            "message": f"Задача прервана по мягкому таймауту при завершении события. Обработано {successfully_processed} из {total} фотографий."
         }
         
     except TimeLimitExceeded as e:
         # Жесткий таймаут - задача будет убита
-        error_msg = f"ЖЕСТКИЙ ТАЙМАУТ в process_event_photos для события {event_id}"
-        logger.error(f"HARD TIMEOUT in process_event_photos for event {event_id}: {str(e)}")
+        error_msg = f"ЖЕСТКИЙ ТАЙМАУТ в finalize_event_processing для события {event_id}"
+        logger.error(f"HARD TIMEOUT in finalize_event_processing for event {event_id}: {str(e)}")
         task_logger.critical(error_msg, exc_info=True, event_id=event_id, error=str(e))
         
         # Получаем информацию об ошибке для сериализации
@@ -1757,6 +1889,9 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
             }
         )
         
+        from utils.event_progress import finish_event_progress
+        finish_event_progress(event_id, 'error', error=error_message)
+        
         # ВАЖНО: Для TimeLimitExceeded возвращаем словарь вместо raise
         # Это позволяет избежать проблем с сериализацией исключений в JSON backend
         return {
@@ -1765,14 +1900,14 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
             "error_type": "TimeLimitExceeded",
             "event_id": event_id,
             "traceback": error_traceback,
-            "total_processed": idx - 1 if 'idx' in locals() else 0,
-            "successfully_processed": successfully_processed if 'successfully_processed' in locals() else 0,
-            "failed_count": len(failed_photos) if 'failed_photos' in locals() else 0,
+            "total_processed": total,
+            "successfully_processed": successfully_processed,
+            "failed_count": len(failed_photos),
         }
     
     except Exception as e:
-        error_msg = f"КРИТИЧЕСКАЯ ОШИБКА в process_event_photos для события {event_id}"
-        logger.error(f"ERROR in process_event_photos for event {event_id}: {str(e)}", exc_info=True)
+        error_msg = f"КРИТИЧЕСКАЯ ОШИБКА в finalize_event_processing для события {event_id}"
+        logger.error(f"ERROR in finalize_event_processing for event {event_id}: {str(e)}", exc_info=True)
         task_logger.critical(error_msg, exc_info=True, event_id=event_id, error=str(e))
         
         # Получаем информацию об ошибке для сериализации
@@ -1791,6 +1926,9 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
             }
         )
         
+        from utils.event_progress import finish_event_progress
+        finish_event_progress(event_id, 'error', error=error_message)
+        
         # ВАЖНО: Не пробрасываем исключение, а возвращаем словарь с ошибкой
         # Это позволяет избежать проблем с сериализацией исключений в JSON backend
         return {
@@ -1799,9 +1937,9 @@ def process_event_photos(self, event_id: str, analyses: Dict[str, bool]):
             "error_type": error_type,
             "event_id": event_id,
             "traceback": error_traceback,
-            "total_processed": idx - 1 if 'idx' in locals() else 0,
-            "successfully_processed": successfully_processed if 'successfully_processed' in locals() else 0,
-            "failed_count": len(failed_photos) if 'failed_photos' in locals() else 0,
+            "total_processed": total,
+            "successfully_processed": successfully_processed,
+            "failed_count": len(failed_photos),
         }
     finally:
         db.close()
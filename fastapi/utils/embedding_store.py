@@ -0,0 +1,366 @@
+"""
+Хранилище embeddings лиц на уровне события
+
+Все лица события лежат в одной непрерывной float32 матрице L2-нормализованных векторов,
+рядом хранится карта строка -> (photo_id, индекс лица в face_encodings).
+Строки одной фотографии идут подряд, поэтому поиск сводится к одному произведению
+матрица-вектор и редукции по фотографиям.
+
+После анализа хранилище события сохраняется в бинарный sidecar:
+- {event_id}-{version}.npy - матрица float32, открывается через np.memmap без копирования
+- {event_id}-{version}.meta.npz - photo_ids, face_index, offsets
+Путь к .npy записывается в events.face_embeddings_path; пока он не задан, хранилище
+собирается из JSON face_encodings.
+"""
+import glob
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from app.config import settings
+from utils.index_files import atomic_save
+
+logger = logging.getLogger(__name__)
+
+SIDECAR_EXT = ".npy"
+SIDECAR_META_EXT = ".meta.npz"
+
+
+class EventEmbeddingStore:
+    """Матрица нормализованных embeddings лиц события + карта photo_id/индекс лица"""
+
+    def __init__(
+        self,
+        matrix: np.ndarray,
+        photo_ids: List[Any],
+        face_index: np.ndarray,
+        offsets: np.ndarray
+    ):
+        """
+        Args:
+            matrix: (N, D) float32, каждая строка нормализована
+            photo_ids: ID фотографий в порядке следования их строк в матрице
+            face_index: (N,) индекс лица внутри face_encodings своей фотографии
+            offsets: (P + 1,) начало строк каждой фотографии, offsets[-1] == N
+        """
+        self.matrix = matrix
+        self.photo_ids = photo_ids
+        self.face_index = face_index
+        self.offsets = offsets
+
+    @property
+    def dim(self) -> int:
+        return int(self.matrix.shape[1]) if self.matrix.ndim == 2 else 0
+
+    @property
+    def faces_count(self) -> int:
+        return int(self.matrix.shape[0])
+
+    @property
+    def photos_count(self) -> int:
+        return len(self.photo_ids)
+
+    @classmethod
+    def empty(cls, dim: int = 0) -> "EventEmbeddingStore":
+        return cls(
+            np.zeros((0, dim), dtype=np.float32),
+            [],
+            np.zeros(0, dtype=np.int32),
+            np.zeros(1, dtype=np.int64)
+        )
+
+    @classmethod
+    def from_rows(
+        cls,
+        rows: Iterable[Tuple[Any, Any]],
+        dim: Optional[int] = None,
+        load_fallback: Optional[Callable[[Any], Optional[List]]] = None
+    ) -> "EventEmbeddingStore":
+        """
+        Построить хранилище из пар (photo_id, face_encodings)
+
+        Правила фильтрации совпадают с прежним поиском по фотографиям:
+        - пустые face_encodings дочитываются через load_fallback (файл embeddings фото)
+        - фото с неконвертируемыми embeddings пропускается целиком
+        - размерность фото определяется по первому лицу, лица другой длины отбрасываются
+        - фото другой размерности, чем dim (размерность запроса), пропускаются;
+          без dim (sidecar строится до запроса) остается размерность большинства фото
+        - лица с нулевой нормой отбрасываются
+        """
+        per_photo: List[Tuple[Any, np.ndarray, np.ndarray]] = []
+        dims: Dict[int, int] = {}
+
+        for photo_id, encodings in rows:
+            if not encodings and load_fallback is not None:
+                encodings = load_fallback(photo_id)
+                if encodings:
+                    logger.debug(f"Photo {photo_id}: Loaded {len(encodings)} embeddings from file")
+                    encodings = list(encodings)
+            if not encodings or not isinstance(encodings, list):
+                continue
+            try:
+                vectors = [np.asarray(e, dtype=np.float32) for e in encodings]
+            except Exception as e:
+                logger.error(f"Photo {photo_id}: Error converting embeddings to numpy arrays: {str(e)}")
+                continue
+
+            indexed = [(i, v) for i, v in enumerate(vectors) if v.ndim == 1 and len(v) > 0]
+            if not indexed:
+                continue
+
+            photo_dim = len(indexed[0][1])
+            if dim is not None and photo_dim != dim:
+                logger.warning(f"Photo {photo_id}: embedding size mismatch {photo_dim} != {dim}. Skipping.")
+                continue
+            indexed = [(i, v) for i, v in indexed if len(v) == photo_dim]
+
+            faces = np.stack([v for _, v in indexed])
+            norms = np.linalg.norm(faces, axis=1)
+            keep = norms > 0
+            if not keep.any():
+                continue
+
+            faces = faces[keep] / norms[keep, None]
+            face_idx = np.asarray([i for i, _ in indexed], dtype=np.int32)[keep]
+            per_photo.append((photo_id, faces, face_idx))
+            dims[photo_dim] = dims.get(photo_dim, 0) + 1
+
+        if not per_photo:
+            return cls.empty(dim or 0)
+
+        # Без размерности запроса - размерность большинства фото (на практике у всех 512)
+        dim = max(dims, key=dims.get)
+        if len(dims) > 1:
+            logger.warning(f"Mixed embedding sizes in store: {dims}, keeping dim={dim}")
+            per_photo = [item for item in per_photo if item[1].shape[1] == dim]
+
+        photo_ids = [photo_id for photo_id, _, _ in per_photo]
+        counts = np.asarray([faces.shape[0] for _, faces, _ in per_photo], dtype=np.int64)
+        offsets = np.zeros(len(per_photo) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        matrix = np.ascontiguousarray(np.concatenate([faces for _, faces, _ in per_photo]), dtype=np.float32)
+        face_index = np.concatenate([face_idx for _, _, face_idx in per_photo])
+
+        return cls(matrix, photo_ids, face_index, offsets)
+
+    def search(self, query_embedding: np.ndarray, threshold: float, top_k: Optional[int] = None) -> List[Dict]:
+        """
+        Найти фотографии с лицами, похожими на запрос
+
+        Для каждой фотографии берется лучшее (минимальное) косинусное расстояние среди её лиц,
+        фотография попадает в выдачу при distance <= threshold. Результаты отсортированы по
+        возрастанию расстояния, top_k ограничивает выдачу лучшими совпадениями.
+
+        Returns: [{"photo_id", "distance", "similarity"}, ...]
+        """
+        if self.faces_count == 0:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32).ravel()
+        if query.shape[0] != self.dim:
+            logger.warning(f"Embedding size mismatch {self.dim} != {query.shape[0]}. Skipping store.")
+            return []
+
+        query_norm = np.linalg.norm(query)
+        if query_norm == 0:
+            logger.warning("Query embedding has zero norm")
+            return []
+        query = query / query_norm
+
+        # Одно произведение матрица-вектор вместо цикла по лицам
+        similarities = self.matrix @ query
+        np.clip(similarities, -1.0, 1.0, out=similarities)
+
+        # Лучшее лицо каждой фотографии (строки фото идут подряд)
+        best_similarities = np.maximum.reduceat(similarities, self.offsets[:-1])
+        distances = 1.0 - best_similarities.astype(np.float64)
+
+        matched = np.flatnonzero(distances <= threshold)
+        if top_k is not None and 0 < top_k < len(matched):
+            matched = matched[np.argpartition(distances[matched], top_k - 1)[:top_k]]
+        matched = matched[np.argsort(distances[matched], kind="stable")]
+
+        return [
+            {
+                "photo_id": self.photo_ids[i],
+                "distance": float(distances[i]),
+                "similarity": 1.0 - float(distances[i])
+            }
+            for i in matched
+        ]
+
+
+def load_embeddings_file(photo_id: Any) -> Optional[List]:
+    """Embeddings фото из файла FaceRecognition.save_embeddings (для фото с пустыми face_encodings)"""
+    from utils.face_recognition import FaceRecognition
+
+    embeddings = FaceRecognition.load_embeddings(str(photo_id))
+    if not embeddings:
+        return None
+    return [emb.tolist() if hasattr(emb, 'tolist') else list(emb) for emb in embeddings]
+
+
+def _sidecar_meta_path(matrix_path: str) -> str:
+    return matrix_path[:-len(SIDECAR_EXT)] + SIDECAR_META_EXT
+
+
+def save_embedding_sidecar(store: EventEmbeddingStore, event_id: str, root: Optional[str] = None) -> str:
+    """
+    Сохранить хранилище события в бинарный sidecar
+
+    Каждая запись получает новую версию в имени файла: читатели, уже открывшие
+    прежний memmap, дочитывают его, а новые запросы идут по пути из БД.
+    Returns: путь к .npy матрице
+    """
+    root = root or settings.FACE_EMBEDDINGS_PATH
+    os.makedirs(root, exist_ok=True)
+
+    matrix_path = os.path.join(root, f"{event_id}-{time.time_ns()}{SIDECAR_EXT}")
+    # Метаданные пишем первыми: матрица без метаданных никогда не видна читателю
+    atomic_save(_sidecar_meta_path(matrix_path), lambda f: np.savez(
+        f,
+        photo_ids=np.asarray([str(photo_id) for photo_id in store.photo_ids]),
+        face_index=store.face_index.astype(np.int32),
+        offsets=store.offsets.astype(np.int64)
+    ))
+    atomic_save(matrix_path, lambda f: np.save(f, np.ascontiguousarray(store.matrix, dtype=np.float32)))
+    return matrix_path
+
+
+def load_embedding_sidecar(matrix_path: str) -> EventEmbeddingStore:
+    """Открыть sidecar: матрица через memmap (без чтения в память и без парсинга JSON)"""
+    matrix = np.load(matrix_path, mmap_mode='r')
+    with np.load(_sidecar_meta_path(matrix_path), allow_pickle=False) as meta:
+        photo_ids = meta['photo_ids'].tolist()
+        face_index = meta['face_index']
+        offsets = meta['offsets']
+
+    if matrix.ndim != 2 or len(offsets) != len(photo_ids) + 1 or offsets[-1] != matrix.shape[0]:
+        raise ValueError(f"Embedding sidecar {matrix_path} is inconsistent with its metadata")
+    return EventEmbeddingStore(matrix, photo_ids, face_index, offsets)
+
+
+def _remove_sidecars(event_id: str, root: str, keep: Optional[str] = None) -> None:
+    """Удалить версии sidecar события, кроме keep"""
+    for path in glob.glob(os.path.join(root, f"{event_id}-*{SIDECAR_EXT}")):
+        if path == keep:
+            continue
+        for stale in (path, _sidecar_meta_path(path)):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+
+
+def _set_event_sidecar_path(db, event_id: str, matrix_path: Optional[str]) -> bool:
+    """Записать путь sidecar в events.face_embeddings_path (None - sidecar неактуален)"""
+    from sqlalchemy import text
+
+    try:
+        db.execute(
+            text("UPDATE events SET face_embeddings_path = :path WHERE id = :event_id"),
+            {"path": matrix_path, "event_id": str(event_id)}
+        )
+        db.commit()
+        return True
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Failed to update face_embeddings_path for event {event_id}: {str(e)}")
+        return False
+
+
+def write_event_embedding_sidecar(db, event_id: str, root: Optional[str] = None) -> Optional[str]:
+    """
+    Пересобрать sidecar события из face_encodings и сослаться на него из events
+
+    Вызывается в конце анализа лиц и скриптом backfill. Returns: путь к .npy или None.
+    """
+    root = root or settings.FACE_EMBEDDINGS_PATH
+    store = build_event_embedding_store(db, event_id, use_sidecar=False)
+    matrix_path = save_embedding_sidecar(store, event_id, root)
+
+    if not _set_event_sidecar_path(db, event_id, matrix_path):
+        _remove_sidecars(event_id, root, keep=None)
+        return None
+
+    _remove_sidecars(event_id, root, keep=matrix_path)
+    logger.info(f"Saved embedding sidecar for event {event_id}: {matrix_path} ({store.faces_count} faces)")
+    return matrix_path
+
+
+def invalidate_event_embedding_sidecar(db, event_id: str) -> None:
+    """Перед повторным анализом лиц поиск должен читать актуальные face_encodings из БД"""
+    _set_event_sidecar_path(db, event_id, None)
+
+
+def _load_event_sidecar(db, event_id: str) -> Optional[EventEmbeddingStore]:
+    from sqlalchemy import text
+
+    try:
+        matrix_path = db.execute(
+            text("SELECT face_embeddings_path FROM events WHERE id = :event_id"),
+            {"event_id": str(event_id)}
+        ).scalar()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Failed to read face_embeddings_path for event {event_id}: {str(e)}")
+        return None
+
+    if not matrix_path:
+        return None
+    try:
+        return load_embedding_sidecar(matrix_path)
+    except Exception as e:
+        logger.warning(f"Embedding sidecar {matrix_path} for event {event_id} is unusable, falling back to DB: {str(e)}")
+        return None
+
+
+def build_event_embedding_store(
+    db,
+    event_id: Optional[str] = None,
+    photo_ids: Optional[List[Any]] = None,
+    use_sidecar: bool = True,
+    dim: Optional[int] = None
+) -> EventEmbeddingStore:
+    """
+    Собрать хранилище embeddings события
+
+    Для события с актуальным sidecar матрица открывается через memmap. Иначе - из таблицы
+    photos одним запросом: загружаются только колонки id и face_encodings, без полных
+    ORM объектов. Если event_id не указан - по всем фотографиям; photo_ids ограничивает
+    выборку конкретными фото (точное переранжирование кандидатов ANN индекса).
+    dim - размерность запроса: sidecar другой размерности не используется, из БД
+    берутся только фото этой размерности.
+    """
+    from app.models import Photo
+
+    if event_id and photo_ids is None and use_sidecar:
+        store = _load_event_sidecar(db, event_id)
+        if store is not None and dim is not None and store.faces_count and store.dim != dim:
+            logger.warning(f"Embedding sidecar for event {event_id} has dim={store.dim}, query dim={dim}, falling back to DB")
+            store = None
+        if store is not None:
+            logger.info(
+                f"Loaded embedding sidecar for event {event_id}: "
+                f"{store.photos_count} photos, {store.faces_count} faces, dim={store.dim}"
+            )
+            return store
+
+    query = db.query(Photo.id, Photo.face_encodings).filter(Photo.face_encodings.isnot(None))
+    if event_id:
+        query = query.filter(Photo.event_id == event_id)
+    if photo_ids is not None:
+        if not photo_ids:
+            return EventEmbeddingStore.empty(dim or 0)
+        query = query.filter(Photo.id.in_(photo_ids))
+
+    store = EventEmbeddingStore.from_rows(query.yield_per(1000), dim=dim, load_fallback=load_embeddings_file)
+    logger.info(
+        f"Built embedding store for event {event_id}: "
+        f"{store.photos_count} photos, {store.faces_count} faces, dim={store.dim}"
+    )
+    return store
@@ -0,0 +1,349 @@
+"""
+Архив фотографий события прямо из S3
+
+Раньше archive_event_photos скачивал все оригиналы по одному во временную папку,
+затем перечитывал их в ZIP_DEFLATED архив: двойной объем диска, последовательная сеть
+и впустую потраченный CPU на сжатие JPEG, который уже сжат.
+
+Теперь объекты скачиваются параллельно (ARCHIVE_FETCH_CONCURRENCY, в памяти не больше
+этого числа объектов сверх записываемого) и сразу пишутся в zip: JPEG/WebP/PNG без сжатия
+(ZIP_STORED), остальное - ZIP_DEFLATED. Каждый объект проверяется на лету: размер
+по листингу и MD5 по ETag (для multipart ETag - только размер). Архив пишется
+в {путь}.part и переименовывается только целиком, поэтому на диске только сам архив.
+
+Крупные события архивируются томами (ARCHIVE_VOLUME_MAX_BYTES) по манифесту
+(ArchiveManifest): повторный запуск пропускает объекты, уже записанные в готовые тома,
+и дописывает только недостающие - сбой одного скачивания не начинает архив заново.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Уже сжатые форматы: повторное сжатие не уменьшает размер
+STORED_EXTENSIONS = {'.jpg', '.jpeg', '.webp', '.png'}
+
+
+class ArchiveVerificationError(ValueError):
+    """Скачанный объект не совпадает с листингом S3 (размер или MD5)"""
+
+
+def list_objects(s3_uploader, prefix: str) -> List[Dict]:
+    """Объекты под префиксом: [{'key', 'size', 'etag', 'modified'}] (без "папок")"""
+    objects = []
+    paginator = s3_uploader.s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=s3_uploader.bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            # Пропускаем папки (объекты заканчивающиеся на /)
+            if obj['Key'].endswith('/'):
+                continue
+            objects.append({
+                'key': obj['Key'],
+                'size': obj['Size'],
+                'etag': obj.get('ETag', '').strip('"'),
+                'modified': obj['LastModified'].timestamp() if obj.get('LastModified') else None,
+            })
+    return objects
+
+
+def fetch_object(s3_uploader, obj: Dict) -> bytes:
+    """
+    Скачать объект и проверить его по листингу
+
+    При несовпадении объект скачивается повторно (S3_UPLOAD_RETRIES попыток),
+    затем ArchiveVerificationError.
+    """
+    attempts = max(1, settings.S3_UPLOAD_RETRIES)
+    for attempt in range(attempts):
+        response = s3_uploader.s3_client.get_object(Bucket=s3_uploader.bucket_name, Key=obj['key'])
+        data = response['Body'].read()
+        try:
+            verify_object(obj, data)
+            return data
+        except ArchiveVerificationError as e:
+            if attempt + 1 >= attempts:
+                raise
+            logger.warning(f"{e}, downloading again (attempt {attempt + 2}/{attempts})")
+            time.sleep(settings.S3_RETRY_BACKOFF * (2 ** attempt))
+    raise ArchiveVerificationError(f"Could not download {obj['key']}")
+
+
+def verify_object(obj: Dict, data: bytes) -> None:
+    """Размер по листингу и MD5 по ETag (ETag multipart загрузки содержит '-' и не является MD5)"""
+    if obj.get('size') is not None and len(data) != obj['size']:
+        raise ArchiveVerificationError(f"Size mismatch for {obj['key']}: got {len(data)}, expected {obj['size']}")
+    etag = obj.get('etag') or ''
+    if etag and '-' not in etag and hashlib.md5(data).hexdigest() != etag:
+        raise ArchiveVerificationError(f"MD5 mismatch for {obj['key']}")
+
+
+def iter_fetched(s3_uploader, objects: List[Dict],
+                 concurrency: Optional[int] = None) -> Iterator[Tuple[Dict, Optional[bytes], Optional[Exception]]]:
+    """
+    Скачать объекты параллельно, отдавая их в исходном порядке: (obj, data, ошибка)
+
+    Впереди записываемого скачивается не больше concurrency объектов - память ограничена.
+    """
+    concurrency = max(1, concurrency or settings.ARCHIVE_FETCH_CONCURRENCY)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='archive-fetch') as executor:
+        window = deque()
+        remaining = iter(objects)
+        for obj in remaining:
+            window.append((obj, executor.submit(fetch_object, s3_uploader, obj)))
+            if len(window) >= concurrency:
+                break
+        while window:
+            obj, future = window.popleft()
+            next_obj = next(remaining, None)
+            if next_obj is not None:
+                window.append((next_obj, executor.submit(fetch_object, s3_uploader, next_obj)))
+            try:
+                yield obj, future.result(), None
+            except Exception as e:
+                yield obj, None, e
+
+
+def archive_name(obj: Dict) -> str:
+    """Имя файла внутри архива"""
+    return os.path.basename(obj['key'])
+
+
+def compress_type_for(name: str) -> int:
+    return zipfile.ZIP_STORED if os.path.splitext(name)[1].lower() in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+
+
+def write_zip(archive_path: str, fetched: Iterable[Tuple[Dict, Optional[bytes], Optional[Exception]]],
+              on_entry: Optional[Callable[[Dict, Optional[Exception]], None]] = None) -> Dict:
+    """
+    Записать скачанные объекты в архив archive_path (через {archive_path}.part)
+
+    on_entry(obj, ошибка) вызывается после каждого объекта (прогресс).
+    Returns: {'written': [ключи], 'failed': {ключ: ошибка}, 'bytes': размер архива}
+    """
+    part_path = archive_path + '.part'
+    written: List[str] = []
+    failed: Dict[str, str] = {}
+    try:
+        with zipfile.ZipFile(part_path, 'w', allowZip64=True) as zipf:
+            for obj, data, error in fetched:
+                if error is None:
+                    name = archive_name(obj)
+                    info = zipfile.ZipInfo(name, date_time=time.localtime(time.time())[:6])
+                    info.compress_type = compress_type_for(name)
+                    info.external_attr = 0o644 << 16
+                    zipf.writestr(info, data)
+                    written.append(obj['key'])
+                else:
+                    logger.error(f"Error downloading {obj['key']}: {error}")
+                    failed[obj['key']] = str(error)
+                if on_entry:
+                    on_entry(obj, error)
+        os.replace(part_path, archive_path)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return {'written': written, 'failed': failed, 'bytes': os.path.getsize(archive_path)}
+
+
+def plan_volumes(objects: List[Dict], max_bytes: int) -> List[List[Dict]]:
+    """Разбить объекты по порядку на тома не больше max_bytes (объект крупнее лимита - отдельный том)"""
+    volumes: List[List[Dict]] = []
+    current: List[Dict] = []
+    current_bytes = 0
+    for obj in objects:
+        size = obj.get('size') or 0
+        if current and max_bytes and current_bytes + size > max_bytes:
+            volumes.append(current)
+            current, current_bytes = [], 0
+        current.append(obj)
+        current_bytes += size
+    if current:
+        volumes.append(current)
+    return volumes
+
+
+class ArchiveManifest:
+    """
+    Манифест архива события: какие объекты (ETag, размер) в каком томе уже записаны
+
+    {archive_dir}/archive_{event_id}.manifest.json, запись атомарная (временный файл + os.replace).
+    Том считается готовым, только если его файл на месте и размер совпадает с манифестом.
+    """
+
+    def __init__(self, archive_dir: str, event_id: str, prefix: str):
+        self.archive_dir = archive_dir
+        self.event_id = str(event_id)
+        self.path = os.path.join(archive_dir, f"archive_{self.event_id}.manifest.json")
+        self.data = {'event_id': self.event_id, 'prefix': prefix, 'volumes': [], 'objects': {}}
+        self._lock = threading.Lock()
+
+    def load(self) -> bool:
+        """Прочитать манифест прошлого запуска (для того же префикса)"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.warning(f"Archive manifest {self.path} is unreadable, starting over: {e}")
+            return False
+        if data.get('prefix') != self.data['prefix']:
+            return False
+        self.data = data
+        return True
+
+    def save(self) -> None:
+        with self._lock:
+            self.data['updated_at'] = datetime.now().isoformat()
+            temp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.data, f, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+
+    def volume_path(self, index: int) -> str:
+        return os.path.join(self.archive_dir, f"archive_{self.event_id}.{index:03d}.zip")
+
+    def _drop_volume(self, volume: Dict) -> None:
+        for path in (volume['path'], volume['path'] + '.part'):
+            if os.path.exists(path):
+                os.remove(path)
+        for key in volume.get('keys', []):
+            entry = self.data['objects'].get(key)
+            if entry and entry.get('volume') == volume['index']:
+                entry['volume'] = None
+
+    def reconcile(self, objects: List[Dict]) -> List[Dict]:
+        """
+        Сверить манифест с текущим листингом S3
+
+        Незавершенные тома, тома с пропавшим/измененным файлом и тома, где объект изменился
+        (ETag, размер) или удален на S3, удаляются и пересобираются.
+        Returns: объекты, которых нет в готовых томах
+        """
+        listed = {obj['key']: obj for obj in objects}
+        known = self.data['objects']
+        kept = []
+        for volume in self.data['volumes']:
+            valid = volume.get('status') == 'complete' \
+                and os.path.exists(volume['path']) \
+                and os.path.getsize(volume['path']) == volume.get('bytes')
+            if valid:
+                for key in volume.get('keys', []):
+                    obj, entry = listed.get(key), known.get(key, {})
+                    if obj is None or obj['etag'] != entry.get('etag') or obj['size'] != entry.get('size'):
+                        valid = False
+                        break
+            if valid:
+                kept.append(volume)
+            else:
+                logger.info(f"Archive volume {volume['path']} is incomplete or stale, rebuilding its objects")
+                self._drop_volume(volume)
+        self.data['volumes'] = kept
+
+        archived = {key for volume in kept for key in volume.get('keys', [])}
+        # Манифест описывает текущий листинг: записи удаленных объектов не нужны
+        self.data['objects'] = {
+            key: {**known.get(key, {}), 'etag': obj['etag'], 'size': obj['size']}
+            for key, obj in listed.items()
+        }
+        for key in listed:
+            if key not in archived:
+                self.data['objects'][key]['volume'] = None
+        return [obj for obj in objects if obj['key'] not in archived]
+
+    def add_volume(self, keys: List[str]) -> Dict:
+        with self._lock:
+            index = max((volume['index'] for volume in self.data['volumes']), default=0) + 1
+            volume = {'index': index, 'path': self.volume_path(index), 'status': 'pending', 'keys': keys}
+            self.data['volumes'].append(volume)
+        return volume
+
+    def complete_volume(self, volume: Dict, stats: Dict) -> None:
+        """Отметить записанный том: его объекты больше не скачиваются, ошибки - в манифест"""
+        with self._lock:
+            if not stats['written']:
+                # Ни один объект не скачался: пустой том не нужен
+                self.data['volumes'].remove(volume)
+                if os.path.exists(volume['path']):
+                    os.remove(volume['path'])
+            else:
+                volume['status'] = 'complete'
+                volume['keys'] = stats['written']
+                volume['bytes'] = stats['bytes']
+            for key in stats['written']:
+                self.data['objects'][key].update(volume=volume['index'], error=None)
+            for key, error in stats['failed'].items():
+                self.data['objects'][key].update(volume=None, error=error)
+        self.save()
+
+    def volumes(self) -> List[Dict]:
+        return sorted(self.data['volumes'], key=lambda volume: volume['index'])
+
+    def missing(self) -> Dict[str, Optional[str]]:
+        """Объекты, которых еще нет в архиве: {ключ: последняя ошибка}"""
+        return {key: entry.get('error') for key, entry in self.data['objects'].items() if not entry.get('volume')}
+
+
+def build_event_archive(s3_uploader, event_id: str, prefix: str, objects: List[Dict], archive_dir: str,
+                        on_entry: Optional[Callable[[Dict, Optional[Exception]], None]] = None) -> Dict:
+    """
+    Собрать (или дособрать) архив объектов prefix (листинг list_objects) по манифесту
+
+    Уже записанные объекты с тем же ETag и размером не скачиваются повторно; недостающие
+    пишутся в новые тома не больше ARCHIVE_VOLUME_MAX_BYTES, тома собираются параллельно
+    (ARCHIVE_PARALLEL_VOLUMES). Объекты, которые не скачались, остаются в манифесте
+    с ошибкой и попадут в новый том при следующем запуске.
+
+    on_entry вызывается из потоков томов.
+    Returns: {'total', 'archived', 'downloaded', 'volumes': [пути], 'missing': {ключ: ошибка}}
+    """
+    os.makedirs(archive_dir, mode=0o755, exist_ok=True)
+
+    manifest = ArchiveManifest(archive_dir, event_id, prefix)
+    resumed = manifest.load()
+    pending = manifest.reconcile(objects)
+    manifest.save()
+    logger.info(
+        f"Archive for event {event_id}: {len(objects)} objects, {len(objects) - len(pending)} already archived"
+        f"{' (resumed)' if resumed else ''}, {len(pending)} to download"
+    )
+
+    downloaded = []
+
+    def build(volume: Dict, volume_objects: List[Dict]) -> None:
+        stats = write_zip(volume['path'], iter_fetched(s3_uploader, volume_objects), on_entry)
+        manifest.complete_volume(volume, stats)
+        downloaded.extend(stats['written'])
+        logger.info(f"Archive volume {volume['path']}: {len(stats['written'])} files, "
+                    f"{len(stats['failed'])} failed, {stats['bytes']} bytes")
+
+    plan = [(manifest.add_volume([obj['key'] for obj in volume_objects]), volume_objects)
+            for volume_objects in plan_volumes(pending, settings.ARCHIVE_VOLUME_MAX_BYTES)]
+    if plan:
+        manifest.save()
+        workers = max(1, min(settings.ARCHIVE_PARALLEL_VOLUMES, len(plan)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='archive-volume') as executor:
+            for future in [executor.submit(build, volume, volume_objects) for volume, volume_objects in plan]:
+                future.result()
+
+    missing = manifest.missing()
+    return {
+        'total': len(objects),
+        'archived': len(objects) - len(missing),
+        'downloaded': len(downloaded),
+        'volumes': [volume['path'] for volume in manifest.volumes()],
+        'missing': missing,
+        'manifest_path': manifest.path,
+    }
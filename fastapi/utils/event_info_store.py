@@ -0,0 +1,289 @@
+"""
+Журнал шагов анализа для event_info.json
+
+Раньше каждый шаг каждой фотографии перечитывал, искал запись линейным проходом и
+целиком переписывал event_info.json (indent=4, с векторами лиц) - O(n^2) ввода-вывода
+на событие. Теперь шаг дописывается одной JSON строкой в event_info.json.log, а журнал
+периодически сворачивается в снимок event_info.json, который читает Laravel:
+- когда журнал больше EVENT_INFO_COMPACT_BYTES;
+- когда снимок старше EVENT_INFO_COMPACT_SECONDS (Laravel видит прогресс с этой задержкой);
+- явно через compact_event_info() (перед чтением в finalize_event_processing).
+Задачи, которые сами меняют снимок (инициализация секций, s3_data), делают это через
+update_event_info() - под той же блокировкой, что и свертка.
+
+Блокировка event_info.json.lock: дописывание и чтение - shared, свертка - exclusive,
+поэтому читатель всегда видит согласованные снимок + журнал.
+"""
+import fcntl
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+LOG_SUFFIX = '.log'
+LOCK_SUFFIX = '.lock'
+
+ANALYSIS_SECTIONS = {
+    'timeline': 'analyze_timeline',
+    'removeexif': 'analyze_removeexif',
+    'watermark': 'analyze_watermark',
+    'facesearch': 'analyze_facesearch',
+    'numbersearch': 'analyze_numbersearch'
+}
+
+
+@contextmanager
+def event_info_lock(event_info_path: str, shared: bool = False):
+    """Блокировка event_info.json.lock (shared - дописывание/чтение, exclusive - перезапись снимка)"""
+    with open(event_info_path + LOCK_SUFFIX, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        except (AttributeError, OSError):
+            pass
+        try:
+            yield
+        finally:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            except (AttributeError, OSError):
+                pass
+
+
+def build_analysis_entry(photo_id: str, analysis_type: str, data: dict, status: str = "ready") -> Optional[Tuple[str, dict]]:
+    """
+    Запись секции analyze_* для фотографии (формат, который ожидает Laravel)
+
+    Returns: (ключ секции, запись) или None для неизвестного типа анализа
+    """
+    section_key = ANALYSIS_SECTIONS.get(analysis_type)
+    if not section_key:
+        return None
+
+    analysis_entry = {
+        'photoId': photo_id,
+        'updated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'status': status
+    }
+
+    # Добавляем данные анализа в зависимости от типа
+    if analysis_type == 'timeline':
+        analysis_entry['date'] = data.get('date', '')
+    elif analysis_type == 'removeexif':
+        analysis_entry['data'] = 'clear'
+    elif analysis_type == 'watermark':
+        analysis_entry['data'] = 'watermark_add'
+    elif analysis_type == 'facesearch' and settings.EVENT_INFO_SLIM_FACES:
+        # Векторы лиц не копируются в опрашиваемый документ: они лежат в photos.face_encodings
+        # и в бинарном хранилище события (events.face_embeddings_path), где ищутся по photoId
+        face_bboxes = data.get('face_bboxes') or []
+        faces_count = data.get('faces_count', len(face_bboxes))
+        analysis_entry['faces_count'] = faces_count
+        analysis_entry['face_bboxes'] = [list(bbox) for bbox in face_bboxes]
+        analysis_entry['embedding_ref'] = photo_id if faces_count else None
+    elif analysis_type == 'facesearch':
+        # Конвертируем numpy arrays в списки если нужно
+        face_encodings = data.get('face_encodings', [])
+        face_vector = data.get('face_vector', [])
+        if hasattr(face_encodings, 'tolist'):
+            face_encodings = face_encodings.tolist()
+        if hasattr(face_vector, 'tolist'):
+            face_vector = face_vector.tolist()
+        analysis_entry['face_encodings'] = face_encodings
+        analysis_entry['face_vector'] = face_vector
+    elif analysis_type == 'numbersearch':
+        # Сохраняем номера, если они есть, иначе null
+        numbers = data.get('numbers', [])
+        analysis_entry['number'] = numbers if numbers else None
+
+    return section_key, analysis_entry
+
+
+def slim_face_entries(event_info: dict) -> int:
+    """
+    Убрать face_encodings/face_vector из записей analyze_facesearch (снимки прошлых запусков)
+
+    Returns: число измененных записей
+    """
+    changed = 0
+    for entry in event_info.get(ANALYSIS_SECTIONS['facesearch']) or []:
+        if not isinstance(entry, dict) or ('face_encodings' not in entry and 'face_vector' not in entry):
+            continue
+        face_encodings = entry.pop('face_encodings', None) or []
+        entry.pop('face_vector', None)
+        entry.setdefault('faces_count', len(face_encodings))
+        entry.setdefault('embedding_ref', entry.get('photoId') if face_encodings else None)
+        changed += 1
+    return changed
+
+
+def _log_path(event_info_path: str) -> str:
+    return event_info_path + LOG_SUFFIX
+
+
+def _read_log(event_info_path: str) -> List[dict]:
+    """Записи журнала по порядку; оборванная последняя строка (падение процесса) пропускается"""
+    path = _log_path(event_info_path)
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping broken record in {path}")
+    return records
+
+
+def apply_records(event_info: dict, records: List[dict]) -> dict:
+    """
+    Применить записи журнала к снимку: запись фото в секции заменяется, новая - добавляется
+
+    Фото ищется по photoId или имени файла (как раньше в update_event_info_json),
+    через словарь позиций, а не линейным поиском для каждой записи.
+    """
+    positions: Dict[str, Dict[str, int]] = {}
+    for record in records:
+        section_key = record.get('section')
+        entry = record.get('entry')
+        if not section_key or not isinstance(entry, dict):
+            continue
+        section = event_info.setdefault(section_key, [])
+        if section_key not in positions:
+            positions[section_key] = {}
+            for idx, item in enumerate(section):
+                if isinstance(item, dict) and item.get('photoId') is not None:
+                    positions[section_key].setdefault(str(item['photoId']), idx)
+        section_positions = positions[section_key]
+
+        photo_id = str(entry.get('photoId'))
+        photo_name = record.get('photo_name')
+        idx = section_positions.get(photo_id)
+        if idx is None and photo_name:
+            idx = section_positions.get(str(photo_name))
+        if idx is not None:
+            section[idx] = entry
+        else:
+            section_positions[photo_id] = len(section)
+            section.append(entry)
+    return event_info
+
+
+def _write_snapshot(event_info_path: str, event_info: dict) -> None:
+    """Атомарная запись снимка через временный файл"""
+    temp_path = event_info_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(event_info, f, indent=4, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, event_info_path)
+
+
+def compact_event_info(event_info_path: str) -> int:
+    """
+    Свернуть журнал в event_info.json
+
+    Returns: число примененных записей
+    """
+    if not event_info_path or not os.path.exists(event_info_path):
+        return 0
+    with event_info_lock(event_info_path):
+        records = _read_log(event_info_path)
+        if not records:
+            return 0
+        with open(event_info_path, 'r', encoding='utf-8') as f:
+            event_info = json.load(f)
+        _write_snapshot(event_info_path, apply_records(event_info, records))
+        # Журнал очищается только после замены снимка: при падении между ними записи
+        # применятся повторно, что безопасно (запись фото просто заменяется)
+        os.remove(_log_path(event_info_path))
+    logger.info(f"Compacted {len(records)} progress records into {event_info_path}")
+    return len(records)
+
+
+def update_event_info(event_info_path: str, mutate: Callable[[dict], Optional[bool]]) -> dict:
+    """
+    Изменить event_info.json под exclusive блокировкой (как свертка журнала)
+
+    mutate получает согласованный вид (снимок + журнал) и меняет его на месте; если он
+    вернул False, снимок переписывается только ради свертки журнала.
+    Returns: итоговый event_info
+    """
+    with event_info_lock(event_info_path):
+        with open(event_info_path, 'r', encoding='utf-8') as f:
+            event_info = json.load(f)
+        records = _read_log(event_info_path)
+        if records:
+            apply_records(event_info, records)
+        changed = mutate(event_info) is not False
+        if changed or records:
+            _write_snapshot(event_info_path, event_info)
+        if records:
+            os.remove(_log_path(event_info_path))
+    return event_info
+
+
+def _compaction_due(event_info_path: str) -> bool:
+    try:
+        log_size = os.path.getsize(_log_path(event_info_path))
+    except OSError:
+        return False
+    if log_size >= settings.EVENT_INFO_COMPACT_BYTES:
+        return True
+    try:
+        return time.time() - os.path.getmtime(event_info_path) >= settings.EVENT_INFO_COMPACT_SECONDS
+    except OSError:
+        return False
+
+
+def append_event_info_record(event_info_path: str, photo_id: str, photo_name: str, analysis_type: str,
+                             data: dict, status: str = "ready") -> bool:
+    """
+    Дописать шаг анализа фотографии в журнал event_info.json (O(1), без перечитывания снимка)
+
+    Returns: False если снимка нет или тип анализа неизвестен
+    """
+    built = build_analysis_entry(photo_id, analysis_type, data, status)
+    if built is None:
+        logger.warning(f"Unknown analysis type: {analysis_type}")
+        return False
+    section_key, entry = built
+
+    line = json.dumps({'section': section_key, 'photo_name': photo_name, 'entry': entry}, ensure_ascii=False) + '\n'
+    with event_info_lock(event_info_path, shared=True):
+        # O_APPEND: строки параллельных писателей не перемешиваются
+        fd = os.open(_log_path(event_info_path), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+    if _compaction_due(event_info_path):
+        try:
+            compact_event_info(event_info_path)
+        except Exception as e:
+            logger.error(f"Failed to compact {event_info_path}: {str(e)}", exc_info=True)
+    return True
+
+
+def read_event_info(event_info_path: str) -> dict:
+    """
+    Согласованный вид event_info.json: снимок + еще не свернутые записи журнала
+
+    json.JSONDecodeError пробрасывается - снимок поврежден
+    """
+    with event_info_lock(event_info_path, shared=True):
+        with open(event_info_path, 'r', encoding='utf-8') as f:
+            event_info = json.load(f)
+        records = _read_log(event_info_path)
+    return apply_records(event_info, records) if records else event_info
@@ -0,0 +1,189 @@
+"""
+Состояние обработки события в Redis (тот же Redis, что у Celery)
+
+Ключи события (TTL EVENT_PROGRESS_TTL):
+- event:{event_id}:meta    - hash: state, task_id, total, sections, started_at, updated_at
+- event:{event_id}:steps   - hash: "{section}:{photo_id}" -> статус шага (processing/ready/error)
+- event:{event_id}:summary - hash: "{section}:{status}" -> число фото в этом статусе
+
+Шаг обновляется одним Lua скриптом: статус, счетчики summary и публикация изменения
+в канал event:{event_id}:updates выполняются атомарно. /events/{event_id}/progress
+читает summary двумя HGETALL вместо разбора event_info.json.
+"""
+import json
+import logging
+import time
+from typing import Dict, List, Optional
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+STATUSES = ('processing', 'ready', 'error')
+
+# KEYS: steps, summary, meta, channel
+# ARGV: field, section, status, message, ttl, updated_at
+_RECORD_STEP_LUA = """
+local old = redis.call('HGET', KEYS[1], ARGV[1])
+if old ~= ARGV[3] then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+    if old then
+        redis.call('HINCRBY', KEYS[2], ARGV[2] .. ':' .. old, -1)
+    end
+    redis.call('HINCRBY', KEYS[2], ARGV[2] .. ':' .. ARGV[3], 1)
+end
+redis.call('HSET', KEYS[3], 'updated_at', ARGV[6])
+for i = 1, 3 do
+    redis.call('EXPIRE', KEYS[i], ARGV[5])
+end
+redis.call('PUBLISH', KEYS[4], ARGV[4])
+return 1
+"""
+
+_record_step_script = None
+
+
+def _keys(event_id: str) -> Dict[str, str]:
+    prefix = f"event:{event_id}"
+    return {
+        'meta': f"{prefix}:meta",
+        'steps': f"{prefix}:steps",
+        'summary': f"{prefix}:summary",
+        'channel': f"{prefix}:updates",
+    }
+
+
+def updates_channel(event_id: str) -> str:
+    """Канал pub/sub с изменениями прогресса события"""
+    return _keys(str(event_id))['channel']
+
+
+def get_redis():
+    """Клиент Redis бэкенда Celery (отдельное подключение не нужно)"""
+    from tasks.celery_app import celery_app
+    return celery_app.backend.client
+
+
+def _publish(client, event_id: str, message: dict) -> None:
+    client.publish(updates_channel(event_id), json.dumps(message, ensure_ascii=False))
+
+
+def init_event_progress(event_id: str, task_id: Optional[str], total: int, sections: List[str]) -> None:
+    """Сбросить состояние события перед новой обработкой (вызывает process_event_photos)"""
+    if not settings.EVENT_PROGRESS_ENABLED:
+        return
+    event_id = str(event_id)
+    keys = _keys(event_id)
+    now = time.time()
+    try:
+        client = get_redis()
+        pipe = client.pipeline(transaction=True)
+        pipe.delete(keys['meta'], keys['steps'], keys['summary'])
+        pipe.hset(keys['meta'], mapping={
+            'state': 'processing',
+            'task_id': task_id or '',
+            'total': total,
+            'sections': ','.join(sections),
+            'started_at': now,
+            'updated_at': now,
+        })
+        pipe.expire(keys['meta'], settings.EVENT_PROGRESS_TTL)
+        pipe.execute()
+        _publish(client, event_id, {'type': 'started', 'event_id': event_id, 'task_id': task_id, 'total': total})
+    except Exception as e:
+        logger.warning(f"Failed to init Redis progress for event {event_id}: {str(e)}")
+
+
+def record_step(event_id: str, section: str, photo_id: str, status: str) -> None:
+    """Атомарно записать статус шага фотографии, пересчитать summary и опубликовать изменение"""
+    global _record_step_script
+    if not settings.EVENT_PROGRESS_ENABLED:
+        return
+    event_id = str(event_id)
+    keys = _keys(event_id)
+    message = json.dumps({
+        'type': 'step',
+        'event_id': event_id,
+        'section': section,
+        'photo_id': str(photo_id),
+        'status': status,
+    }, ensure_ascii=False)
+    try:
+        client = get_redis()
+        if _record_step_script is None:
+            _record_step_script = client.register_script(_RECORD_STEP_LUA)
+        _record_step_script(
+            keys=[keys['steps'], keys['summary'], keys['meta'], keys['channel']],
+            args=[f"{section}:{photo_id}", section, status, message, settings.EVENT_PROGRESS_TTL, time.time()],
+            client=client
+        )
+    except Exception as e:
+        logger.warning(f"Failed to record Redis progress for event {event_id}, photo {photo_id}: {str(e)}")
+
+
+def finish_event_progress(event_id: str, state: str = 'completed', **extra) -> None:
+    """Отметить завершение обработки события (state: completed/error)"""
+    if not settings.EVENT_PROGRESS_ENABLED:
+        return
+    event_id = str(event_id)
+    keys = _keys(event_id)
+    try:
+        client = get_redis()
+        client.hset(keys['meta'], mapping={'state': state, 'updated_at': time.time()})
+        client.expire(keys['meta'], settings.EVENT_PROGRESS_TTL)
+        _publish(client, event_id, {'type': 'finished', 'event_id': event_id, 'state': state, **extra})
+    except Exception as e:
+        logger.warning(f"Failed to finish Redis progress for event {event_id}: {str(e)}")
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def get_event_progress(event_id: str, details: bool = False) -> Optional[Dict]:
+    """
+    Сводка прогресса события из Redis, None если состояния нет (событие не обрабатывалось
+    или ключи истекли)
+
+    details=True добавляет статусы всех фото: {section: {photo_id: status}}
+    """
+    event_id = str(event_id)
+    keys = _keys(event_id)
+    client = get_redis()
+    pipe = client.pipeline(transaction=False)
+    pipe.hgetall(keys['meta'])
+    pipe.hgetall(keys['summary'])
+    if details:
+        pipe.hgetall(keys['steps'])
+    replies = pipe.execute()
+
+    meta = {_decode(k): _decode(v) for k, v in (replies[0] or {}).items()}
+    if not meta:
+        return None
+    counters = {_decode(k): int(v) for k, v in (replies[1] or {}).items()}
+
+    total = int(meta.get('total') or 0)
+    sections = {}
+    for section in filter(None, (meta.get('sections') or '').split(',')):
+        counts = {status: max(0, counters.get(f"{section}:{status}", 0)) for status in STATUSES}
+        done = counts['ready'] + counts['error']
+        counts['pending'] = max(0, total - done - counts['processing'])
+        counts['progress'] = int(done / total * 100) if total else 100
+        sections[section] = counts
+
+    result = {
+        'event_id': event_id,
+        'state': meta.get('state'),
+        'task_id': meta.get('task_id') or None,
+        'total': total,
+        'started_at': float(meta['started_at']) if meta.get('started_at') else None,
+        'updated_at': float(meta['updated_at']) if meta.get('updated_at') else None,
+        'sections': sections,
+    }
+    if details:
+        steps: Dict[str, Dict[str, str]] = {}
+        for field, status in (replies[2] or {}).items():
+            section, _, photo_id = _decode(field).partition(':')
+            steps.setdefault(section, {})[photo_id] = _decode(status)
+        result['steps'] = steps
+    return result
@@ -10,10 +10,10 @@ logger = logging.getLogger(__name__)
 class EXIFProcessor:
     """Обработка EXIF данных"""
     
-    def extract_exif(self, image_path: str) -> Optional[Dict]:
-        """Извлечь EXIF данные из изображения"""
+    def extract_exif(self, image_path: str, image: Optional[Image.Image] = None) -> Optional[Dict]:
+        """Извлечь EXIF данные из изображения (image - уже открытый файл, чтобы не открывать повторно)"""
         try:
-            img = Image.open(image_path)
+            img = image if image is not None else Image.open(image_path)
             exif_data = img._getexif()
             
             if not exif_data:
@@ -104,7 +104,7 @@ class EXIFProcessor:
         
         return None
 
-    def normalize_orientation(self, image_path: str) -> None:
+    def normalize_orientation(self, image_path: str, image: Optional[Image.Image] = None) -> Image.Image:
         """
         КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Повернуть изображение согласно EXIF и УДАЛИТЬ EXIF Orientation
         Перезаписывает файл на месте
@@ -114,10 +114,13 @@ class EXIFProcessor:
         
         Args:
             image_path: Путь к изображению (будет перезаписан)
+            image: Уже открытый исходный файл; тогда результат пишется в image_path без копирования
+        
+        Returns: повернутое RGB изображение (используется следующими шагами без повторного декодирования)
         """
         try:
             logger.info(f"Normalizing EXIF orientation for: {image_path}")
-            img = Image.open(image_path)
+            img = image if image is not None else Image.open(image_path)
             original_size = img.size
             
             # Проверяем наличие EXIF данных
@@ -224,6 +227,8 @@ class EXIFProcessor:
                     logger.error(f"Alternative save method also failed: {str(alt_error)}")
                     raise
             
+            return img_transposed
+            
         except Exception as e:
             logger.error(f"Error normalizing EXIF orientation for {image_path}: {str(e)}", exc_info=True)
             raise
@@ -0,0 +1,599 @@
+"""
+ANN индекс лиц для поиска по всем событиям
+
+IVF (inverted file) индекс на NumPy:
+- грубый квантизатор - сферический k-means на FACE_ANN_NLIST центроидов; переобучается,
+  когда число векторов вырастает в FACE_ANN_RETRAIN_GROWTH раз с прошлого обучения
+- векторы хранятся в float16, по одному сегменту на событие (segments/{event_id}.npz)
+- части process_event_photos не переписывают сегмент: каждый сброс пишет отдельную дельту
+  (segments/{event_id}~{время}-{pid}-{n}.npz) без общей блокировки, а finalize_event_processing
+  сливает дельты в сегмент (compact_segment); читатель применяет дельты поверх сегмента
+- поиск просматривает FACE_ANN_NPROBE ближайших кластеров и возвращает фото-кандидатов,
+  которые затем переранжируются точным расстоянием по float32 embeddings
+
+Пока центроиды не обучены (мало данных), поиск просматривает все векторы.
+"""
+import glob
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.config import settings
+from utils.index_files import IndexLock, atomic_save
+
+logger = logging.getLogger(__name__)
+
+SEGMENTS_DIR = "segments"
+CENTROIDS_FILE = "centroids.npy"
+# Сколько векторов было при обучении центроидов (для переобучения по росту индекса)
+CENTROIDS_META_FILE = "centroids.json"
+# Разделитель event_id и суффикса дельты в имени файла
+DELTA_SEPARATOR = "~"
+
+# Как в faiss: меньше 39 точек на кластер - обучать бессмысленно
+MIN_POINTS_PER_CENTROID = 39
+MAX_TRAIN_POINTS_PER_CENTROID = 256
+KMEANS_ITERATIONS = 10
+# Векторы в float16 - считаем сходство кусками, чтобы не раздувать память при upcast
+SCAN_CHUNK_ROWS = 65536
+
+_delta_counter = itertools.count()
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _segment_path(index_path: str, event_id: str) -> str:
+    return os.path.join(index_path, SEGMENTS_DIR, f"{event_id}.npz")
+
+
+def _delta_path(index_path: str, event_id: str) -> str:
+    suffix = f"{time.time_ns():020d}-{os.getpid()}-{next(_delta_counter)}"
+    return os.path.join(index_path, SEGMENTS_DIR, f"{event_id}{DELTA_SEPARATOR}{suffix}.npz")
+
+
+def file_event_id(path: str) -> str:
+    """event_id сегмента или дельты по имени файла"""
+    return os.path.basename(path)[:-len(".npz")].split(DELTA_SEPARATOR, 1)[0]
+
+
+def event_files(index_path: str, event_id: str) -> Tuple[Optional[str], List[str]]:
+    """Сегмент события (если есть) и его дельты в порядке записи"""
+    base = _segment_path(index_path, event_id)
+    deltas = sorted(glob.glob(os.path.join(index_path, SEGMENTS_DIR, f"{glob.escape(event_id)}{DELTA_SEPARATOR}*.npz")))
+    return (base if os.path.exists(base) else None), deltas
+
+
+def _read_segment(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Прочитать сегмент: (vectors float16 (N, D), photo_ids (N,))"""
+    with np.load(path, allow_pickle=False) as data:
+        return data['vectors'], data['photo_ids']
+
+
+def _read_delta(path: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Прочитать дельту: (vectors, photo_ids, replaced - все фото, лица которых она заменяет)"""
+    with np.load(path, allow_pickle=False) as data:
+        return data['vectors'], data['photo_ids'], data['replaced']
+
+
+def _segment_rows(path: str) -> int:
+    """Число векторов в файле по заголовку .npy, без чтения данных"""
+    with np.load(path, allow_pickle=False) as data:
+        with data.zip.open('vectors.npy') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, _, _ = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, _, _ = np.lib.format.read_array_header_2_0(f)
+    return int(shape[0]) if shape else 0
+
+
+def _encode_updates(updates: Dict[Any, List]) -> Tuple[Optional[np.ndarray], np.ndarray]:
+    """Embeddings фото -> (нормализованные float16 векторы или None, photo_ids строк)"""
+    new_vectors = []
+    new_ids = []
+    for photo_id, embeddings in updates.items():
+        for emb in embeddings or []:
+            vector = np.asarray(emb, dtype=np.float32).ravel()
+            if vector.size == 0 or not np.any(vector):
+                continue
+            new_vectors.append(vector)
+            new_ids.append(str(photo_id))
+    if not new_vectors:
+        return None, np.zeros(0, dtype=str)
+    dim = len(new_vectors[0])
+    keep = [i for i, v in enumerate(new_vectors) if len(v) == dim]
+    vectors = _normalize_rows(np.stack([new_vectors[i] for i in keep])).astype(np.float16)
+    return vectors, np.asarray([new_ids[i] for i in keep])
+
+
+def _apply_update(vectors: Optional[np.ndarray], photo_ids: np.ndarray, replaced,
+                  added: Optional[np.ndarray], added_ids: np.ndarray, label: str) -> Tuple[Optional[np.ndarray], np.ndarray]:
+    """Заменить строки фото replaced строками added"""
+    if vectors is not None and len(vectors):
+        keep = ~np.isin(photo_ids, np.asarray([str(pid) for pid in replaced]))
+        vectors, photo_ids = vectors[keep], photo_ids[keep]
+    if added is None or not len(added):
+        return vectors, photo_ids
+    if vectors is not None and len(vectors) and vectors.shape[1] != added.shape[1]:
+        logger.warning(f"Face index segment {label}: dim changed {vectors.shape[1]} -> {added.shape[1]}, dropping old rows")
+        vectors = None
+    if vectors is None or not len(vectors):
+        return added, added_ids
+    return np.concatenate([vectors, added]), np.concatenate([photo_ids, added_ids])
+
+
+def _read_event(base: Optional[str], deltas: List[str], label: str) -> Tuple[Optional[np.ndarray], np.ndarray]:
+    """Сегмент события с примененными по порядку дельтами"""
+    vectors, photo_ids = None, np.zeros(0, dtype=str)
+    if base:
+        try:
+            vectors, photo_ids = _read_segment(base)
+        except Exception as e:
+            logger.warning(f"Face index segment {base} is unreadable, rebuilding it: {str(e)}")
+    for path in deltas:
+        try:
+            added, added_ids, replaced = _read_delta(path)
+        except Exception as e:
+            logger.warning(f"Skipping unreadable face index delta {path}: {str(e)}")
+            continue
+        vectors, photo_ids = _apply_update(vectors, photo_ids, replaced.tolist(), added, added_ids, label)
+    return vectors, photo_ids
+
+
+def _write_segment(path: str, vectors: Optional[np.ndarray], photo_ids: np.ndarray) -> int:
+    if vectors is None or len(vectors) == 0:
+        if os.path.exists(path):
+            os.remove(path)
+        return 0
+    atomic_save(path, lambda f: np.savez(f, vectors=vectors, photo_ids=photo_ids))
+    return len(vectors)
+
+
+def write_delta(event_id: str, updates: Dict[Any, List], index_path: Optional[str] = None) -> int:
+    """
+    Записать лица указанных фотографий отдельной дельтой сегмента события
+
+    updates: photo_id -> список embeddings (пустой список удаляет фото из индекса).
+    Блокировка не нужна: имя дельты уникально, сегмент не переписывается.
+    Возвращает число строк в дельте.
+    """
+    index_path = index_path or settings.FACE_INDEX_PATH
+    vectors, photo_ids = _encode_updates(updates)
+    if vectors is None:
+        vectors = np.zeros((0, 0), dtype=np.float16)
+    replaced = np.asarray([str(pid) for pid in updates])
+    atomic_save(_delta_path(index_path, event_id),
+                lambda f: np.savez(f, vectors=vectors, photo_ids=photo_ids, replaced=replaced))
+    return len(vectors)
+
+
+def update_segment(event_id: str, updates: Dict[Any, List], index_path: Optional[str] = None) -> int:
+    """
+    Заменить лица указанных фотографий прямо в сегменте события
+
+    updates: photo_id -> список embeddings (пустой список удаляет фото из индекса)
+    Вызывать под IndexLock (скрипт перестройки индекса). Возвращает число строк в сегменте.
+    """
+    index_path = index_path or settings.FACE_INDEX_PATH
+    path = _segment_path(index_path, event_id)
+    vectors, photo_ids = _read_event(path if os.path.exists(path) else None, [], event_id)
+    added, added_ids = _encode_updates(updates)
+    vectors, photo_ids = _apply_update(vectors, photo_ids, list(updates), added, added_ids, event_id)
+    return _write_segment(path, vectors, photo_ids)
+
+
+def compact_segment(event_id: str, index_path: Optional[str] = None) -> int:
+    """
+    Слить дельты события в его сегмент и переобучить центроиды, если индекс вырос
+
+    Вызывается из finalize_event_processing, когда все части события записали дельты.
+    Возвращает число строк в сегменте.
+    """
+    index_path = index_path or settings.FACE_INDEX_PATH
+    with IndexLock(index_path):
+        base, deltas = event_files(index_path, event_id)
+        path = _segment_path(index_path, event_id)
+        if deltas:
+            vectors, photo_ids = _read_event(base, deltas, event_id)
+            rows = _write_segment(path, vectors, photo_ids)
+            for delta in deltas:
+                os.remove(delta)
+            logger.info(f"Face index: merged {len(deltas)} deltas into segment {event_id}, rows={rows}")
+        else:
+            rows = _segment_rows(path) if base else 0
+        maybe_train_centroids(index_path)
+    return rows
+
+
+def _spherical_kmeans(data: np.ndarray, k: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0) -> np.ndarray:
+    """Сферический k-means: центроиды нормализованы, близость - скалярное произведение"""
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), size=k, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignment = np.argmax(data @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, data)
+        counts = np.bincount(assignment, minlength=k)
+
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            # Пустые кластеры переинициализируем случайными точками
+            sums[empty] = data[rng.choice(len(data), size=len(empty), replace=False)]
+        centroids = _normalize_rows(sums)
+
+    return centroids.astype(np.float32)
+
+
+def _centroids_trained_on(index_path: str) -> Optional[int]:
+    try:
+        with open(os.path.join(index_path, CENTROIDS_META_FILE), 'r', encoding='utf-8') as f:
+            return int(json.load(f)['trained_on'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def maybe_train_centroids(index_path: Optional[str] = None, force: bool = False) -> bool:
+    """
+    Обучить грубый квантизатор, если данных стало достаточно
+
+    Вызывать под IndexLock. Центроиды обучаются, когда векторов хватает на FACE_ANN_NLIST
+    списков, и переобучаются, когда векторов стало в FACE_ANN_RETRAIN_GROWTH раз больше,
+    чем при прошлом обучении; force=True переобучает всегда (скрипт полной перестройки).
+    """
+    index_path = index_path or settings.FACE_INDEX_PATH
+    centroids_path = os.path.join(index_path, CENTROIDS_FILE)
+    nlist = settings.FACE_ANN_NLIST
+    min_points = nlist * MIN_POINTS_PER_CENTROID
+    segments = sorted(glob.glob(os.path.join(index_path, SEGMENTS_DIR, "*.npz")))
+
+    if os.path.exists(centroids_path) and not force:
+        # Центроиды без отметки (обучены до ее появления) считаем обученными на минимуме
+        trained_on = _centroids_trained_on(index_path) or min_points
+        total = 0
+        for path in segments:
+            try:
+                total += _segment_rows(path)
+            except Exception as e:
+                logger.warning(f"Skipping unreadable face index segment {path}: {str(e)}")
+        if total < trained_on * settings.FACE_ANN_RETRAIN_GROWTH:
+            return False
+        logger.info(f"Face index: {total} vectors since training on {trained_on}, retraining centroids")
+
+    chunks = []
+    for path in segments:
+        try:
+            vectors, _ = _read_segment(path)
+            if len(vectors):
+                chunks.append(vectors)
+        except Exception as e:
+            logger.warning(f"Skipping unreadable face index segment {path}: {str(e)}")
+    if chunks:
+        dims = {}
+        for chunk in chunks:
+            dims[chunk.shape[1]] = dims.get(chunk.shape[1], 0) + len(chunk)
+        dim = max(dims, key=dims.get)
+        chunks = [chunk for chunk in chunks if chunk.shape[1] == dim]
+
+    total = sum(len(c) for c in chunks)
+    if total < min_points:
+        logger.info(f"Face index: {total} vectors, need {min_points} to train {nlist} lists")
+        return False
+
+    data = np.concatenate(chunks).astype(np.float32)
+    max_points = nlist * MAX_TRAIN_POINTS_PER_CENTROID
+    if len(data) > max_points:
+        data = data[np.random.default_rng(0).choice(len(data), size=max_points, replace=False)]
+
+    logger.info(f"Face index: training {nlist} centroids on {len(data)} of {total} vectors")
+    centroids = _spherical_kmeans(_normalize_rows(data), nlist)
+    atomic_save(centroids_path, lambda f: np.save(f, centroids))
+    atomic_save(os.path.join(index_path, CENTROIDS_META_FILE),
+                lambda f: f.write(json.dumps({'trained_on': total}).encode('utf-8')))
+    logger.info(f"Face index: centroids saved to {centroids_path}")
+    return True
+
+
+class FaceIndexWriter:
+    """
+    Буфер записи лиц одного события в ANN индекс
+
+    process_event_photos добавляет лица по мере обработки фотографий, буфер сбрасывается
+    дельтой сегмента события каждые FACE_ANN_FLUSH_EVERY фото и в конце части.
+    Дельты пишутся без общей блокировки, части события не ждут друг друга.
+    Ошибки индекса логируются и не прерывают обработку - индекс только ускоряет поиск.
+    """
+
+    def __init__(self, event_id: str, flush_every: Optional[int] = None, index_path: Optional[str] = None):
+        self.event_id = str(event_id)
+        self.flush_every = flush_every or settings.FACE_ANN_FLUSH_EVERY
+        self.index_path = index_path or settings.FACE_INDEX_PATH
+        self._pending: Dict[Any, List] = {}
+
+    def add(self, photo_id: Any, embeddings: List) -> None:
+        """Запомнить лица фото (пустой список - у фото нет лиц, убрать его из индекса)"""
+        if not settings.FACE_ANN_ENABLED:
+            return
+        self._pending[str(photo_id)] = list(embeddings or [])
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            rows = write_delta(self.event_id, pending, self.index_path)
+            logger.info(f"Face index: flushed {len(pending)} photos for event {self.event_id}, delta rows={rows}")
+        except Exception as e:
+            logger.error(f"Face index: failed to flush event {self.event_id}: {str(e)}", exc_info=True)
+
+
+class _IndexState:
+    """
+    Снимок индекса для поиска
+
+    Перезагрузка строит новый снимок и заменяет его одним присваиванием, поиск берет
+    одну ссылку на снимок - смещения списков и векторы всегда из одной загрузки.
+    """
+
+    __slots__ = ('centroids', 'vectors', 'row_photo', 'photo_ids', 'list_offsets')
+
+    def __init__(self, centroids: Optional[np.ndarray], vectors: np.ndarray, row_photo: np.ndarray,
+                 photo_ids: Tuple[str, ...], list_offsets: np.ndarray):
+        self.centroids = centroids
+        self.vectors = vectors
+        self.row_photo = row_photo
+        self.photo_ids = photo_ids
+        self.list_offsets = list_offsets
+
+    @property
+    def size(self) -> int:
+        return int(self.vectors.shape[0])
+
+
+class FaceANNIndex:
+    """
+    Читатель ANN индекса: держит все сегменты в памяти, сгруппированные по кластерам
+
+    Когда меняются файлы события (сегмент или дельты), перечитываются только они:
+    строки остальных событий берутся из памяти (по запомненным позициям) и раскладываются
+    по спискам кластеров без повторного назначения и сортировки. Все строки заново
+    назначаются кластерам только при смене центроидов.
+    """
+
+    def __init__(self, index_path: Optional[str] = None):
+        self.index_path = index_path or settings.FACE_INDEX_PATH
+        self._lock = threading.Lock()
+        self._signature = None
+        self._centroids_signature = None
+        self._raw_centroids: Optional[np.ndarray] = None
+        # event_id -> {'signature', 'assign', 'rows', 'counts', 'dest'}: строки события,
+        # отсортированные по кластеру, и их позиции в векторах текущего снимка
+        self._segments: Dict[str, Dict] = {}
+        # photo_id -> номер в _photo_ids (только дописывается: удаленные фото просто не встречаются в строках)
+        self._photo_index: Dict[str, int] = {}
+        self._photo_ids: List[str] = []
+        self._state = _IndexState(None, np.zeros((0, 0), dtype=np.float16), np.zeros(0, dtype=np.int64),
+                                  (), np.zeros(1, dtype=np.int64))
+
+    @property
+    def size(self) -> int:
+        return self._state.size
+
+    def _current_signature(self) -> Tuple:
+        files = glob.glob(os.path.join(self.index_path, SEGMENTS_DIR, "*.npz"))
+        files.append(os.path.join(self.index_path, CENTROIDS_FILE))
+        signature = []
+        for path in sorted(files):
+            try:
+                stat = os.stat(path)
+                signature.append((path, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                continue
+        return tuple(signature)
+
+    def refresh(self) -> None:
+        """Перезагрузить изменившиеся файлы индекса"""
+        signature = self._current_signature()
+        if signature == self._signature:
+            return
+        with self._lock:
+            if signature != self._signature:
+                self._load(signature)
+                self._signature = signature
+
+    def _photo_rows(self, photo_ids: np.ndarray) -> np.ndarray:
+        rows = np.empty(len(photo_ids), dtype=np.int64)
+        for i, photo_id in enumerate(photo_ids.tolist()):
+            row = self._photo_index.get(photo_id)
+            if row is None:
+                row = self._photo_index[photo_id] = len(self._photo_ids)
+                self._photo_ids.append(photo_id)
+            rows[i] = row
+        return rows
+
+    def _assign(self, vectors: np.ndarray, centroids: Optional[np.ndarray]) -> np.ndarray:
+        """Номер кластера для каждой строки (0 для всех без центроидов)"""
+        assignment = np.zeros(len(vectors), dtype=np.int64)
+        if centroids is not None:
+            for start in range(0, len(vectors), SCAN_CHUNK_ROWS):
+                chunk = vectors[start:start + SCAN_CHUNK_ROWS].astype(np.float32)
+                assignment[start:start + SCAN_CHUNK_ROWS] = np.argmax(chunk @ centroids.T, axis=1)
+        return assignment
+
+    def _load(self, signature: Tuple) -> None:
+        centroids_path = os.path.join(self.index_path, CENTROIDS_FILE)
+        centroids_signature = None
+        events: Dict[str, List[Tuple]] = {}
+        for path, mtime, size in signature:
+            if path == centroids_path:
+                centroids_signature = (mtime, size)
+            else:
+                events.setdefault(file_event_id(path), []).append((path, mtime, size))
+
+        if centroids_signature != self._centroids_signature:
+            self._raw_centroids = None
+            if centroids_signature is not None:
+                try:
+                    self._raw_centroids = np.load(centroids_path).astype(np.float32)
+                except Exception as e:
+                    logger.warning(f"Face index: unreadable centroids, falling back to full scan: {str(e)}")
+            self._centroids_signature = centroids_signature
+
+        state = self._state
+        # Строки каждого события: неизмененные - из памяти, остальные - из сегмента и дельт
+        loaded = {}
+        reread = 0
+        for event_id, files in sorted(events.items()):
+            event_signature = tuple(files)
+            cached = self._segments.get(event_id)
+            if cached is not None and cached['signature'] == event_signature:
+                loaded[event_id] = {**cached, 'vectors': state.vectors[cached['dest']]}
+                continue
+            base = _segment_path(self.index_path, event_id)
+            deltas = [path for path, _, _ in files if path != base]
+            vectors, photo_ids = _read_event(base if any(path == base for path, _, _ in files) else None,
+                                             deltas, event_id)
+            reread += 1
+            if vectors is not None and len(vectors):
+                loaded[event_id] = {
+                    'signature': event_signature,
+                    'vectors': vectors.astype(np.float16, copy=False),
+                    'rows': self._photo_rows(photo_ids),
+                    'assign': None,
+                }
+
+        dim = 0
+        if loaded:
+            dims = {}
+            for segment in loaded.values():
+                dims[segment['vectors'].shape[1]] = dims.get(segment['vectors'].shape[1], 0) + len(segment['vectors'])
+            dim = max(dims, key=dims.get)
+            loaded = {event_id: segment for event_id, segment in loaded.items() if segment['vectors'].shape[1] == dim}
+
+        centroids = self._raw_centroids
+        if centroids is not None and dim and centroids.shape[1] != dim:
+            logger.warning("Face index: centroids dim does not match vectors, falling back to full scan")
+            centroids = None
+        reassign_all = centroids is not state.centroids
+        nlist = len(centroids) if centroids is not None else 1
+
+        for segment in loaded.values():
+            if segment['assign'] is None or reassign_all:
+                assignment = self._assign(segment['vectors'], centroids)
+                order = np.argsort(assignment, kind="stable")
+                segment['vectors'] = segment['vectors'][order]
+                segment['rows'] = segment['rows'][order]
+                segment['assign'] = assignment[order]
+                segment['counts'] = np.bincount(segment['assign'], minlength=nlist)
+
+        # Раскладываем события по спискам кластеров: внутри списка - в порядке event_id
+        counts = np.zeros(nlist, dtype=np.int64)
+        for segment in loaded.values():
+            counts += segment['counts']
+        list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        vectors = np.empty((int(list_offsets[-1]), dim), dtype=np.float16)
+        row_photo = np.empty(len(vectors), dtype=np.int64)
+        cursor = list_offsets[:-1].copy()
+        for segment in loaded.values():
+            segment_offsets = np.concatenate([[0], np.cumsum(segment['counts'])])
+            assign = segment['assign']
+            dest = cursor[assign] + (np.arange(len(assign)) - segment_offsets[assign])
+            vectors[dest] = segment.pop('vectors')
+            row_photo[dest] = segment['rows']
+            segment['dest'] = dest
+            cursor += segment['counts']
+
+        if centroids is None:
+            list_offsets = np.asarray([0, len(vectors)], dtype=np.int64)
+        self._segments = loaded
+        # Одно присваивание: поиск видит либо старый снимок, либо новый целиком
+        self._state = _IndexState(centroids, vectors, row_photo, tuple(self._photo_ids), list_offsets)
+        logger.info(
+            f"Face index loaded: {len(vectors)} faces in {len(loaded)} events ({reread} read from disk), "
+            f"lists={len(centroids) if centroids is not None else 0}"
+        )
+
+    @staticmethod
+    def _scan(vectors: np.ndarray, query: np.ndarray, start: int, end: int) -> np.ndarray:
+        sims = np.empty(end - start, dtype=np.float32)
+        for chunk_start in range(start, end, SCAN_CHUNK_ROWS):
+            chunk_end = min(chunk_start + SCAN_CHUNK_ROWS, end)
+            sims[chunk_start - start:chunk_end - start] = vectors[chunk_start:chunk_end].astype(np.float32) @ query
+        return sims
+
+    def search(
+        self,
+        query_embedding: np.ndarray,
+        nprobe: Optional[int] = None,
+        candidates: Optional[int] = None
+    ) -> Optional[List[Tuple[str, float]]]:
+        """
+        Найти фото-кандидатов для точного переранжирования
+
+        Returns: [(photo_id, approx_distance), ...] по возрастанию расстояния,
+                 None если индекс пуст или несовместим с запросом (нужен полный перебор)
+        """
+        self.refresh()
+        state = self._state
+        if state.size == 0:
+            return None
+
+        query = np.asarray(query_embedding, dtype=np.float32).ravel()
+        if query.shape[0] != state.vectors.shape[1]:
+            logger.warning(f"Face index dim {state.vectors.shape[1]} != query dim {query.shape[0]}")
+            return None
+        query_norm = np.linalg.norm(query)
+        if query_norm == 0:
+            return []
+        query = query / query_norm
+
+        nprobe = nprobe or settings.FACE_ANN_NPROBE
+        candidates = candidates or settings.FACE_ANN_RERANK
+
+        if state.centroids is None:
+            ranges = [(0, state.size)]
+        else:
+            probe = np.argsort(-(state.centroids @ query))[:nprobe]
+            ranges = [(int(state.list_offsets[c]), int(state.list_offsets[c + 1])) for c in probe]
+            ranges = [(s, e) for s, e in ranges if e > s]
+
+        if not ranges:
+            return []
+
+        rows = np.concatenate([np.arange(s, e) for s, e in ranges])
+        sims = np.concatenate([self._scan(state.vectors, query, s, e) for s, e in ranges])
+
+        # Лучшее лицо каждого фото: сортируем по сходству и берем первое вхождение фото
+        order = np.argsort(-sims, kind="stable")
+        photo_rows = state.row_photo[rows[order]]
+        _, first = np.unique(photo_rows, return_index=True)
+        first.sort()
+        first = first[:candidates]
+
+        return [
+            (state.photo_ids[photo_rows[i]], float(1.0 - sims[order[i]]))
+            for i in first
+        ]
+
+
+_face_ann_index_instance = None
+
+
+def get_face_ann_index() -> FaceANNIndex:
+    """Получить singleton читателя ANN индекса (на процесс)"""
+    global _face_ann_index_instance
+    if _face_ann_index_instance is None:
+        _face_ann_index_instance = FaceANNIndex()
+    return _face_ann_index_instance
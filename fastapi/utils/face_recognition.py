@@ -7,6 +7,7 @@ import sys
 import warnings
 from typing import List, Optional, Tuple, Dict
 from app.config import settings
+from utils.image_loader import load_image
 import logging
 
 # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Подавляем FutureWarning от InsightFace
@@ -17,6 +18,13 @@ warnings.filterwarnings('ignore', message='.*estimate is deprecated.*', category
 
 logger = logging.getLogger(__name__)
 
+# Минимальный порог confidence для детекции лиц
+MIN_DET_SCORE = 0.3
+# Сколько выровненных лиц подавать в модель распознавания за один вызов
+RECOGNITION_BATCH_SIZE = 64
+# Максимальная сторона изображения, подаваемого в InsightFace (в этих координатах хранятся bbox лиц)
+PREPARE_MAX_SIDE = 1280
+
 # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ №1: Singleton для FaceRecognition
 # Модель должна быть singleton на процесс, иначе InsightFace не инициализируется корректно
 _face_recognition_instance = None
@@ -82,6 +90,9 @@ class FaceRecognition:
         
         logger.error(f"INSIGHTFACE INIT - Model directory exists: {os.path.exists(model_path)}, absolute path: {os.path.abspath(model_path)}")
         
+        # None - еще не проверяли, поддерживает ли детектор батч
+        self._detector_batching = None
+        
         # Список моделей для попытки загрузки (от легкой к тяжелой)
         models_to_try = ['buffalo_s', 'antelopev2', 'buffalo_l']
         self.model = None
@@ -102,6 +113,7 @@ class FaceRecognition:
                 self.model.prepare(ctx_id=-1, det_size=(640, 640))
                 logger.error(f"INSIGHTFACE INIT - Model {model_name} prepared successfully")
                 logger.info(f"FaceRecognition initialized successfully with {model_name} model")
+                self.model_name = model_name
                 break
             except AssertionError as e:
                 last_error = e
@@ -139,8 +151,8 @@ class FaceRecognition:
         # Нормализуем размер (не 4k вертикаль после EXIF)
         h, w = img.shape[:2]
         max_side = max(h, w)
-        if max_side > 1280:
-            scale = 1280 / max_side
+        if max_side > PREPARE_MAX_SIDE:
+            scale = PREPARE_MAX_SIDE / max_side
             new_w = int(w * scale)
             new_h = int(h * scale)
             img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
@@ -156,7 +168,13 @@ class FaceRecognition:
         EXIF применяется ТОЛЬКО ОДИН РАЗ в начале пайплайна через normalize_orientation()
         После этого изображение уже нормализовано и не содержит EXIF
         """
-        embeddings = self.extract_all_embeddings(image_path)
+        return self._first_embedding(self.extract_all_embeddings(image_path))
+    
+    def extract_embedding_from_array(self, img: np.ndarray) -> Optional[np.ndarray]:
+        """Извлечь embedding первого лица из уже декодированного BGR изображения"""
+        return self._first_embedding(self.extract_all_embeddings_from_array(img))
+    
+    def _first_embedding(self, embeddings: List[np.ndarray]) -> Optional[np.ndarray]:
         if embeddings and len(embeddings) > 0:
             # Возвращаем первое лицо с правильным типом
             embedding = embeddings[0]
@@ -178,7 +196,14 @@ class FaceRecognition:
             if img is None:
                 logger.warning(f"Failed to load image: {image_path}")
                 return []
-            
+        except Exception as e:
+            logger.error(f"Error extracting face embeddings: {str(e)}", exc_info=True)
+            return []
+        return self.extract_all_embeddings_from_array(img)
+    
+    def extract_all_embeddings_from_array(self, img: np.ndarray) -> List[np.ndarray]:
+        """Извлечь embeddings всех лиц из уже декодированного BGR изображения"""
+        try:
             # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ №2: Подготавливаем изображение (BGR→RGB, resize)
             img = self._prepare_image(img)
             
@@ -222,26 +247,13 @@ class FaceRecognition:
             except Exception as pil_error:
                 logger.warning(f"PIL failed to open image: {str(pil_error)}")
             
-            # Читаем через OpenCV
-            img = cv2.imread(image_path)
+            # Декодируем сразу в размере, который нужен модели (JPEG draft), с fallback на cv2
+            img = load_image(image_path, max_side=PREPARE_MAX_SIDE)
             if img is None:
-                logger.error(f"Failed to load image with cv2.imread: {image_path}")
-                # Пробуем альтернативный способ чтения через PIL
-                try:
-                    import numpy as np
-                    from PIL import Image as PILImage
-                    pil_img = PILImage.open(image_path)
-                    # Конвертируем PIL в numpy array для OpenCV
-                    img = np.array(pil_img)
-                    # Если изображение в RGB, конвертируем в BGR для OpenCV
-                    if len(img.shape) == 3 and img.shape[2] == 3:
-                        img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-                    logger.info(f"Successfully loaded image via PIL fallback, shape: {img.shape}")
-                except Exception as fallback_error:
-                    logger.error(f"Fallback loading also failed: {str(fallback_error)}")
-                    return []
+                logger.error(f"Failed to load image: {image_path}")
+                return []
             
-            logger.info(f"cv2.imread successful: shape={img.shape}, dtype={img.dtype}")
+            logger.info(f"Image loaded: shape={img.shape}, dtype={img.dtype}")
             
             # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ №2: Подготавливаем изображение (BGR→RGB, resize)
             img = self._prepare_image(img)
@@ -295,7 +307,7 @@ class FaceRecognition:
             # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ №6: min_det_score = 0.3 (было 0.35, снижено для лучшего обнаружения)
             # embeddings с плохих детекций → мусор, потом cosine distance не проходит
             # Но слишком высокий порог может пропускать лица
-            min_det_score = 0.3  # Минимальный порог confidence для детекции лиц
+            min_det_score = MIN_DET_SCORE
             
             logger.info(f"INSIGHTFACE АНАЛИЗ - Фильтрация лиц с min_det_score={min_det_score}, всего сырых лиц: {len(faces)}")
             
@@ -341,6 +353,194 @@ class FaceRecognition:
             logger.error(f"Error extracting faces with bboxes from {image_path}: {str(e)}", exc_info=True)
             return []
     
+    def _load_prepared_image(self, image_path: str) -> Optional[np.ndarray]:
+        """Прочитать изображение (уменьшенное декодирование) и подготовить его как в extract_faces_with_bboxes"""
+        img = load_image(image_path, max_side=PREPARE_MAX_SIDE)
+        if img is None:
+            logger.error(f"Failed to load image {image_path}")
+            return None
+        return self._prepare_image(img)
+
+    def _letterbox_for_detection(self, img: np.ndarray, input_size: Tuple[int, int]) -> Tuple[np.ndarray, float]:
+        """Letterbox как в SCRFD.detect: resize с сохранением пропорций в левый верхний угол"""
+        im_ratio = float(img.shape[0]) / img.shape[1]
+        model_ratio = float(input_size[1]) / input_size[0]
+        if im_ratio > model_ratio:
+            new_height = input_size[1]
+            new_width = int(new_height / im_ratio)
+        else:
+            new_width = input_size[0]
+            new_height = int(new_width * im_ratio)
+        det_scale = float(new_height) / img.shape[0]
+        det_img = np.zeros((input_size[1], input_size[0], 3), dtype=np.uint8)
+        det_img[:new_height, :new_width, :] = cv2.resize(img, (new_width, new_height))
+        return det_img, det_scale
+
+    def _forward_detection_batch(self, det_imgs: List[np.ndarray]) -> List[Tuple[List, List, List]]:
+        """
+        Один прогон ONNX детектора на стеке letterbox-изображений
+
+        Повторяет SCRFD.forward, но раскладывает выходы по изображениям батча.
+        Бросает ValueError, если модель не поддерживает батч (фиксированный batch=1).
+        """
+        from insightface.model_zoo.scrfd import distance2bbox, distance2kps
+
+        det_model = self.model.det_model
+        batch_size = len(det_imgs)
+        input_size = tuple(det_imgs[0].shape[0:2][::-1])
+        blob = cv2.dnn.blobFromImages(
+            det_imgs, 1.0 / det_model.input_std, input_size,
+            (det_model.input_mean, det_model.input_mean, det_model.input_mean), swapRB=True
+        )
+        net_outs = det_model.session.run(det_model.output_names, {det_model.input_name: blob})
+
+        input_height, input_width = blob.shape[2], blob.shape[3]
+        fmc = det_model.fmc
+        per_image = [([], [], []) for _ in range(batch_size)]
+
+        def split(output: np.ndarray, rows: int) -> np.ndarray:
+            # Батчевый экспорт: (B, K, C); небатчевый с динамической осью: (B*K, C)
+            if output.ndim == 3 and output.shape[0] == batch_size and output.shape[1] == rows:
+                return output
+            if output.ndim == 2 and output.shape[0] == batch_size * rows:
+                return output.reshape(batch_size, rows, -1)
+            raise ValueError(f"Detector output {output.shape} is not batched for batch_size={batch_size}")
+
+        for idx, stride in enumerate(det_model._feat_stride_fpn):
+            height = input_height // stride
+            width = input_width // stride
+            rows = height * width * det_model._num_anchors
+
+            key = (height, width, stride)
+            anchor_centers = det_model.center_cache.get(key)
+            if anchor_centers is None:
+                anchor_centers = np.stack(np.mgrid[:height, :width][::-1], axis=-1).astype(np.float32)
+                anchor_centers = (anchor_centers * stride).reshape((-1, 2))
+                if det_model._num_anchors > 1:
+                    anchor_centers = np.stack([anchor_centers] * det_model._num_anchors, axis=1).reshape((-1, 2))
+                if len(det_model.center_cache) < 100:
+                    det_model.center_cache[key] = anchor_centers
+
+            scores = split(net_outs[idx], rows)
+            bbox_preds = split(net_outs[idx + fmc], rows) * stride
+            kps_preds = split(net_outs[idx + fmc * 2], rows) * stride if det_model.use_kps else None
+
+            for b in range(batch_size):
+                pos_inds = np.where(scores[b] >= det_model.det_thresh)[0]
+                bboxes = distance2bbox(anchor_centers, bbox_preds[b])
+                per_image[b][0].append(scores[b][pos_inds])
+                per_image[b][1].append(bboxes[pos_inds])
+                if kps_preds is not None:
+                    kpss = distance2kps(anchor_centers, kps_preds[b])
+                    kpss = kpss.reshape((kpss.shape[0], -1, 2))
+                    per_image[b][2].append(kpss[pos_inds])
+
+        return per_image
+
+    def _postprocess_detections(self, forward_result: Tuple[List, List, List], det_scale: float):
+        """NMS и возврат к координатам исходного изображения (как в SCRFD.detect)"""
+        det_model = self.model.det_model
+        scores_list, bboxes_list, kpss_list = forward_result
+        scores = np.vstack(scores_list)
+        order = scores.ravel().argsort()[::-1]
+        bboxes = np.vstack(bboxes_list) / det_scale
+        pre_det = np.hstack((bboxes, scores)).astype(np.float32, copy=False)[order, :]
+        keep = det_model.nms(pre_det)
+        det = pre_det[keep, :]
+        kpss = None
+        if det_model.use_kps:
+            kpss = (np.vstack(kpss_list) / det_scale)[order, :, :][keep, :, :]
+        return det, kpss
+
+    def cache_signature(self) -> str:
+        """Модель и параметры, от которых зависит результат (ключ кэша utils.ml_cache)"""
+        det_size = getattr(self.model.det_model, 'input_size', None) if self.model else None
+        return (
+            f"insightface={insightface.__version__};model={getattr(self, 'model_name', None)};"
+            f"det_size={det_size};min_det_score={MIN_DET_SCORE};prepare_max_side={PREPARE_MAX_SIDE};"
+            f"draft_decode={settings.ML_DRAFT_DECODE}"
+        )
+
+    def extract_faces_batch(self, image_paths: List[str]) -> List[Optional[List[Dict]]]:
+        """
+        Пакетное извлечение лиц для нескольких фотографий
+
+        Изображения декодируются и приводятся к det_size, детектор запускается одним
+        ONNX вызовом на весь батч (или по одному, если модель экспортирована с batch=1),
+        затем выровненные лица всех фото идут в модель распознавания одним батчем.
+        Остальные модели FaceAnalysis (landmarks, genderage) не запускаются - их
+        результаты не сохраняются.
+
+        Returns: для каждого пути - список словарей как в extract_faces_with_bboxes,
+                 или None, если фото не удалось обработать
+        """
+        from insightface.utils import face_align
+
+        results: List[Optional[List[Dict]]] = [None] * len(image_paths)
+        rec_model = self.model.models.get('recognition')
+        det_model = self.model.det_model
+        if rec_model is None or det_model is None or not det_model.use_kps:
+            # Без keypoints выравнивание невозможно - обычный путь по одному фото
+            return [self.extract_faces_with_bboxes(path) for path in image_paths]
+
+        images = []
+        for i, path in enumerate(image_paths):
+            img = self._load_prepared_image(path)
+            if img is not None:
+                images.append((i, img))
+        if not images:
+            return results
+
+        letterboxed = [self._letterbox_for_detection(img, det_model.input_size) for _, img in images]
+        forward_results = None
+        if len(images) > 1 and self._detector_batching is not False:
+            try:
+                forward_results = self._forward_detection_batch([det_img for det_img, _ in letterboxed])
+                self._detector_batching = True
+            except Exception as e:
+                # Модель с фиксированным batch=1 - запоминаем и дальше детектируем по одному
+                logger.warning(f"Batched face detection is not supported by this model, using per-image detection: {str(e)}")
+                self._detector_batching = False
+        if forward_results is None:
+            forward_results = [det_model.forward(det_img, det_model.det_thresh) for det_img, _ in letterboxed]
+
+        # Выравниваем лица всех фото и собираем их в один батч распознавания
+        crops = []
+        owners = []
+        for (i, img), (_, det_scale), forward_result in zip(images, letterboxed, forward_results):
+            try:
+                det, kpss = self._postprocess_detections(forward_result, det_scale)
+            except Exception as e:
+                logger.error(f"Face detection postprocessing failed for {image_paths[i]}: {str(e)}", exc_info=True)
+                continue
+            results[i] = []
+            for face_idx in range(det.shape[0]):
+                det_score = float(det[face_idx, 4])
+                if det_score < MIN_DET_SCORE:
+                    continue
+                crops.append(face_align.norm_crop(img, landmark=kpss[face_idx], image_size=rec_model.input_size[0]))
+                owners.append((i, det[face_idx, 0:4].tolist(), det_score))
+
+        for start in range(0, len(crops), RECOGNITION_BATCH_SIZE):
+            batch = crops[start:start + RECOGNITION_BATCH_SIZE]
+            try:
+                embeddings = rec_model.get_feat(batch)
+            except Exception as e:
+                logger.warning(f"Batched face recognition failed, falling back to per-face: {str(e)}")
+                embeddings = [rec_model.get_feat(crop) for crop in batch]
+            for (i, bbox, det_score), embedding in zip(owners[start:start + RECOGNITION_BATCH_SIZE], embeddings):
+                results[i].append({
+                    'embedding': embedding.flatten().astype("float32"),
+                    'bbox': bbox,
+                    'det_score': det_score
+                })
+
+        logger.info(
+            f"Batch face extraction: {len(image_paths)} photos, {len(crops)} faces, "
+            f"batched_detection={bool(self._detector_batching) and len(images) > 1}"
+        )
+        return results
+
     def compare_embeddings(
         self,
         embedding1: np.ndarray,
@@ -372,7 +572,8 @@ class FaceRecognition:
         with open(file_path, 'wb') as f:
             pickle.dump(embeddings, f)
     
-    def load_embeddings(self, photo_id: str, storage_path: str = "./embeddings") -> Optional[List[np.ndarray]]:
+    @staticmethod
+    def load_embeddings(photo_id: str, storage_path: str = "./embeddings") -> Optional[List[np.ndarray]]:
         """Загрузить embeddings из файла"""
         file_path = os.path.join(storage_path, f"{photo_id}.pkl")
         
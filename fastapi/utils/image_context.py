@@ -0,0 +1,91 @@
+"""
+Изображение одной фотографии в памяти на время ее обработки
+
+Раньше каждый шаг сам открывал и декодировал файл: extract_exif (timeline),
+normalize_orientation (копия в original_photo, декодирование, поворот, JPEG q95),
+add_watermark (повторное декодирование только что сохраненного JPEG), convert_to_webp.
+PhotoImage открывает исходный файл один раз:
+- EXIF читается из заголовка без декодирования пикселей;
+- removeexif декодирует и поворачивает изображение один раз, пишет JPEG в original_photo
+  и оставляет повернутые пиксели в памяти;
+- водяной знак и WebP берут эти пиксели, а не перечитывают файл.
+
+Лица и номера считаются в процессах ML пула (utils.ml_pool) и получают путь к файлу
+после removeexif: передача декодированного кадра между процессами (pickle десятков МБ)
+дороже, чем чтение JPEG там.
+"""
+import logging
+from typing import Dict, Optional
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+class PhotoImage:
+    """Исходный файл фотографии, декодируемый не больше одного раза"""
+
+    def __init__(self, path: str, exif_processor=None):
+        self.path = path
+        self._exif_processor = exif_processor
+        self._source: Optional[Image.Image] = None
+        self._pixels: Optional[Image.Image] = None
+
+    @property
+    def exif_processor(self):
+        if self._exif_processor is None:
+            from utils.exif_processor import EXIFProcessor
+            self._exif_processor = EXIFProcessor()
+        return self._exif_processor
+
+    def _open(self) -> Image.Image:
+        # Image.open читает только заголовок, пиксели декодируются при первом обращении
+        if self._source is None:
+            self._source = Image.open(self.path)
+        return self._source
+
+    def exif(self) -> Optional[Dict]:
+        """EXIF данные исходного файла (как EXIFProcessor.extract_exif)"""
+        return self.exif_processor.extract_exif(self.path, image=self._open())
+
+    def normalize(self, output_path: str) -> Image.Image:
+        """
+        Применить EXIF ориентацию и сохранить JPEG без EXIF в output_path
+
+        Повернутые пиксели остаются в памяти для следующих шагов (pixels()).
+        """
+        self._pixels = self.exif_processor.normalize_orientation(output_path, image=self._open())
+        self._close_source()
+        return self._pixels
+
+    def pixels(self) -> Image.Image:
+        """
+        Декодированное изображение: после normalize() - повернутое, иначе файл как есть
+
+        Без normalize() поворот не применяется, как и при чтении файла шагами напрямую
+        (remove_exif выключен или файл уже нормализован прошлым запуском).
+        """
+        if self._pixels is None:
+            image = self._open()
+            image.load()
+            self._pixels = image
+            self._source = None
+        return self._pixels
+
+    def _close_source(self) -> None:
+        if self._source is not None:
+            try:
+                self._source.close()
+            except Exception as e:
+                logger.debug(f"Failed to close {self.path}: {str(e)}")
+            self._source = None
+
+    def close(self) -> None:
+        """Освободить файл и пиксели"""
+        self._close_source()
+        if self._pixels is not None:
+            try:
+                self._pixels.close()
+            except Exception as e:
+                logger.debug(f"Failed to release pixels of {self.path}: {str(e)}")
+            self._pixels = None
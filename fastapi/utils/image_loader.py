@@ -0,0 +1,72 @@
+"""
+Чтение изображений для моделей лиц и номеров
+
+Модели не используют полное разрешение камеры (24-45 Мп): лица детектируются на кадре
+не больше 1280px, детектор текста EasyOCR сам уменьшает кадр до canvas_size.
+Для JPEG load_image декодирует сразу в нужном масштабе (PIL draft - libjpeg масштабирует
+в DCT на 1/2, 1/4, 1/8, не меньше запрошенного размера), а для OCR - только яркость без
+преобразования цвета. Декодирование быстрее в разы и не держит в памяти полный кадр.
+
+Результат как у cv2.imread: BGR (или grayscale) numpy массив с примененной EXIF ориентацией.
+"""
+import logging
+import math
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _draft_size(size: tuple, max_side: Optional[int]) -> tuple:
+    """Минимальный размер, который нужен при ограничении max_side"""
+    width, height = size
+    if not max_side or max(width, height) <= max_side:
+        return size
+    scale = max_side / max(width, height)
+    return max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale))
+
+
+def _load_with_pil(image_path: str, max_side: Optional[int], grayscale: bool) -> np.ndarray:
+    from PIL import Image, ImageOps
+
+    mode = 'L' if grayscale else 'RGB'
+    with Image.open(image_path) as img:
+        if img.format == 'JPEG':
+            # draft до load(): декодер выдаст уменьшенный кадр (и только яркость для 'L')
+            img.draft(mode, _draft_size(img.size, max_side))
+        # cv2.imread тоже применяет EXIF ориентацию
+        img = ImageOps.exif_transpose(img)
+        img = img.convert(mode)
+    if grayscale:
+        return np.array(img)
+    return cv2.cvtColor(np.asarray(img), cv2.COLOR_RGB2BGR)
+
+
+def load_image(image_path: str, max_side: Optional[int] = None, grayscale: bool = False) -> Optional[np.ndarray]:
+    """
+    Прочитать изображение для модели
+
+    max_side: нужный размер большей стороны; кадр может оказаться больше (масштабы JPEG
+        кратны 1/2), но не меньше - окончательный resize делает вызывающий
+    grayscale: вернуть одноканальное изображение
+    Returns: numpy массив (BGR или grayscale), None если файл не читается
+    """
+    if settings.ML_DRAFT_DECODE:
+        try:
+            return _load_with_pil(image_path, max_side, grayscale)
+        except Exception as e:
+            logger.warning(f"Reduced decode failed for {image_path}, falling back to cv2: {str(e)}")
+
+    img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR)
+    if img is None and not settings.ML_DRAFT_DECODE:
+        try:
+            # Форматы, которые не читает OpenCV
+            img = _load_with_pil(image_path, None, grayscale)
+        except Exception as e:
+            logger.error(f"Failed to load image {image_path}: {str(e)}")
+            return None
+    return img
@@ -193,8 +193,9 @@ class ImageProcessor:
         # Вызываем новую функцию для обратной совместимости
         return self.remove_to_exif_and_rotate(image_path, output_path)
     
-    def convert_to_webp(self, image_path: str, quality: int = 85, output_path: Optional[str] = None) -> str:
-        """Конвертировать изображение в WebP"""
+    def convert_to_webp(self, image_path: str, quality: int = 85, output_path: Optional[str] = None,
+                        image: Optional[Image.Image] = None) -> str:
+        """Конвертировать изображение в WebP (image - уже декодированное изображение, файл тогда не читается)"""
         if output_path:
             # Используем указанный путь
             output = output_path
@@ -203,7 +204,7 @@ class ImageProcessor:
             base, ext = os.path.splitext(image_path)
             output = f"{base}.webp"
         
-        img = Image.open(image_path)
+        img = image if image is not None else Image.open(image_path)
         img.save(output, "WEBP", quality=quality)
         
         return output
@@ -0,0 +1,53 @@
+"""
+Файлы поисковых индексов (лица, номера): блокировка каталога и атомарная запись
+"""
+import fcntl
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+LOCK_FILE = ".lock"
+
+
+class IndexLock:
+    """
+    Межпроцессная блокировка каталога индекса (fcntl), нужна только писателям
+
+    Если блокировку взять не удалось, OSError пробрасывается - писать без нее нельзя.
+    """
+
+    def __init__(self, index_path: str):
+        self.path = os.path.join(index_path, LOCK_FILE)
+        self._file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = open(self.path, 'a')
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        except OSError as e:
+            logger.warning(f"Failed to lock index {self.path}: {str(e)}")
+            self._file.close()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        except OSError as e:
+            # Закрытие файла все равно снимает блокировку
+            logger.warning(f"Failed to unlock index {self.path}: {str(e)}")
+        self._file.close()
+        return False
+
+
+def atomic_save(path: str, writer) -> None:
+    """Атомарная запись через временный файл (как для event_info.json)"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        writer(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
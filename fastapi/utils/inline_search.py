@@ -0,0 +1,222 @@
+"""
+Синхронный поиск в процессе API, без Celery
+
+Интерактивный поиск по событию занимает десятки миллисекунд, если модель уже загружена,
+а индекс события лежит в памяти. Через Celery к этому добавляются брокер и опрос
+/tasks/{task_id}. Inline режим отвечает прямо в запросе и отказывается (вызывающий
+уходит на Celery), когда:
+- модель еще не загружена в процессе API или занята другим запросом дольше SEARCH_INLINE_WAIT;
+- индекс события холодный (не загружен в память) - тогда он прогревается в фоне,
+  и следующий запрос по событию уже пойдет inline.
+
+Результат совпадает с результатом задач search_similar_faces / search_by_numbers.
+"""
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# InsightFace и EasyOCR не thread-safe: один запрос на модель, остальные - в Celery
+_face_lock = threading.Lock()
+_number_lock = threading.Lock()
+
+# event_id -> (путь к sidecar, хранилище embeddings)
+_face_stores: Dict[str, Tuple[str, object]] = {}
+_warming = set()
+_warming_lock = threading.Lock()
+
+
+def _run_in_background(key: str, target, *args) -> None:
+    """Запустить прогрев один раз на ключ (повторные запросы не плодят потоки)"""
+    with _warming_lock:
+        if key in _warming:
+            return
+        _warming.add(key)
+
+    def runner():
+        try:
+            target(*args)
+        except Exception as e:
+            logger.error(f"Inline search warm-up {key} failed: {str(e)}", exc_info=True)
+        finally:
+            with _warming_lock:
+                _warming.discard(key)
+
+    threading.Thread(target=runner, name=f"inline-warmup-{key}", daemon=True).start()
+
+
+def _face_model_ready() -> bool:
+    import utils.face_recognition as face_recognition_module
+    return face_recognition_module._face_recognition_instance is not None
+
+
+def _number_model_ready() -> bool:
+    import utils.number_recognition as number_recognition_module
+    return number_recognition_module._number_recognition_instance is not None
+
+
+def warm_inline_search() -> None:
+    """Загрузить модели для inline поиска в фоне (вызывается при старте API)"""
+    if not settings.SEARCH_INLINE_ENABLED:
+        return
+    if settings.SEARCH_INLINE_FACE:
+        from utils.face_recognition import get_face_recognition
+        _run_in_background("face-model", get_face_recognition)
+    if settings.SEARCH_INLINE_NUMBER:
+        from utils.number_recognition import get_number_recognition
+        _run_in_background("number-model", get_number_recognition)
+
+
+def _decode_image(content: bytes) -> Optional[np.ndarray]:
+    import cv2
+    return cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def _event_sidecar_path(db, event_id: str) -> Optional[str]:
+    from sqlalchemy import text
+
+    try:
+        return db.execute(
+            text("SELECT face_embeddings_path FROM events WHERE id = :event_id"),
+            {"event_id": str(event_id)}
+        ).scalar()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Failed to read face_embeddings_path for event {event_id}: {str(e)}")
+        return None
+
+
+def _load_face_store(event_id: str, matrix_path: str) -> None:
+    from utils.embedding_store import load_embedding_sidecar
+
+    store = load_embedding_sidecar(matrix_path)
+    _face_stores[event_id] = (matrix_path, store)
+    logger.info(f"Inline search: embeddings of event {event_id} loaded ({store.faces_count} faces)")
+
+
+def _load_number_index(event_id: str) -> None:
+    from app.database import SessionLocal
+    from utils.number_index import get_event_number_index
+
+    db = SessionLocal()
+    try:
+        index = get_event_number_index(db, event_id)
+        logger.info(f"Inline search: number index of event {event_id} loaded ({index.photos_count} photos)")
+    finally:
+        db.close()
+
+
+def search_faces_inline(
+    db,
+    content: bytes,
+    event_id: Optional[str],
+    threshold: float = 0.6,
+    top_k: Optional[int] = None
+) -> Tuple[Optional[Dict], str]:
+    """
+    Поиск по лицу в процессе API
+
+    Returns: (результат как у search_similar_faces, "") или (None, причина перехода на Celery)
+    """
+    if not settings.SEARCH_INLINE_ENABLED or not settings.SEARCH_INLINE_FACE:
+        return None, "disabled"
+    if not event_id:
+        # Поиск по всем событиям идет через ANN индекс и остается в Celery
+        return None, "no event_id"
+    event_id = str(event_id)
+    if not _face_model_ready():
+        warm_inline_search()
+        return None, "model is not loaded"
+
+    matrix_path = _event_sidecar_path(db, event_id)
+    if not matrix_path:
+        return None, "event has no embedding sidecar"
+    cached = _face_stores.get(event_id)
+    if cached is None or cached[0] != matrix_path:
+        _run_in_background(f"face-{event_id}", _load_face_store, event_id, matrix_path)
+        return None, "event index is cold"
+    store = cached[1]
+
+    img = _decode_image(content)
+    if img is None:
+        return {"error": "Failed to decode query image", "results": []}, ""
+
+    if not _face_lock.acquire(timeout=settings.SEARCH_INLINE_WAIT):
+        return None, "face model is busy"
+    try:
+        from utils.face_recognition import get_face_recognition
+        query_embedding = get_face_recognition().extract_embedding_from_array(img)
+    finally:
+        _face_lock.release()
+
+    if query_embedding is None:
+        return {"error": "No face found in query image", "results": []}, ""
+
+    results = store.search(query_embedding, threshold, top_k=top_k)
+    logger.info(f"Inline face search in event {event_id}: {len(results)} matches")
+    return {
+        "status": "completed",
+        "results": results,
+        "total_found": len(results)
+    }, ""
+
+
+def search_numbers_inline(db, content: bytes, event_id: Optional[str]) -> Tuple[Optional[Dict], str]:
+    """
+    Поиск по номеру в процессе API
+
+    Returns: (результат как у search_by_numbers, "") или (None, причина перехода на Celery)
+    """
+    from utils.number_index import peek_event_number_index
+
+    if not settings.SEARCH_INLINE_ENABLED or not settings.SEARCH_INLINE_NUMBER:
+        return None, "disabled"
+    if not event_id:
+        return None, "no event_id"
+    event_id = str(event_id)
+    if not _number_model_ready():
+        warm_inline_search()
+        return None, "model is not loaded"
+
+    number_index = peek_event_number_index(event_id)
+    if number_index is None:
+        _run_in_background(f"number-{event_id}", _load_number_index, event_id)
+        return None, "event index is cold"
+
+    img = _decode_image(content)
+    if img is None:
+        return {"error": "Failed to decode query image", "results": []}, ""
+
+    if not _number_lock.acquire(timeout=settings.SEARCH_INLINE_WAIT):
+        return None, "number model is busy"
+    try:
+        from utils.number_recognition import get_number_recognition
+        query_numbers = get_number_recognition().extract_from_array(img, source="inline query")
+    finally:
+        _number_lock.release()
+
+    if not query_numbers:
+        return {"error": "No numbers found in query image", "results": []}, ""
+
+    results = number_index.search(query_numbers)
+    if results:
+        # Как в search_by_numbers: индекс мог пережить удаленные фотографии
+        from app.models import Photo
+        existing_ids = {
+            str(row[0]) for row in
+            db.query(Photo.id).filter(Photo.id.in_([result["photo_id"] for result in results])).all()
+        }
+        results = [result for result in results if result["photo_id"] in existing_ids]
+
+    logger.info(f"Inline number search in event {event_id}: {len(results)} matches for {query_numbers}")
+    return {
+        "status": "completed",
+        "results": results,
+        "total_found": len(results),
+        "query_numbers": query_numbers
+    }, ""
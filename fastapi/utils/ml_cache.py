@@ -0,0 +1,168 @@
+"""
+Кэш результатов ML анализа по содержимому изображения
+
+Одни и те же фото анализируются повторно: перезапуски обработки, restart_task.py,
+смена набора анализов. Результаты extract_faces_batch и extract_numbers сохраняются
+на локальный диск под ключом
+
+    blake2b(вид анализа, хэш содержимого файла, сигнатура модели, доп. параметры)
+
+где сигнатура модели - модель, ее версия и параметры (min_det_score, det_size, языки OCR...),
+поэтому смена модели или параметров просто перестает попадать в старые записи.
+
+Записи - отдельные JSON файлы {ML_CACHE_PATH}/{ключ[:2]}/{ключ}.json, запись атомарная
+(временный файл + os.replace), поэтому кэш можно делить между процессами и воркерами.
+Размер ограничен ML_CACHE_MAX_BYTES: при превышении удаляются записи с самым старым
+mtime (mtime обновляется при каждом попадании - LRU).
+"""
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# После очистки кэш занимает не больше этой доли ML_CACHE_MAX_BYTES
+EVICT_TO_RATIO = 0.9
+
+
+def make_key(kind: str, content_hash: str, signature: str, extra: str = "") -> str:
+    """Ключ записи кэша"""
+    digest = hashlib.blake2b(digest_size=20)
+    for part in (kind, content_hash, signature, extra):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def encode_faces(faces: List[Dict]) -> List[Dict]:
+    """Лица extract_faces_batch -> JSON (embedding как base64 float32)"""
+    encoded = []
+    for face in faces:
+        embedding = np.asarray(face['embedding'], dtype=np.float32)
+        encoded.append({
+            'embedding': base64.b64encode(embedding.tobytes()).decode('ascii'),
+            'bbox': [float(value) for value in face['bbox']],
+            'det_score': float(face.get('det_score', 0.0)),
+        })
+    return encoded
+
+
+def decode_faces(encoded: List[Dict]) -> List[Dict]:
+    """JSON -> лица в формате extract_faces_batch"""
+    return [
+        {
+            'embedding': np.frombuffer(base64.b64decode(face['embedding']), dtype=np.float32).copy(),
+            'bbox': face['bbox'],
+            'det_score': face.get('det_score', 0.0),
+        }
+        for face in encoded
+    ]
+
+
+class MLResultCache:
+    """Дисковый LRU кэш результатов ML анализа"""
+
+    def __init__(self, root: Optional[str] = None, max_bytes: Optional[int] = None):
+        self.root = root or settings.ML_CACHE_PATH
+        self.max_bytes = max_bytes or settings.ML_CACHE_MAX_BYTES
+        # Оценка размера кэша этим процессом; точный размер считается при очистке
+        self._approx_bytes: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[Any]:
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"ML cache: unreadable entry {path}, ignoring: {str(e)}")
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        path = self._path(key)
+        data = json.dumps(value, ensure_ascii=False).encode('utf-8')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            if self._approx_bytes is None:
+                self._approx_bytes = self._scan_size()
+            self._approx_bytes += len(data)
+            over_limit = self._approx_bytes > self.max_bytes
+        if over_limit:
+            self.evict()
+
+    def _entries(self) -> List[tuple]:
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self) -> int:
+        """Удалить самые давно использованные записи до EVICT_TO_RATIO от лимита"""
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            target = int(self.max_bytes * EVICT_TO_RATIO)
+            removed = 0
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+            self._approx_bytes = total
+        if removed:
+            logger.info(f"ML cache: evicted {removed} entries, size is now {total} bytes")
+        return removed
+
+
+_ml_cache_instance: Optional[MLResultCache] = None
+
+
+def get_ml_cache() -> Optional[MLResultCache]:
+    """Кэш результатов ML (один на процесс), None если кэш выключен"""
+    global _ml_cache_instance
+    if not settings.ML_CACHE_ENABLED:
+        return None
+    if _ml_cache_instance is None:
+        _ml_cache_instance = MLResultCache()
+    return _ml_cache_instance
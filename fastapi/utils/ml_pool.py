@@ -0,0 +1,277 @@
+"""
+Пул процессов для ML инференса (InsightFace, EasyOCR)
+
+Celery worker работает с -P threads, а onnxruntime и EasyOCR держат GIL и не thread-safe,
+поэтому потоки воркера фактически выполняют инференс по очереди. Тяжелые вызовы
+отправляются в пул процессов: модели загружаются в каждом процессе один раз при его
+старте (initializer), потоки воркера только ждут результат.
+
+Процессы создаются через spawn - fork многопоточного процесса с onnxruntime небезопасен.
+
+Перед отправкой в пул результат ищется в кэше по содержимому файла (utils.ml_cache):
+повторный анализ того же фото той же моделью с теми же параметрами не доходит до пула.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _init_ml_process(threads: int):
+    """Initializer процесса пула: ограничиваем потоки библиотек и загружаем модели заранее"""
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    try:
+        import cv2
+        cv2.setNumThreads(threads)
+    except Exception:
+        pass
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except Exception:
+        pass
+
+    from utils.face_recognition import get_face_recognition
+    from utils.number_recognition import get_number_recognition
+
+    for name, loader in (('InsightFace', get_face_recognition), ('EasyOCR', get_number_recognition)):
+        try:
+            loader()
+        except Exception as e:
+            # Модель загрузится при первом вызове (или вызов вернет ошибку)
+            logger.error(f"ML pool process {os.getpid()}: failed to preload {name}: {str(e)}", exc_info=True)
+    logger.info(f"ML pool process {os.getpid()} ready")
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _run_extract_faces_batch(image_paths: List[str]) -> List[Optional[List[Dict]]]:
+    from utils.face_recognition import get_face_recognition
+    return get_face_recognition().extract_faces_batch(image_paths)
+
+
+def _run_extract_numbers(image_path: str, face_bboxes: Optional[List] = None) -> List[str]:
+    from utils.number_recognition import get_number_recognition
+    return get_number_recognition().extract(image_path, face_bboxes=face_bboxes)
+
+
+def _run_cache_signature(kind: str) -> str:
+    if kind == 'faces':
+        from utils.face_recognition import get_face_recognition
+        return get_face_recognition().cache_signature()
+    from utils.number_recognition import get_number_recognition
+    return get_number_recognition().cache_signature()
+
+
+def get_ml_pool() -> Optional[ProcessPoolExecutor]:
+    """Получить пул процессов (один на процесс воркера), None если пул выключен"""
+    global _pool
+    if not settings.ML_POOL_ENABLED:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            workers = settings.ML_POOL_WORKERS or os.cpu_count() or 1
+            _pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_ml_process,
+                initargs=(settings.ML_POOL_THREADS_PER_WORKER,)
+            )
+            logger.info(f"ML process pool started: {workers} processes, {settings.ML_POOL_THREADS_PER_WORKER} thread(s) each")
+        return _pool
+
+
+def warm_ml_pool() -> None:
+    """Запустить все процессы пула заранее, чтобы модели загрузились до первых задач"""
+    pool = get_ml_pool()
+    if pool is None:
+        return
+    workers = settings.ML_POOL_WORKERS or os.cpu_count() or 1
+    for _ in range(workers):
+        pool.submit(_ping)
+    logger.info(f"ML process pool warming up {workers} processes")
+
+
+def shutdown_ml_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def _restart_pool(pool: ProcessPoolExecutor, kill: bool = False) -> None:
+    """
+    Убрать пул, следующий вызов создаст новый
+
+    kill=True - завершить процессы пула: зависший вызов иначе держит процесс навсегда,
+    shutdown его не прерывает. Вызовы других потоков в этом пуле получат BrokenProcessPool
+    и повторятся в новом пуле.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    processes = list((getattr(pool, '_processes', None) or {}).values()) if kill else []
+    try:
+        pool.shutdown(wait=False, cancel_futures=True)
+    except Exception:
+        pass
+    for process in processes:
+        try:
+            if process.is_alive():
+                process.kill()
+        except Exception as e:
+            logger.warning(f"ML pool: failed to kill process {process.pid}: {str(e)}")
+
+
+def _call(fn, *args):
+    """
+    Выполнить fn в пуле; без пула - в текущем процессе
+
+    Если пул сломался (процесс упал: OOM, segfault в onnxruntime), пул пересоздается и вызов
+    повторяется в нем один раз - в процессе воркера модели не загружаются. При таймауте
+    процессы пула завершаются, пул пересоздается, наружу уходит FuturesTimeoutError.
+    """
+    for attempt in range(2):
+        pool = get_ml_pool()
+        if pool is None:
+            return fn(*args)
+        try:
+            return pool.submit(fn, *args).result(timeout=settings.ML_POOL_TIMEOUT)
+        except FuturesTimeoutError:
+            logger.error(f"ML process pool call timed out after {settings.ML_POOL_TIMEOUT}s, restarting the pool")
+            _restart_pool(pool, kill=True)
+            raise
+        except BrokenProcessPool as e:
+            _restart_pool(pool)
+            if attempt:
+                raise
+            logger.error(f"ML process pool is broken, restarting it and retrying: {str(e)}")
+
+
+_signatures: Dict[str, str] = {}
+
+
+def _cache_signature(kind: str) -> Optional[str]:
+    """Сигнатура модели из процесса, где она загружена (запрашивается один раз)"""
+    signature = _signatures.get(kind)
+    if signature is None:
+        try:
+            signature = _call(_run_cache_signature, kind)
+        except Exception as e:
+            logger.warning(f"ML cache: failed to get {kind} model signature, cache is bypassed: {str(e)}")
+            return None
+        _signatures[kind] = signature
+    return signature
+
+
+def _cache_key(kind: str, image_path: str, extra: str = "") -> Optional[str]:
+    """Ключ кэша для файла, None если кэш выключен или недоступен"""
+    from utils.ml_cache import get_ml_cache, make_key
+    from utils.photo_checkpoints import content_hash
+
+    if get_ml_cache() is None:
+        return None
+    signature = _cache_signature(kind)
+    if signature is None:
+        return None
+    try:
+        image_hash = content_hash(image_path)
+    except OSError:
+        return None
+    return make_key(kind, image_hash, signature, extra) if image_hash else None
+
+
+def _cache_get(key: Optional[str]):
+    from utils.ml_cache import get_ml_cache
+
+    if key is None:
+        return None
+    try:
+        return get_ml_cache().get(key)
+    except Exception as e:
+        logger.warning(f"ML cache: lookup failed: {str(e)}")
+        return None
+
+
+def _cache_put(key: Optional[str], value) -> None:
+    from utils.ml_cache import get_ml_cache
+
+    if key is None:
+        return
+    try:
+        get_ml_cache().put(key, value)
+    except Exception as e:
+        logger.warning(f"ML cache: failed to store entry: {str(e)}")
+
+
+def extract_faces_batch(image_paths: List[str]) -> List[Optional[List[Dict]]]:
+    """
+    Пакетное извлечение лиц в пуле процессов (см. FaceRecognition.extract_faces_batch)
+
+    Фото, которые уже есть в кэше, в пул не отправляются.
+    Returns: для каждого пути - список лиц или None, если фото не удалось обработать
+    """
+    from utils.ml_cache import decode_faces, encode_faces
+
+    image_paths = list(image_paths)
+    results: List[Optional[List[Dict]]] = [None] * len(image_paths)
+    keys = [_cache_key('faces', path) for path in image_paths]
+    misses = []
+    for i, key in enumerate(keys):
+        cached = _cache_get(key)
+        if cached is not None:
+            results[i] = decode_faces(cached)
+        else:
+            misses.append(i)
+    if len(misses) < len(image_paths):
+        logger.info(f"ML cache: {len(image_paths) - len(misses)} of {len(image_paths)} photos found for face extraction")
+    if not misses:
+        return results
+
+    try:
+        extracted = _call(_run_extract_faces_batch, [image_paths[i] for i in misses])
+    except FuturesTimeoutError:
+        logger.error(f"Face extraction timed out after {settings.ML_POOL_TIMEOUT}s for batch of {len(misses)} photos")
+        return results
+    except Exception as e:
+        logger.error(f"Error extracting faces for batch of {len(misses)} photos: {str(e)}", exc_info=True)
+        return results
+
+    for i, faces in zip(misses, extracted):
+        results[i] = faces
+        # Неудачи (None) не кэшируются - при следующем запуске фото обработается снова
+        if faces is not None:
+            _cache_put(keys[i], encode_faces(faces))
+    return results
+
+
+def extract_numbers(image_path: str, face_bboxes: Optional[List] = None) -> List[str]:
+    """Распознавание номеров в пуле процессов (см. NumberRecognition.extract), с кэшем"""
+    import json
+
+    # Зоны поиска номера зависят от bbox лиц, поэтому они входят в ключ
+    key = _cache_key('numbers', image_path, json.dumps(face_bboxes or [], sort_keys=True))
+    cached = _cache_get(key)
+    if cached is not None:
+        logger.info(f"ML cache: numbers for {image_path} found in cache")
+        return cached
+    try:
+        numbers = _call(_run_extract_numbers, image_path, face_bboxes)
+    except FuturesTimeoutError:
+        raise TimeoutError(f"Number extraction timed out after {settings.ML_POOL_TIMEOUT}s for {image_path}")
+    _cache_put(key, list(numbers or []))
+    return numbers
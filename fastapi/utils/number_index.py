@@ -0,0 +1,282 @@
+"""
+Инвертированный индекс стартовых номеров для search_by_numbers
+
+Номера фотографий события хранятся в {NUMBER_INDEX_PATH}/{event_id}.json
+({photo_id: [номера]}), process_event_photos дописывает их по мере распознавания.
+В памяти по ним строятся:
+- exact: номер (только цифры) -> вхождения, для точного совпадения
+- substrings: все подстроки номеров длиной от 2 цифр -> вхождения, для "partial"
+  (запрос содержится в номере фото); обратный случай (номер фото содержится в запросе)
+  ищется перебором подстрок запроса по exact
+- segments: номер длины L режется на max_hamming_distance(L) + 1 частей -> вхождения,
+  для "similar" (расстояние Хэмминга между номерами одинаковой длины): при допустимом
+  числе ошибок хотя бы одна часть совпадает точно, кандидаты затем проверяются
+
+Правила совпадений и их приоритет те же, что были у полного перебора в search_by_numbers.
+"""
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.config import settings
+from utils.index_files import IndexLock, atomic_save
+
+logger = logging.getLogger(__name__)
+
+MATCH_RANK = {"exact": 0, "partial": 1, "similar": 2}
+
+
+def clean_number(value: Any) -> str:
+    """Оставить только цифры (как при сравнении в search_by_numbers)"""
+    return ''.join(c for c in str(value) if c.isdigit())
+
+
+def max_hamming_distance(length: int) -> int:
+    """Допустимое число ошибок OCR для номеров одинаковой длины"""
+    # 3-4 цифры: 1 ошибка, 5-6 цифр: 2 ошибки, 7+: до 20% цифр
+    return 1 if length <= 4 else (2 if length <= 6 else max(1, length // 5))
+
+
+def _segment_keys(number: str) -> List[Tuple[int, int, str]]:
+    """Ключи (длина, номер части, часть) для поиска номеров в пределах max_hamming_distance"""
+    length = len(number)
+    parts = max_hamming_distance(length) + 1
+    bounds = [length * i // parts for i in range(parts + 1)]
+    return [(length, i, number[bounds[i]:bounds[i + 1]]) for i in range(parts)]
+
+
+class NumberIndex:
+    """In-memory индекс номеров набора фотографий"""
+
+    def __init__(self, photos: Dict[str, List]):
+        self.photo_ids: List[str] = []
+        self.numbers: List[List] = []
+        # (индекс фото, позиция номера в Photo.numbers)
+        self.exact: Dict[str, List[Tuple[int, int]]] = {}
+        self.substrings: Dict[str, List[Tuple[int, int]]] = {}
+        self.segments: Dict[Tuple[int, int, str], List[Tuple[int, int]]] = {}
+        self._cleaned: List[List[str]] = []
+
+        for photo_id, numbers in photos.items():
+            if not isinstance(numbers, list) or not numbers:
+                continue
+            photo_idx = len(self.photo_ids)
+            self.photo_ids.append(str(photo_id))
+            self.numbers.append(numbers)
+            cleaned_numbers = []
+            for position, number in enumerate(numbers):
+                cleaned = clean_number(number)
+                cleaned_numbers.append(cleaned)
+                if not cleaned:
+                    continue
+                entry = (photo_idx, position)
+                self.exact.setdefault(cleaned, []).append(entry)
+                if len(cleaned) >= 2:
+                    for substring in {cleaned[i:j] for i in range(len(cleaned)) for j in range(i + 2, len(cleaned) + 1)}:
+                        self.substrings.setdefault(substring, []).append(entry)
+                if len(cleaned) >= 3:
+                    for key in _segment_keys(cleaned):
+                        self.segments.setdefault(key, []).append(entry)
+            self._cleaned.append(cleaned_numbers)
+
+    @property
+    def photos_count(self) -> int:
+        return len(self.photo_ids)
+
+    def _similar_entries(self, query: str) -> List[Tuple[int, int]]:
+        max_diff = max_hamming_distance(len(query))
+        candidates = set()
+        for key in _segment_keys(query):
+            candidates.update(self.segments.get(key, ()))
+        return [
+            (photo_idx, position) for photo_idx, position in candidates
+            if sum(1 for a, b in zip(query, self._cleaned[photo_idx][position]) if a != b) <= max_diff
+        ]
+
+    def search(self, query_numbers: List) -> List[Dict]:
+        """
+        Найти фото по распознанным номерам запроса
+
+        Для каждого фото берется первое совпадение в порядке (номер запроса, номер фото),
+        как в прежнем переборе. Результаты отсортированы: exact, partial, similar.
+        """
+        best: Dict[int, Tuple[Tuple[int, int], str, Any, Any]] = {}
+
+        for query_idx, query_num in enumerate(query_numbers):
+            query = clean_number(query_num)
+            if not query:
+                continue
+
+            matches: Dict[Tuple[int, int], str] = {}
+            if len(query) >= 3:
+                for entry in self._similar_entries(query):
+                    matches[entry] = "similar"
+            if len(query) >= 2:
+                # Запрос содержится в номере фото
+                for entry in self.substrings.get(query, ()):
+                    matches[entry] = "partial"
+                # Номер фото содержится в запросе
+                for i in range(len(query)):
+                    for j in range(i + 2, len(query) + 1):
+                        for entry in self.exact.get(query[i:j], ()):
+                            matches[entry] = "partial"
+            for entry in self.exact.get(query, ()):
+                matches[entry] = "exact"
+
+            for (photo_idx, position), match_type in matches.items():
+                key = (query_idx, position)
+                current = best.get(photo_idx)
+                if current is None or key < current[0]:
+                    best[photo_idx] = (key, match_type, self.numbers[photo_idx][position], query_num)
+
+        ordered = sorted(best.items(), key=lambda item: (MATCH_RANK[item[1][1]], item[0]))
+        return [
+            {
+                "photo_id": self.photo_ids[photo_idx],
+                "matched_number": matched_number,
+                "query_number": query_num,
+                "match_type": match_type
+            }
+            for photo_idx, (_, match_type, matched_number, query_num) in ordered
+        ]
+
+
+def _event_index_path(event_id: str, index_path: Optional[str] = None) -> str:
+    return os.path.join(index_path or settings.NUMBER_INDEX_PATH, f"{event_id}.json")
+
+
+def _read_event_numbers(path: str) -> Dict[str, List]:
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return data if isinstance(data, dict) else {}
+
+
+def _write_event_numbers(path: str, photos: Dict[str, List]) -> None:
+    atomic_save(path, lambda f: f.write(json.dumps(photos, ensure_ascii=False).encode('utf-8')))
+
+
+def update_event_numbers(event_id: str, updates: Dict[Any, List], index_path: Optional[str] = None) -> int:
+    """
+    Заменить номера указанных фотографий в индексе события (пустой список убирает фото)
+
+    Returns: число фото с номерами в индексе события
+    """
+    index_path = index_path or settings.NUMBER_INDEX_PATH
+    path = _event_index_path(event_id, index_path)
+    with IndexLock(index_path):
+        photos = {}
+        if os.path.exists(path):
+            try:
+                photos = _read_event_numbers(path)
+            except Exception as e:
+                logger.warning(f"Number index {path} is unreadable, rebuilding it: {str(e)}")
+        for photo_id, numbers in updates.items():
+            if numbers:
+                photos[str(photo_id)] = list(numbers)
+            else:
+                photos.pop(str(photo_id), None)
+        _write_event_numbers(path, photos)
+    return len(photos)
+
+
+class NumberIndexWriter:
+    """
+    Буфер записи номеров одного события в индекс (как FaceIndexWriter для лиц)
+
+    Ошибки индекса логируются и не прерывают обработку.
+    """
+
+    def __init__(self, event_id: str, flush_every: Optional[int] = None, index_path: Optional[str] = None):
+        self.event_id = str(event_id)
+        self.flush_every = flush_every or settings.NUMBER_INDEX_FLUSH_EVERY
+        self.index_path = index_path or settings.NUMBER_INDEX_PATH
+        self._pending: Dict[str, List] = {}
+
+    def add(self, photo_id: Any, numbers: List) -> None:
+        if not settings.NUMBER_INDEX_ENABLED:
+            return
+        self._pending[str(photo_id)] = list(numbers or [])
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            count = update_event_numbers(self.event_id, pending, self.index_path)
+            logger.info(f"Number index: flushed {len(pending)} photos for event {self.event_id}, photos in index={count}")
+        except Exception as e:
+            logger.error(f"Number index: failed to flush event {self.event_id}: {str(e)}", exc_info=True)
+
+
+def _load_numbers_from_db(db, event_id: Optional[str] = None) -> Dict[str, List]:
+    from app.models import Photo
+
+    query = db.query(Photo.id, Photo.numbers).filter(Photo.numbers.isnot(None))
+    if event_id:
+        query = query.filter(Photo.event_id == event_id)
+    return {
+        str(photo_id): numbers
+        for photo_id, numbers in query.yield_per(1000)
+        if isinstance(numbers, list) and numbers
+    }
+
+
+_cache: Dict[str, Tuple[Tuple[int, int], NumberIndex]] = {}
+_cache_lock = threading.Lock()
+
+
+def _file_signature(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def peek_event_number_index(event_id: str) -> Optional[NumberIndex]:
+    """Индекс события, только если он уже загружен в этом процессе и актуален (без чтения файла и БД)"""
+    cached = _cache.get(str(event_id))
+    if cached and cached[0] == _file_signature(_event_index_path(str(event_id))):
+        return cached[1]
+    return None
+
+
+def get_event_number_index(db, event_id: Optional[str] = None) -> NumberIndex:
+    """
+    Индекс номеров события: из кэша процесса, файла индекса или (если файла нет) из БД
+
+    Без event_id индекс строится из БД по всем событиям и не кэшируется.
+    Файл события, которого еще нет (события до появления индекса), создается из БД.
+    """
+    if not event_id or not settings.NUMBER_INDEX_ENABLED:
+        return NumberIndex(_load_numbers_from_db(db, event_id))
+
+    event_id = str(event_id)
+    path = _event_index_path(event_id)
+    if not os.path.exists(path):
+        photos = _load_numbers_from_db(db, event_id)
+        try:
+            with IndexLock(settings.NUMBER_INDEX_PATH):
+                if not os.path.exists(path):
+                    _write_event_numbers(path, photos)
+            logger.info(f"Number index for event {event_id} built from database: {len(photos)} photos")
+        except Exception as e:
+            logger.error(f"Number index: failed to save index for event {event_id}: {str(e)}", exc_info=True)
+            return NumberIndex(photos)
+
+    signature = _file_signature(path)
+    cached = _cache.get(event_id)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    with _cache_lock:
+        cached = _cache.get(event_id)
+        if cached and cached[0] == signature:
+            return cached[1]
+        index = NumberIndex(_read_event_numbers(path))
+        _cache[event_id] = (signature, index)
+        return index
@@ -1,8 +1,9 @@
 import easyocr
 import cv2
 import numpy as np
-from typing import List
+from typing import Callable, List, Optional
 from app.config import settings
+from utils.image_loader import load_image
 import logging
 import os
 import sys
@@ -10,6 +11,15 @@ import itertools
 
 logger = logging.getLogger(__name__)
 
+# Двухэтапный режим: зона поиска номера относительно bbox лица (в ширинах/высотах лица)
+TORSO_SIDE_FACTOR = 1.5  # Насколько зона шире лица с каждой стороны
+TORSO_HEIGHT_FACTOR = 4.0  # Насколько зона уходит вниз от подбородка
+# bbox лиц хранятся в координатах изображения, уменьшенного до 1280px (FaceRecognition._prepare_image)
+FACE_BBOX_MAX_SIDE = 1280
+# Размеры, до которых увеличиваются изображения перед детекцией текста и вырезанные области перед распознаванием
+DETECT_MIN_SIDE = 1000
+CROP_MIN_SIDE = 64
+
 # КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Singleton для NumberRecognition
 # EasyOCR должен быть singleton на процесс, иначе модель инициализируется каждый раз заново
 _number_recognition_instance = None
@@ -65,10 +75,22 @@ class NumberRecognition:
             self.logger.error(f"Failed to initialize EasyOCR: {str(e)}", exc_info=True)
             raise
     
-    def _preprocess_image(self, img: np.ndarray) -> List[tuple]:
+    def cache_signature(self) -> str:
+        """Модель и параметры, от которых зависит результат (ключ кэша utils.ml_cache)"""
+        return (
+            f"easyocr={easyocr.__version__};languages={','.join(settings.easyocr_languages_list)};"
+            f"two_stage={settings.OCR_TWO_STAGE};max_regions={settings.OCR_MAX_TEXT_REGIONS};"
+            f"torso={TORSO_SIDE_FACTOR}x{TORSO_HEIGHT_FACTOR};detect_min_side={DETECT_MIN_SIDE};"
+            f"crop_min_side={CROP_MIN_SIDE};detect_max_side={settings.OCR_DETECT_MAX_SIDE};"
+            f"draft_decode={settings.ML_DRAFT_DECODE}"
+        )
+    
+    def _preprocess_image(self, img: np.ndarray, min_side: int = DETECT_MIN_SIDE) -> List[tuple]:
         """
         Предобработка изображения для улучшения распознавания номеров
         Возвращает список кортежей (обработанное_изображение, описание_метода)
+        
+        min_side: маленькие изображения увеличиваются, пока обе стороны не станут не меньше min_side
         """
         processed_images = []
         
@@ -80,9 +102,9 @@ class NumberRecognition:
         
         # Метод 1: Оригинальное изображение (увеличенное для лучшего распознавания)
         h, w = gray.shape
-        if h < 1000 or w < 1000:
+        if h < min_side or w < min_side:
             # Увеличиваем маленькие изображения для лучшего распознавания
-            scale = max(1000 / h, 1000 / w)
+            scale = max(min_side / h, min_side / w)
             new_h, new_w = int(h * scale), int(w * scale)
             gray_large = cv2.resize(gray, (new_w, new_h), interpolation=cv2.INTER_CUBIC)
             processed_images.append((gray_large, "original_large"))
@@ -97,8 +119,8 @@ class NumberRecognition:
             adaptive_thresh = cv2.adaptiveThreshold(
                 gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, block_size, 2
             )
-            if adaptive_thresh.shape[0] < 1000 or adaptive_thresh.shape[1] < 1000:
-                scale = max(1000 / adaptive_thresh.shape[0], 1000 / adaptive_thresh.shape[1])
+            if adaptive_thresh.shape[0] < min_side or adaptive_thresh.shape[1] < min_side:
+                scale = max(min_side / adaptive_thresh.shape[0], min_side / adaptive_thresh.shape[1])
                 new_h, new_w = int(adaptive_thresh.shape[0] * scale), int(adaptive_thresh.shape[1] * scale)
                 adaptive_thresh = cv2.resize(adaptive_thresh, (new_w, new_h), interpolation=cv2.INTER_CUBIC)
             processed_images.append((adaptive_thresh, "adaptive_thresh"))
@@ -109,8 +131,8 @@ class NumberRecognition:
         try:
             clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
             clahe_img = clahe.apply(gray)
-            if clahe_img.shape[0] < 1000 or clahe_img.shape[1] < 1000:
-                scale = max(1000 / clahe_img.shape[0], 1000 / clahe_img.shape[1])
+            if clahe_img.shape[0] < min_side or clahe_img.shape[1] < min_side:
+                scale = max(min_side / clahe_img.shape[0], min_side / clahe_img.shape[1])
                 new_h, new_w = int(clahe_img.shape[0] * scale), int(clahe_img.shape[1] * scale)
                 clahe_img = cv2.resize(clahe_img, (new_w, new_h), interpolation=cv2.INTER_CUBIC)
             processed_images.append((clahe_img, "clahe"))
@@ -125,8 +147,8 @@ class NumberRecognition:
             morph = cv2.morphologyEx(gray, cv2.MORPH_CLOSE, kernel)
             # Улучшаем контраст
             morph = cv2.convertScaleAbs(morph, alpha=1.5, beta=30)
-            if morph.shape[0] < 1000 or morph.shape[1] < 1000:
-                scale = max(1000 / morph.shape[0], 1000 / morph.shape[1])
+            if morph.shape[0] < min_side or morph.shape[1] < min_side:
+                scale = max(min_side / morph.shape[0], min_side / morph.shape[1])
                 new_h, new_w = int(morph.shape[0] * scale), int(morph.shape[1] * scale)
                 morph = cv2.resize(morph, (new_w, new_h), interpolation=cv2.INTER_CUBIC)
             processed_images.append((morph, "morphology"))
@@ -139,8 +161,8 @@ class NumberRecognition:
                                       [-1,  9, -1],
                                       [-1, -1, -1]])
             sharpened = cv2.filter2D(gray, -1, kernel_sharpen)
-            if sharpened.shape[0] < 1000 or sharpened.shape[1] < 1000:
-                scale = max(1000 / sharpened.shape[0], 1000 / sharpened.shape[1])
+            if sharpened.shape[0] < min_side or sharpened.shape[1] < min_side:
+                scale = max(min_side / sharpened.shape[0], min_side / sharpened.shape[1])
                 new_h, new_w = int(sharpened.shape[0] * scale), int(sharpened.shape[1] * scale)
                 sharpened = cv2.resize(sharpened, (new_w, new_h), interpolation=cv2.INTER_CUBIC)
             processed_images.append((sharpened, "sharpened"))
@@ -149,80 +171,215 @@ class NumberRecognition:
         
         return processed_images
     
-    def extract(self, image_path: str) -> List[str]:
+    def extract(self, image_path: str, face_bboxes: Optional[List] = None) -> List[str]:
         """
         Извлечь номера с изображения
         
+        face_bboxes: bbox лиц этой фотографии (Photo.face_bboxes), если уже известны -
+            в двухэтапном режиме текст сначала ищется под лицами
         Returns: список найденных номеров
         """
         try:
             self.logger.info(f"Starting number extraction from: {image_path}")
             
             # Проверяем, что файл существует
-            import os
             if not os.path.exists(image_path):
                 self.logger.error(f"Image file not found: {image_path}")
                 return []
             
-            # Загружаем изображение
-            img = cv2.imread(image_path)
+            # OCR работает с яркостью: декодируем только ее, для двухэтапного режима - в размере
+            # детекции; полное разрешение читается позже и только для мелких областей текста
+            full_res = None
+            if settings.OCR_TWO_STAGE:
+                img = load_image(image_path, max_side=settings.OCR_DETECT_MAX_SIDE, grayscale=True)
+                if img is not None and max(img.shape[:2]) >= settings.OCR_DETECT_MAX_SIDE:
+                    full_res = lambda: load_image(image_path, grayscale=True)
+            else:
+                img = load_image(image_path, grayscale=True)
             if img is None:
                 self.logger.error(f"Failed to load image: {image_path}")
                 return []
-            
-            # Предобрабатываем изображение несколькими методами
-            processed_images = self._preprocess_image(img)
-            self.logger.info(f"Created {len(processed_images)} preprocessed image variants")
-            
-            # Сохраняем обработанные изображения во временные файлы
-            import tempfile
-            temp_files = []
+        except Exception as e:
+            self.logger.error(f"Error extracting numbers from {image_path}: {str(e)}", exc_info=True)
+            return []
+        
+        return self.extract_from_array(img, source=image_path, face_bboxes=face_bboxes, full_res=full_res)
+    
+    def _read_variants(self, processed_images: List[tuple]) -> List[tuple]:
+        """
+        Распознать текст на всех вариантах предобработки
+        
+        Варианты передаются в EasyOCR как numpy массивы - без записи во временные
+        JPEG и повторного декодирования (и без потерь JPEG на бинаризованных вариантах)
+        
+        Returns: список (bbox, text, confidence, method_name)
+        """
+        from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+        timeout_seconds = 20  # Таймаут на каждый вариант
+        all_results = []
+        
+        for processed_img, method_name in processed_images:
             try:
-                for processed_img, method_name in processed_images:
-                    temp_fd, temp_path = tempfile.mkstemp(suffix='.jpg', prefix=f'ocr_{method_name}_')
-                    os.close(temp_fd)
-                    cv2.imwrite(temp_path, processed_img)
-                    temp_files.append((temp_path, method_name))
-                    self.logger.debug(f"Saved preprocessed image: {temp_path} (method: {method_name})")
-            
-                # Распознаем текст на всех обработанных изображениях
-                from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
-                timeout_seconds = 20  # Уменьшили таймаут для каждого варианта
-                all_results = []
-                
-                for temp_path, method_name in temp_files:
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    future = executor.submit(
+                        self.reader.readtext, processed_img, detail=1, paragraph=False
+                    )
                     try:
-                        def read_text():
-                            return self.reader.readtext(temp_path, detail=1, paragraph=False)
-                        
-                        with ThreadPoolExecutor(max_workers=1) as executor:
-                            future = executor.submit(read_text)
-                            try:
-                                results = future.result(timeout=timeout_seconds)
-                                if results:
-                                    self.logger.info(f"EasyOCR found {len(results)} text regions using {method_name}")
-                                    # Добавляем информацию о методе к каждому результату
-                                    for result in results:
-                                        if len(result) >= 3:
-                                            all_results.append((*result, method_name))
-                            except FuturesTimeoutError:
-                                self.logger.warning(f"EasyOCR timeout on {method_name} after {timeout_seconds}s, skipping")
-                                future.cancel()
-                            except Exception as e:
-                                self.logger.warning(f"Error in OCR for {method_name}: {str(e)}")
+                        results = future.result(timeout=timeout_seconds)
+                        if results:
+                            self.logger.info(f"EasyOCR found {len(results)} text regions using {method_name}")
+                            # Добавляем информацию о методе к каждому результату
+                            for result in results:
+                                if len(result) >= 3:
+                                    all_results.append((*result, method_name))
+                    except FuturesTimeoutError:
+                        self.logger.warning(f"EasyOCR timeout on {method_name} after {timeout_seconds}s, skipping")
+                        future.cancel()
                     except Exception as e:
-                        self.logger.warning(f"Error processing {method_name}: {str(e)}")
-                
-                self.logger.info(f"Total text regions found across all methods: {len(all_results)}")
+                        self.logger.warning(f"Error in OCR for {method_name}: {str(e)}")
+            except Exception as e:
+                self.logger.warning(f"Error processing {method_name}: {str(e)}")
+        
+        return all_results
+    
+    def _torso_regions(self, shape: tuple, face_bboxes: Optional[List]) -> List[tuple]:
+        """
+        Зоны под лицами, где обычно находится стартовый номер: (x1, y1, x2, y2) в пикселях изображения
+        """
+        h, w = shape[:2]
+        # bbox лиц посчитаны на изображении, уменьшенном до FACE_BBOX_MAX_SIDE
+        scale = max(h, w) / FACE_BBOX_MAX_SIDE if max(h, w) > FACE_BBOX_MAX_SIDE else 1.0
+        regions = []
+        for bbox in face_bboxes or []:
+            try:
+                fx1, fy1, fx2, fy2 = [float(v) * scale for v in bbox[:4]]
+            except (TypeError, ValueError):
+                continue
+            face_w, face_h = fx2 - fx1, fy2 - fy1
+            if face_w <= 0 or face_h <= 0:
+                continue
+            x1 = max(0, int(fx1 - face_w * TORSO_SIDE_FACTOR))
+            x2 = min(w, int(fx2 + face_w * TORSO_SIDE_FACTOR))
+            y1 = max(0, int(fy2))
+            y2 = min(h, int(fy2 + face_h * TORSO_HEIGHT_FACTOR))
+            if x2 - x1 >= 8 and y2 - y1 >= 8:
+                regions.append((x1, y1, x2, y2))
+        return regions
+    
+    def _detect_text_boxes(self, gray: np.ndarray, region: tuple) -> List[tuple]:
+        """
+        Один проход детектора EasyOCR по области изображения
+        
+        Returns: список (x1, y1, x2, y2) найденных текстовых областей в координатах всего изображения
+        """
+        rx1, ry1, rx2, ry2 = region
+        roi = gray[ry1:ry2, rx1:rx2]
+        # Маленькие области увеличиваем так же, как полные кадры в _preprocess_image
+        mag_ratio = max(1.0, DETECT_MIN_SIDE / max(roi.shape[:2]))
+        horizontal_list, free_list = self.reader.detect(roi, mag_ratio=mag_ratio)
+        
+        boxes = []
+        for x_min, x_max, y_min, y_max in (horizontal_list[0] if horizontal_list else []):
+            boxes.append((x_min, y_min, x_max, y_max))
+        for points in (free_list[0] if free_list else []):
+            xs = [p[0] for p in points]
+            ys = [p[1] for p in points]
+            boxes.append((min(xs), min(ys), max(xs), max(ys)))
+        
+        h, w = gray.shape[:2]
+        result = []
+        for x1, y1, x2, y2 in boxes:
+            x1, x2 = max(0, int(x1) + rx1), min(w, int(x2) + rx1)
+            y1, y2 = max(0, int(y1) + ry1), min(h, int(y2) + ry1)
+            if x2 - x1 >= 4 and y2 - y1 >= 4:
+                result.append((x1, y1, x2, y2))
+        return result
+    
+    def _read_text_regions(self, img: np.ndarray, face_bboxes: Optional[List] = None,
+                           full_res: Optional[Callable[[], Optional[np.ndarray]]] = None) -> List[tuple]:
+        """
+        Двухэтапное распознавание: детекция текста один раз, затем варианты предобработки
+        и распознаватель только на вырезанных текстовых областях
+        
+        Детекция сначала идет по зонам под лицами (если есть face_bboxes), при пустом
+        результате - по всему кадру.
+        full_res: загрузка полного разрешения, если img уменьшен; вызывается один раз и только
+            когда есть области ниже CROP_MIN_SIDE - их вырезаем из полного кадра, а не увеличиваем
+        Returns: список (bbox, text, confidence, method_name) как в _read_variants
+        """
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if len(img.shape) == 3 else img
+        h, w = gray.shape[:2]
+        
+        boxes = []
+        torso_regions = self._torso_regions(gray.shape, face_bboxes)
+        for region in torso_regions:
+            boxes.extend(self._detect_text_boxes(gray, region))
+        if torso_regions:
+            self.logger.info(f"Text detection in {len(torso_regions)} torso region(s): {len(boxes)} text box(es)")
+        if not boxes:
+            boxes = self._detect_text_boxes(gray, (0, 0, w, h))
+            self.logger.info(f"Text detection on full frame: {len(boxes)} text box(es)")
+        
+        # Самые крупные области - наиболее вероятные номера
+        boxes = sorted(set(boxes), key=lambda b: (b[2] - b[0]) * (b[3] - b[1]), reverse=True)
+        boxes = boxes[:settings.OCR_MAX_TEXT_REGIONS]
+        
+        full = None  # Полный кадр: None - еще не читали, False - не нужен (img не уменьшен) или не прочитался
+        all_results = []
+        for x1, y1, x2, y2 in boxes:
+            # Небольшой отступ, чтобы не обрезать края цифр
+            pad = max(2, (y2 - y1) // 10)
+            crop = gray[max(0, y1 - pad):min(h, y2 + pad), max(0, x1 - pad):min(w, x2 + pad)]
+            if full_res is not None and full is not False and min(crop.shape[:2]) < CROP_MIN_SIDE:
+                if full is None:
+                    full = full_res()
+                    if full is None or full.shape[:2] == gray.shape[:2]:
+                        full = False
+                    elif full.ndim == 3:
+                        full = cv2.cvtColor(full, cv2.COLOR_BGR2GRAY)
+                if full is not False:
+                    fh, fw = full.shape[:2]
+                    sx, sy = fw / w, fh / h
+                    crop = full[max(0, int((y1 - pad) * sy)):min(fh, int((y2 + pad) * sy)),
+                                max(0, int((x1 - pad) * sx)):min(fw, int((x2 + pad) * sx))]
+            for variant, method_name in self._preprocess_image(crop, min_side=CROP_MIN_SIDE):
+                vh, vw = variant.shape[:2]
+                try:
+                    results = self.reader.recognize(
+                        variant, horizontal_list=[[0, vw, 0, vh]], free_list=[],
+                        detail=1, paragraph=False
+                    )
+                except Exception as e:
+                    self.logger.warning(f"Error in OCR for region {(x1, y1, x2, y2)} ({method_name}): {str(e)}")
+                    continue
+                for result in results:
+                    if len(result) >= 3:
+                        all_results.append(([[x1, y1], [x2, y1], [x2, y2], [x1, y2]], result[1], result[2], f"region_{method_name}"))
+        return all_results
+    
+    def extract_from_array(self, img: np.ndarray, source: str = "<array>",
+                           face_bboxes: Optional[List] = None,
+                           full_res: Optional[Callable[[], Optional[np.ndarray]]] = None) -> List[str]:
+        """
+        Извлечь номера из уже декодированного изображения (BGR или grayscale)
+        
+        source: используется только в логах
+        face_bboxes: bbox лиц для двухэтапного режима (см. extract)
+        full_res: загрузка полного разрешения, если img уменьшен (см. _read_text_regions)
+        Returns: список найденных номеров
+        """
+        try:
+            if settings.OCR_TWO_STAGE:
+                # Детекция один раз, варианты предобработки - только на найденных областях
+                all_results = self._read_text_regions(img, face_bboxes, full_res)
+            else:
+                # Предобрабатываем изображение несколькими методами
+                processed_images = self._preprocess_image(img)
+                self.logger.info(f"Created {len(processed_images)} preprocessed image variants")
                 
-            finally:
-                # Удаляем все временные файлы
-                for temp_path, _ in temp_files:
-                    if os.path.exists(temp_path):
-                        try:
-                            os.unlink(temp_path)
-                        except:
-                            pass
+                # Распознаем текст на всех обработанных изображениях прямо из памяти
+                all_results = self._read_variants(processed_images)
+            self.logger.info(f"Total text regions found across all methods: {len(all_results)}")
             
             # Фильтруем и обрабатываем результаты
             numbers = []
@@ -284,7 +441,7 @@ class NumberRecognition:
             return filtered_numbers
             
         except Exception as e:
-            self.logger.error(f"Error extracting numbers from {image_path}: {str(e)}", exc_info=True)
+            self.logger.error(f"Error extracting numbers from {source}: {str(e)}", exc_info=True)
             return []
     
     def _clean_number(self, text: str) -> str:
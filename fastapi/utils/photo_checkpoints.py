@@ -0,0 +1,169 @@
+"""
+Контрольные точки шагов обработки фотографий
+
+Повторный запуск process_event_photos (мягкий таймаут, падение воркера с task_acks_late,
+перезапуск из Laravel) раньше заново делал EXIF, водяной знак, лица и OCR для всех фото.
+Теперь после успешной записи результатов шага в БД сохраняется отметка:
+
+    {"photo_id", "step", "version", "input": хэш входного файла, "output": {...}}
+
+Шаг пропускается, если отметка есть, хэш входного файла совпадает, версия шага та же,
+а результат на месте (файл существует, колонка в БД заполнена - проверяет вызывающий).
+
+Входом removeexif является исходный файл фото, входом остальных шагов - файл после
+removeexif. После успешного запуска photo.original_path указывает на результат removeexif,
+поэтому при повторе совпадает хэш выхода removeexif ("output.hash").
+
+Отметки хранятся в {PHOTO_CHECKPOINT_PATH}/{event_id}/{шард}.jsonl (шард - первые символы
+photo_id): часть читает только шарды своих фото, строки дописываются через O_APPEND.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Версия шага: увеличивается при изменении обработки, чтобы старые отметки не использовались
+STEP_VERSIONS = {
+    'removeexif': 1,
+    'watermark': 1,
+    'facesearch': 1,
+    'numbersearch': 1,
+}
+
+SHARD_PREFIX_LEN = 2
+
+_hash_cache: Dict[Tuple[str, int, int], str] = {}
+
+
+def content_hash(path: str) -> Optional[str]:
+    """
+    Хэш содержимого файла (BLAKE2b, 128 бит), None если файла нет
+
+    Хэш одного и того же файла (путь, размер, mtime) считается в процессе один раз.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    cached = _hash_cache.get(key)
+    if cached:
+        return cached
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    value = digest.hexdigest()
+    if len(_hash_cache) > 10000:
+        _hash_cache.clear()
+    _hash_cache[key] = value
+    return value
+
+
+class CheckpointStore:
+    """Отметки выполненных шагов фотографий одного события"""
+
+    def __init__(self, event_id: str, root: Optional[str] = None):
+        self.event_id = str(event_id)
+        self.root = os.path.join(root or settings.PHOTO_CHECKPOINT_PATH, self.event_id)
+        self._records: Dict[Tuple[str, str], dict] = {}
+        self._inputs: Dict[str, str] = {}
+        self._pending: Dict[str, list] = {}
+
+    def _shard_path(self, photo_id: str) -> str:
+        return os.path.join(self.root, f"{photo_id[:SHARD_PREFIX_LEN] or '_'}.jsonl")
+
+    def load(self, photo_ids: Iterable[Any]) -> int:
+        """Прочитать отметки указанных фото (поздние строки перекрывают ранние)"""
+        wanted = {str(photo_id) for photo_id in photo_ids}
+        loaded = 0
+        for shard in sorted({self._shard_path(photo_id) for photo_id in wanted}):
+            if not os.path.exists(shard):
+                continue
+            with open(shard, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Оборванная строка после падения процесса
+                        continue
+                    photo_id = record.get('photo_id')
+                    if photo_id in wanted and record.get('step') in STEP_VERSIONS:
+                        self._records[(photo_id, record['step'])] = record
+                        loaded += 1
+        return loaded
+
+    def get(self, photo_id: Any, step: str) -> Optional[dict]:
+        """Отметка шага текущей версии"""
+        record = self._records.get((str(photo_id), step))
+        if record and record.get('version') == STEP_VERSIONS[step]:
+            return record
+        return None
+
+    def done(self, photo_id: Any, step: str, input_hash: Optional[str] = None) -> Optional[dict]:
+        """Отметка шага, если он выполнен для того же входа (по умолчанию - вход, заданный set_input)"""
+        input_hash = input_hash or self._inputs.get(str(photo_id))
+        record = self.get(photo_id, step)
+        if input_hash and record and record.get('input') == input_hash:
+            return record
+        return None
+
+    def set_input(self, photo_id: Any, input_hash: Optional[str]) -> None:
+        """Хэш файла, который анализируют шаги после removeexif"""
+        if input_hash:
+            self._inputs[str(photo_id)] = input_hash
+        else:
+            self._inputs.pop(str(photo_id), None)
+
+    def mark(self, photo_id: Any, step: str, input_hash: Optional[str] = None, **output) -> None:
+        """Запомнить выполненный шаг; на диск отметка попадает в commit() после записи в БД"""
+        photo_id = str(photo_id)
+        input_hash = input_hash or self._inputs.get(photo_id)
+        if not input_hash:
+            return
+        record = {
+            'photo_id': photo_id,
+            'step': step,
+            'version': STEP_VERSIONS[step],
+            'input': input_hash,
+            'output': output,
+        }
+        self._pending.setdefault(photo_id, []).append(record)
+
+    def commit(self, written_ids: Set[str], failed_ids: Set[str] = frozenset()) -> int:
+        """
+        Записать отметки фото, чьи изменения сохранены в БД; отметки несохраненных фото отбросить
+
+        Returns: число записанных отметок
+        """
+        for photo_id in failed_ids:
+            self._pending.pop(str(photo_id), None)
+        by_shard: Dict[str, list] = {}
+        for photo_id in list(self._pending):
+            if photo_id not in written_ids:
+                continue
+            for record in self._pending.pop(photo_id):
+                self._records[(photo_id, record['step'])] = record
+                by_shard.setdefault(self._shard_path(photo_id), []).append(record)
+        if not by_shard:
+            return 0
+
+        os.makedirs(self.root, exist_ok=True)
+        count = 0
+        for shard, records in by_shard.items():
+            data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records).encode('utf-8')
+            fd = os.open(shard, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                # Части события могут писать в один шард одновременно
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+            count += len(records)
+        return count
@@ -0,0 +1,131 @@
+"""
+Отложенная запись колонок photos при обработке события
+
+Раньше каждый шаг каждой фотографии делал свой UPDATE + commit (original_path, custom_path,
+данные лиц, номера) и перечитывал строку - десятки тысяч обращений к Postgres на событие.
+PhotoWriteBuffer копит изменения по фотографиям и записывает их пакетно (bulk UPDATE по
+первичному ключу, executemany) каждые DB_WRITE_BATCH_SIZE фото или DB_WRITE_BATCH_SECONDS.
+Engine создан с executemany_mode='values_plus_batch' (app.database): psycopg2 отправляет
+UPDATE пакета страницами execute_batch, а не по запросу на строку.
+
+Сессия части открыта с expire_on_commit=False, поэтому объекты Photo после сброса
+не перечитываются и хранят старые значения: записанные значения отдает get().
+
+Буфер сбрасывается в конце части, при таймауте и ошибке части. Отметки выполненных шагов
+(utils.photo_checkpoints) записываются только после сохранения строк фото: если воркер умер
+до сброса, при повторе часть (task_acks_late) выполнит шаги этих фото заново.
+"""
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class PhotoWriteBuffer:
+    """Буфер изменений колонок photos одной части события"""
+
+    def __init__(self, db, flush_every: Optional[int] = None, flush_seconds: Optional[float] = None,
+                 checkpoints=None):
+        self.db = db
+        self.checkpoints = checkpoints
+        self.flush_every = flush_every or settings.DB_WRITE_BATCH_SIZE
+        self.flush_seconds = flush_seconds if flush_seconds is not None else settings.DB_WRITE_BATCH_SECONDS
+        self._pending: Dict[Any, Dict[str, Any]] = {}
+        # Уже записанные значения (объекты Photo в сессии их не видят)
+        self._written: Dict[Any, Dict[str, Any]] = {}
+        self._last_flush = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def set(self, photo_id: Any, **values) -> None:
+        """Запомнить новые значения колонок фотографии (поздние значения перекрывают ранние)"""
+        self._pending.setdefault(photo_id, {}).update(values)
+
+    def mark_step(self, photo_id: Any, step: str, **kwargs) -> None:
+        """Отметить выполненный шаг фото (запишется вместе с его колонками)"""
+        if self.checkpoints is not None:
+            self.checkpoints.mark(photo_id, step, **kwargs)
+
+    def _commit_checkpoints(self, written_ids, failed_ids=()) -> None:
+        if self.checkpoints is None:
+            return
+        try:
+            self.checkpoints.commit({str(photo_id) for photo_id in written_ids},
+                                    {str(photo_id) for photo_id in failed_ids})
+        except Exception as e:
+            logger.error(f"Photo writes: failed to save step checkpoints: {str(e)}", exc_info=True)
+
+    def get(self, photo_id: Any, column: str, default: Any = None) -> Any:
+        """Значение колонки, заданное через set() (записанное или еще нет), иначе default"""
+        for values in (self._pending.get(photo_id), self._written.get(photo_id)):
+            if values and column in values:
+                return values[column]
+        return default
+
+    def _remember(self, pending: Dict[Any, Dict[str, Any]], photo_ids) -> None:
+        for photo_id in photo_ids:
+            self._written.setdefault(photo_id, {}).update(pending[photo_id])
+
+    def due(self) -> bool:
+        if not self._pending:
+            return False
+        return (len(self._pending) >= self.flush_every
+                or time.monotonic() - self._last_flush >= self.flush_seconds)
+
+    def maybe_flush(self) -> int:
+        """Записать буфер, если набралось flush_every фото или прошло flush_seconds"""
+        return self.flush() if self.due() else 0
+
+    def _execute(self, rows: List[Dict[str, Any]]) -> None:
+        from sqlalchemy import update
+        from app.models import Photo
+
+        # Пакеты с одинаковым набором колонок - один executemany на пакет
+        groups: Dict[tuple, List[Dict[str, Any]]] = {}
+        for row in rows:
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+        for group in groups.values():
+            self.db.execute(update(Photo), group)
+
+    def flush(self) -> int:
+        """
+        Записать все накопленные изменения одной транзакцией
+
+        Если пакет не записался, строки пишутся по одной, чтобы одна плохая строка
+        не потеряла изменения остальных фото. Returns: число записанных фото
+        """
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        rows = [{'id': photo_id, **values} for photo_id, values in pending.items()]
+
+        start_time = time.time()
+        try:
+            self._execute(rows)
+            self.db.commit()
+            logger.info(f"Photo writes: flushed {len(rows)} photos in {time.time() - start_time:.3f} seconds")
+            self._remember(pending, pending)
+            self._commit_checkpoints(pending)
+            return len(rows)
+        except Exception as e:
+            logger.error(f"Photo writes: batch of {len(rows)} photos failed, writing one by one: {str(e)}", exc_info=True)
+            self.db.rollback()
+
+        written, failed = [], []
+        for row in rows:
+            try:
+                self._execute([row])
+                self.db.commit()
+                written.append(row['id'])
+            except Exception as e:
+                self.db.rollback()
+                failed.append(row['id'])
+                logger.error(f"Photo writes: failed to write photo {row['id']}: {str(e)}", exc_info=True)
+        self._remember(pending, written)
+        self._commit_checkpoints(written, failed)
+        return len(written)
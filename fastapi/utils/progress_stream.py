@@ -0,0 +1,121 @@
+"""
+Потоки прогресса задач и событий (Server-Sent Events)
+
+Вместо polling /tasks/{task_id} и /events/{event_id}/event-info клиент держит одно
+соединение, а API пересылает ему изменения из Redis pub/sub:
+- задача: Redis backend Celery публикует каждое сохранение состояния (PROGRESS из
+  CallbackTask.on_progress и report_event_progress, итоговый результат) в канал
+  с именем ключа результата celery-task-meta-{task_id};
+- событие: record_step/finish_event_progress публикуют шаги в event:{event_id}:updates.
+
+Подписка оформляется до чтения начального состояния, поэтому изменения между ними
+не теряются. Redis здесь асинхронный (redis.asyncio) - event loop API не блокируется.
+"""
+import asyncio
+import json
+import logging
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_TASK_STATES = ('SUCCESS', 'FAILURE', 'REVOKED')
+
+
+def format_sse(data, event: Optional[str] = None) -> str:
+    """Одно SSE сообщение"""
+    payload = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False, default=str)
+    lines = [f"event: {event}"] if event else []
+    lines.extend(f"data: {line}" for line in payload.split('\n'))
+    return '\n'.join(lines) + '\n\n'
+
+
+def task_channel(task_id: str) -> str:
+    """Канал, в который Redis backend Celery публикует состояние задачи"""
+    from tasks.celery_app import celery_app
+
+    key = celery_app.backend.get_key_for_task(task_id)
+    return key.decode('utf-8') if isinstance(key, bytes) else key
+
+
+async def stream_channel(
+    channel: str,
+    initial: Callable[[], Tuple[List[str], bool]],
+    on_message: Callable[[dict], List[str]],
+    is_final: Callable[[dict], bool],
+) -> AsyncIterator[str]:
+    """
+    Генератор SSE: начальное состояние, затем сообщения канала до финального
+
+    initial возвращает (SSE сообщения, поток завершен), on_message - SSE сообщения;
+    is_final завершает поток.
+    Без сообщений дольше PROGRESS_STREAM_KEEPALIVE отправляется комментарий, чтобы
+    прокси не закрывали соединение; поток ограничен PROGRESS_STREAM_MAX_SECONDS.
+    """
+    import redis.asyncio as aioredis
+
+    client = aioredis.from_url(settings.CELERY_RESULT_BACKEND)
+    pubsub = client.pubsub()
+    try:
+        await pubsub.subscribe(channel)
+        messages, finished = await asyncio.to_thread(initial)
+        for message in messages:
+            yield message
+        if finished:
+            return
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.PROGRESS_STREAM_MAX_SECONDS
+        while loop.time() < deadline:
+            message = await pubsub.get_message(
+                ignore_subscribe_messages=True,
+                timeout=settings.PROGRESS_STREAM_KEEPALIVE
+            )
+            if message is None:
+                yield ": keepalive\n\n"
+                continue
+            try:
+                data = json.loads(message['data'])
+            except (TypeError, ValueError):
+                logger.warning(f"Skipping non-JSON message in {channel}")
+                continue
+            if not isinstance(data, dict):
+                continue
+            for event in on_message(data):
+                yield event
+            if is_final(data):
+                return
+        yield format_sse({'reason': 'stream time limit reached'}, event='timeout')
+    finally:
+        try:
+            await pubsub.unsubscribe(channel)
+            await pubsub.aclose()
+            await client.aclose()
+        except Exception as e:
+            logger.debug(f"Failed to close progress stream for {channel}: {str(e)}")
+
+
+def task_progress_message(task_id: str, meta: dict) -> dict:
+    """Сообщение о состоянии задачи из метаданных backend'а (формат как у /tasks/{task_id})"""
+    state = meta.get('status')
+    info = meta.get('result')
+    message = {'task_id': task_id, 'state': state}
+    if state == 'PROGRESS' and isinstance(info, dict):
+        message.update({
+            'progress': info.get('progress', 0),
+            'current': info.get('current', 0),
+            'total': info.get('total', 0)
+        })
+    elif state == 'SUCCESS':
+        message['result'] = info
+    elif state == 'FAILURE':
+        if isinstance(info, dict):
+            # update_state(FAILURE, meta) задач или сериализованное исключение Celery
+            message['error'] = info.get('error', info.get('exc_message', str(info)))
+            message['error_type'] = info.get('error_type', info.get('exc_type', 'UnknownError'))
+        else:
+            message['error'] = str(info) if info else 'Неизвестная ошибка'
+            message['error_type'] = 'UnknownError'
+        message['traceback'] = meta.get('traceback')
+    return message
@@ -1,9 +1,21 @@
 """
 Утилита для загрузки фотографий на S3 облако
+
+Публикация события загружает тысячи файлов. Объекты загружаются параллельно
+(S3_UPLOAD_CONCURRENCY потоков), крупные - multipart частями (TransferConfig).
+Повторы делает только botocore (retries standard: S3_UPLOAD_RETRIES попыток каждого
+запроса с экспоненциальной задержкой), в том числе для каждой части multipart.
+boto3 клиент один на процесс (он потокобезопасен) с пулом соединений под эту параллельность.
+
+Для тестов с moto/MinIO клиент и bucket можно передать в S3Uploader явно,
+endpoint для MinIO задается S3_CLOUD_URL.
 """
 import os
+import time
 import logging
-from typing import Optional, Dict, Tuple
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Tuple, List, Iterable
 from app.config import settings
 
 logger = logging.getLogger(__name__)
@@ -12,23 +24,85 @@ try:
     import boto3
     from botocore.exceptions import ClientError, BotoCoreError
     from botocore.config import Config
+    from boto3.s3.transfer import TransferConfig
+    from boto3.exceptions import S3UploadFailedError
     BOTO3_AVAILABLE = True
 except ImportError:
     BOTO3_AVAILABLE = False
     logger.warning("boto3 not installed. S3 upload functionality will be disabled.")
 
+BASE_STORAGE_PATH = "/var/www/html/storage/app/public"
+
+CONTENT_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.webp': 'image/webp',
+}
+
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+
+def _get_shared_client():
+    """boto3 клиент S3 (один на процесс, пул соединений под параллельную загрузку)"""
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            # Используем Config с addressing_style='path' для совместимости с S3-совместимыми хранилищами
+            s3_config = Config(
+                s3={'addressing_style': 'path'},
+                max_pool_connections=max(10, settings.S3_UPLOAD_CONCURRENCY * settings.S3_MULTIPART_CONCURRENCY),
+                # Единственный уровень повторов: upload_file и остальные вызовы сами не повторяют
+                retries={'max_attempts': max(1, settings.S3_UPLOAD_RETRIES), 'mode': 'standard'}
+            )
+            _shared_client = boto3.client(
+                's3',
+                endpoint_url=settings.S3_CLOUD_URL,
+                region_name=settings.S3_CLOUD_REGION,
+                aws_access_key_id=settings.S3_CLOUD_ACCESS_KEY,
+                aws_secret_access_key=settings.S3_CLOUD_SECRET_KEY,
+                config=s3_config
+            )
+        return _shared_client
+
+
+def resolve_storage_path(path: str) -> str:
+    """Относительный путь Laravel storage (или абсолютный путь Docker) -> абсолютный путь"""
+    if not path.startswith('/'):
+        # Относительный путь
+        return os.path.join(BASE_STORAGE_PATH, path)
+    if path.startswith(BASE_STORAGE_PATH + '/'):
+        # Уже абсолютный путь Docker
+        return path
+    # Другой формат пути
+    return os.path.join(BASE_STORAGE_PATH, path.lstrip('/'))
+
 
 class S3Uploader:
     """Класс для загрузки файлов на S3"""
     
-    def __init__(self):
+    def __init__(self, client=None, bucket_name: Optional[str] = None):
         self.s3_client = None
-        self.bucket_name = settings.S3_BUCKET_NAME
+        self.bucket_name = bucket_name or settings.S3_BUCKET_NAME
+        self.transfer_config = None
         
         if not BOTO3_AVAILABLE:
             logger.warning("boto3 not available, S3 uploader disabled")
             return
         
+        self.transfer_config = TransferConfig(
+            multipart_threshold=settings.S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=settings.S3_MULTIPART_CHUNKSIZE,
+            max_concurrency=settings.S3_MULTIPART_CONCURRENCY,
+            use_threads=True
+        )
+        
+        if client is not None:
+            # Явно переданный клиент (moto, MinIO в тестах)
+            self.s3_client = client
+            return
+        
         # Детальное логирование настроек S3 (без секретных ключей)
         logger.info("S3 Configuration Check:", extra={
             'S3_CLOUD_URL': settings.S3_CLOUD_URL if settings.S3_CLOUD_URL else 'NOT SET',
@@ -57,19 +131,7 @@ class S3Uploader:
             return
         
         try:
-            # Используем Config с addressing_style='path' для совместимости с S3-совместимыми хранилищами
-            s3_config = Config(
-                s3={'addressing_style': 'path'}
-            )
-            
-            self.s3_client = boto3.client(
-                's3',
-                endpoint_url=settings.S3_CLOUD_URL,
-                region_name=settings.S3_CLOUD_REGION,
-                aws_access_key_id=settings.S3_CLOUD_ACCESS_KEY,
-                aws_secret_access_key=settings.S3_CLOUD_SECRET_KEY,
-                config=s3_config
-            )
+            self.s3_client = _get_shared_client()
             logger.info("S3 client initialized successfully", extra={
                 'endpoint_url': settings.S3_CLOUD_URL,
                 'region': settings.S3_CLOUD_REGION,
@@ -84,10 +146,21 @@ class S3Uploader:
         """Проверить, доступен ли S3 клиент"""
         return self.s3_client is not None and self.bucket_name is not None
     
+    def object_url(self, s3_key: str) -> str:
+        """Публичный URL объекта"""
+        if settings.S3_CLOUD_URL:
+            # Если указан endpoint_url, используем его
+            return f"{settings.S3_CLOUD_URL.rstrip('/')}/{self.bucket_name}/{s3_key}"
+        # Стандартный AWS S3 URL
+        return f"https://{self.bucket_name}.s3.{settings.S3_CLOUD_REGION}.amazonaws.com/{s3_key}"
+    
     def upload_file(self, local_path: str, s3_key: str, content_type: Optional[str] = None) -> Optional[str]:
         """
         Загрузить файл на S3
         
+        Крупные файлы загружаются multipart (transfer_config). Запросы повторяет botocore
+        (S3_UPLOAD_RETRIES попыток), ошибка после этого возвращает None.
+        
         Args:
             local_path: Локальный путь к файлу
             s3_key: Ключ (путь) в S3 bucket
@@ -104,57 +177,82 @@ class S3Uploader:
             logger.error(f"File not found: {local_path}")
             return None
         
+        extra_args = {}
+        if content_type:
+            extra_args['ContentType'] = content_type
+        else:
+            # Определяем content_type по расширению
+            ext = os.path.splitext(local_path)[1].lower()
+            if ext in CONTENT_TYPES:
+                extra_args['ContentType'] = CONTENT_TYPES[ext]
+        
         try:
-            extra_args = {}
-            if content_type:
-                extra_args['ContentType'] = content_type
-            else:
-                # Определяем content_type по расширению
-                ext = os.path.splitext(local_path)[1].lower()
-                content_types = {
-                    '.jpg': 'image/jpeg',
-                    '.jpeg': 'image/jpeg',
-                    '.png': 'image/png',
-                    '.webp': 'image/webp',
-                }
-                if ext in content_types:
-                    extra_args['ContentType'] = content_types[ext]
-            
             logger.info(f"Uploading file to S3: {local_path} -> {s3_key}")
             self.s3_client.upload_file(
                 local_path,
                 self.bucket_name,
                 s3_key,
-                ExtraArgs=extra_args
+                ExtraArgs=extra_args,
+                Config=self.transfer_config
             )
-            
-            # Формируем URL
-            if settings.S3_CLOUD_URL:
-                # Если указан endpoint_url, используем его
-                url = f"{settings.S3_CLOUD_URL.rstrip('/')}/{self.bucket_name}/{s3_key}"
-            else:
-                # Стандартный AWS S3 URL
-                url = f"https://{self.bucket_name}.s3.{settings.S3_CLOUD_REGION}.amazonaws.com/{s3_key}"
-            
+            url = self.object_url(s3_key)
             logger.info(f"File uploaded successfully: {url}")
             return url
-            
-        except ClientError as e:
-            logger.error(f"Error uploading file to S3: {e}")
+        except (ClientError, BotoCoreError, S3UploadFailedError, OSError) as e:
+            logger.error(f"Error uploading file to S3: {s3_key}: {e}")
             return None
         except Exception as e:
             logger.error(f"Unexpected error uploading file to S3: {e}")
             return None
     
+    def upload_many(self, items: Iterable[Tuple[str, str]]) -> Dict[str, Optional[str]]:
+        """
+        Загрузить файлы параллельно (S3_UPLOAD_CONCURRENCY потоков)
+        
+        Args:
+            items: пары (локальный путь, ключ S3)
+        
+        Returns:
+            {ключ S3: URL или None, если загрузка не удалась}
+        """
+        items = list(items)
+        if not items:
+            return {}
+        if not self.is_available():
+            logger.warning("S3 uploader not available, skipping upload")
+            return {s3_key: None for _, s3_key in items}
+        
+        start_time = time.time()
+        workers = max(1, min(settings.S3_UPLOAD_CONCURRENCY, len(items)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='s3-upload') as executor:
+            urls = list(executor.map(lambda item: self.upload_file(*item), items))
+        results = {s3_key: url for (_, s3_key), url in zip(items, urls)}
+        
+        failed = sum(1 for url in urls if not url)
+        logger.info(
+            f"Uploaded {len(items) - failed}/{len(items)} files to S3 in {time.time() - start_time:.1f}s "
+            f"({workers} workers)"
+        )
+        return results
+    
+    def event_photo_key(self, event_id: str, kind: str, full_path: str) -> str:
+        """Ключ S3 файла события (kind - custom_photo или original_photo)"""
+        return f"hunter-photo/events/{event_id}/{kind}/{os.path.basename(full_path)}"
+    
     def upload_event_photos(
         self, 
         event_id: str, 
         photos_data: Dict[str, Dict],
-        db_session = None
+        db_session = None,
+        uploaded: Optional[Dict[str, Dict[str, str]]] = None,
+        verified: Optional[List[Tuple[str, str]]] = None
     ) -> Dict[str, Dict[str, str]]:
         """
         Загрузить все фотографии события на S3
         
+        Пути берутся из БД одним запросом (иначе из photos_data), файлы загружаются
+        параллельно через upload_many.
+        
         Args:
             event_id: ID события
             photos_data: Словарь с данными фотографий из event_info.json
@@ -165,7 +263,11 @@ class S3Uploader:
                         "original_path": "/path/to/original_photo.jpg"
                     }
                 }
-            db_session: SQLAlchemy сессия для обновления базы данных
+            db_session: SQLAlchemy сессия для получения актуальных путей
+            uploaded: URL, уже загруженные S3UploadPipeline ({photo_id: {custom_url, original_url}});
+                файл не загружается повторно, если URL указывает на ключ его текущего пути
+            verified: если передан список, в него добавляются пары (локальный путь, ключ S3)
+                всех файлов события - для verify_many перед удалением локальных файлов
         
         Returns:
             Словарь с S3 URL для каждой фотографии:
@@ -180,94 +282,141 @@ class S3Uploader:
             logger.warning("S3 uploader not available, skipping upload")
             return {}
         
-        uploaded_urls = {}
-        base_path = "/var/www/html/storage/app/public"
-        
+        photo_infos = {}
         for photo_name, photo_info in photos_data.items():
             photo_id = photo_info.get('id')
             if not photo_id:
                 logger.warning(f"Photo {photo_name} has no ID, skipping")
                 continue
-            
+            photo_infos[str(photo_id)] = photo_info
+        
+        # Актуальные пути всех фото одним запросом
+        db_paths = {}
+        if db_session and photo_infos:
+            from app.models import Photo
+            rows = db_session.query(Photo.id, Photo.custom_path, Photo.original_path) \
+                .filter(Photo.id.in_(list(photo_infos))).all()
+            db_paths = {str(row.id): (row.custom_path, row.original_path) for row in rows}
+        
+        uploaded_urls = {}
+        jobs: List[Tuple[str, str]] = []
+        owners: Dict[str, Tuple[str, str]] = {}
+        for photo_id, photo_info in photo_infos.items():
             uploaded_urls[photo_id] = {
                 'custom_url': None,
                 'original_url': None
             }
-            
-            # Загружаем custom_photo
-            # Пробуем получить путь из разных источников
-            custom_path = None
-            if db_session:
-                from app.models import Photo
-                photo = db_session.query(Photo).filter(Photo.id == photo_id).first()
-                if photo and photo.custom_path:
-                    custom_path = photo.custom_path
-            
+            custom_path, original_path = db_paths.get(photo_id, (None, None))
             if not custom_path:
                 custom_path = photo_info.get('custom_path') or photo_info.get('docker_path')
-            
-            if custom_path:
-                # Преобразуем относительный путь в абсолютный для Docker контейнера
-                if not custom_path.startswith('/'):
-                    # Относительный путь
-                    full_custom_path = os.path.join(base_path, custom_path)
-                elif custom_path.startswith('/var/www/html/storage/app/public/'):
-                    # Уже абсолютный путь Docker
-                    full_custom_path = custom_path
-                else:
-                    # Другой формат пути
-                    full_custom_path = os.path.join(base_path, custom_path.lstrip('/'))
-                
-                # Проверяем, что файл существует
-                if os.path.exists(full_custom_path):
-                    s3_key_custom = f"hunter-photo/events/{event_id}/custom_photo/{os.path.basename(full_custom_path)}"
-                    custom_url = self.upload_file(full_custom_path, s3_key_custom)
-                    uploaded_urls[photo_id]['custom_url'] = custom_url
-                else:
-                    logger.warning(f"Custom photo not found: {full_custom_path}")
-            
-            # Загружаем original_photo
-            original_path = None
-            if db_session:
-                from app.models import Photo
-                photo = db_session.query(Photo).filter(Photo.id == photo_id).first()
-                if photo and photo.original_path:
-                    original_path = photo.original_path
-                    logger.info(f"Photo {photo_id}: Got original_path from DB: {original_path}")
-            
             if not original_path:
                 original_path = photo_info.get('original_path') or photo_info.get('relative_path')
-                if original_path:
-                    logger.info(f"Photo {photo_id}: Got original_path from photo_info: {original_path}")
             
-            if original_path:
-                # Преобразуем относительный путь в абсолютный для Docker контейнера
-                if not original_path.startswith('/'):
-                    # Относительный путь
-                    full_original_path = os.path.join(base_path, original_path)
-                elif original_path.startswith('/var/www/html/storage/app/public/'):
-                    # Уже абсолютный путь Docker
-                    full_original_path = original_path
-                else:
-                    # Другой формат пути
-                    full_original_path = os.path.join(base_path, original_path.lstrip('/'))
-                
-                logger.info(f"Photo {photo_id}: Full original path: {full_original_path}")
-                
-                # Проверяем, что файл существует
-                if os.path.exists(full_original_path):
-                    s3_key_original = f"hunter-photo/events/{event_id}/original_photo/{os.path.basename(full_original_path)}"
-                    logger.info(f"Photo {photo_id}: Uploading original to S3: {s3_key_original}")
-                    original_url = self.upload_file(full_original_path, s3_key_original)
-                    uploaded_urls[photo_id]['original_url'] = original_url
-                    if original_url:
-                        logger.info(f"Photo {photo_id}: Original uploaded successfully: {original_url}")
-                    else:
-                        logger.error(f"Photo {photo_id}: Failed to upload original to S3")
-                else:
-                    logger.warning(f"Original photo not found: {full_original_path} for photo {photo_id}")
-            else:
-                logger.warning(f"Photo {photo_id}: No original_path found in DB or photo_info")
+            for kind, url_field, path in (
+                ('custom_photo', 'custom_url', custom_path),
+                ('original_photo', 'original_url', original_path),
+            ):
+                if not path:
+                    logger.warning(f"Photo {photo_id}: No {kind} path found in DB or photo_info")
+                    continue
+                full_path = resolve_storage_path(path)
+                if not os.path.exists(full_path):
+                    logger.warning(f"{kind} not found: {full_path} for photo {photo_id}")
+                    continue
+                s3_key = self.event_photo_key(event_id, kind, full_path)
+                if verified is not None:
+                    verified.append((full_path, s3_key))
+                if (uploaded or {}).get(photo_id, {}).get(url_field) == self.object_url(s3_key):
+                    # Загружен во время анализа
+                    uploaded_urls[photo_id][url_field] = self.object_url(s3_key)
+                    continue
+                jobs.append((full_path, s3_key))
+                owners[s3_key] = (photo_id, url_field)
+        
+        logger.info(f"Uploading {len(jobs)} files of {len(photo_infos)} photos for event {event_id}")
+        for s3_key, url in self.upload_many(jobs).items():
+            photo_id, url_field = owners[s3_key]
+            uploaded_urls[photo_id][url_field] = url
+            if not url:
+                logger.error(f"Photo {photo_id}: Failed to upload {url_field} to S3 ({s3_key})")
         
         return uploaded_urls
+    
+    def verify_many(self, items: Iterable[Tuple[str, str]]) -> List[str]:
+        """
+        Проверить, что объекты на S3 есть и их размер совпадает с локальными файлами
+        
+        Args:
+            items: пары (локальный путь, ключ S3)
+        
+        Returns:
+            ключи S3, не прошедшие проверку
+        """
+        items = list(items)
+        if not items:
+            return []
+        if not self.is_available():
+            return [s3_key for _, s3_key in items]
+        
+        def check(item):
+            local_path, s3_key = item
+            try:
+                head = self.s3_client.head_object(Bucket=self.bucket_name, Key=s3_key)
+                return head.get('ContentLength') == os.path.getsize(local_path)
+            except Exception as e:
+                logger.warning(f"S3 verification failed for {s3_key}: {e}")
+                return False
+        
+        workers = max(1, min(settings.S3_UPLOAD_CONCURRENCY, len(items)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='s3-verify') as executor:
+            checks = list(executor.map(check, items))
+        return [s3_key for (_, s3_key), ok in zip(items, checks) if not ok]
 
+
+class S3UploadPipeline:
+    """
+    Загрузка файлов фотографий на S3 по мере их готовности
+    
+    process_photo_chunk отдает custom_photo и original_photo сразу после водяного знака,
+    и сетевая загрузка идет параллельно с анализом следующих фото. finalize_event_processing
+    догружает только то, что не успело или не загрузилось, и проверяет все объекты
+    перед удалением локальных файлов.
+    """
+    
+    URL_FIELDS = {'custom_photo': 'custom_url', 'original_photo': 'original_url'}
+    
+    def __init__(self, event_id: str, uploader: Optional[S3Uploader] = None, workers: Optional[int] = None):
+        self.event_id = str(event_id)
+        self.uploader = uploader or S3Uploader()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, workers or settings.S3_PIPELINE_WORKERS),
+            thread_name_prefix='s3-pipeline'
+        )
+        self._futures = []
+    
+    def submit(self, photo_id, kind: str, full_path: str) -> None:
+        """Поставить файл фото в очередь загрузки (kind - custom_photo или original_photo)"""
+        s3_key = self.uploader.event_photo_key(self.event_id, kind, full_path)
+        future = self._executor.submit(self.uploader.upload_file, full_path, s3_key)
+        self._futures.append((str(photo_id), self.URL_FIELDS[kind], future))
+    
+    def results(self, wait: bool = True) -> Dict[str, Dict[str, Optional[str]]]:
+        """
+        URL загруженных файлов {photo_id: {custom_url, original_url}}
+        
+        wait=False (таймаут части) - только уже завершенные загрузки, остальные отменяются
+        или дозагрузит finalize_event_processing.
+        """
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
+        uploaded: Dict[str, Dict[str, Optional[str]]] = {}
+        for photo_id, url_field, future in self._futures:
+            if not future.done() or future.cancelled():
+                continue
+            try:
+                url = future.result()
+            except Exception as e:
+                logger.error(f"Pipelined S3 upload failed for photo {photo_id}: {e}")
+                url = None
+            if url:
+                uploaded.setdefault(photo_id, {})[url_field] = url
+        return uploaded
@@ -1,11 +1,21 @@
 from PIL import Image, ImageDraw, ImageFont
 import os
+import threading
+from collections import OrderedDict
 from typing import Optional
 
+from app.config import settings
+
+# Маски водяного знака по (ширина, высота, текст, размер шрифта): фото события обычно
+# одного-нескольких разрешений, поэтому маска строится один раз на разрешение
+_mask_cache: "OrderedDict[tuple, Image.Image]" = OrderedDict()
+_font_cache = {}
+_cache_lock = threading.Lock()
+
 
 class WatermarkProcessor:
     """Добавление водяного знака на изображения"""
-    
+
     def __init__(self):
         # Прозрачность уменьшена на 15%: было 45%, стало 45% * 0.85 = 38.25%
         self.opacity = 0.3825  # ~38%
@@ -14,93 +24,116 @@ class WatermarkProcessor:
         # Отступ увеличен на 30%: было 10%, стало 10% * 1.3 = 13%
         self.interval_ratio = 0.13  # 13% интервал
         self.color = (255, 255, 255)  # Белый цвет
-    
+
+    def _load_font(self, font_size: int):
+        """Шрифт нужного размера (загружается один раз на размер)"""
+        font = _font_cache.get(font_size)
+        if font is None:
+            try:
+                font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", font_size)
+            except:
+                try:
+                    font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", font_size)
+                except:
+                    font = ImageFont.load_default()
+            _font_cache[font_size] = font
+        return font
+
+    def _build_mask(self, width: int, height: int, text: str, font_size: int) -> Image.Image:
+        """
+        Маска прозрачности водяного знака (режим L) на весь кадр
+
+        Текст растеризуется один раз в плитку, плитка вставляется в те же позиции,
+        где раньше рисовался текст: повтор с места остановки в строке (не как забор).
+        """
+        font = self._load_font(font_size)
+        bbox = ImageDraw.Draw(Image.new("L", (1, 1))).textbbox((0, 0), text, font=font)
+        text_width = bbox[2] - bbox[0]
+        text_height = bbox[3] - bbox[1]
+
+        # Плитка - только область глифов, поэтому соседние плитки не перекрываются
+        tile = Image.new("L", (max(1, text_width), max(1, text_height)), 0)
+        ImageDraw.Draw(tile).text((-bbox[0], -bbox[1]), text, font=font, fill=int(255 * self.opacity))
+
+        # Интервал между водяными знаками (13% от размера шрифта, увеличен на 30%)
+        interval = int(font_size * self.interval_ratio)
+        step_x = text_width + interval
+        step_y = text_height + interval
+
+        mask = Image.new("L", (width, height), 0)
+        y = 0
+        x_offset = 0  # Смещение для продолжения текста в следующей строке
+        while y < height:
+            x = -x_offset  # Начинаем с отрицательного смещения для продолжения текста
+            while x < width:
+                mask.paste(tile, (x + bbox[0], y + bbox[1]))
+                x += step_x
+
+            # Вычисляем смещение для следующей строки (продолжение текста)
+            # Берем остаток от деления ширины на (text_width + interval)
+            remaining_width = (width + x_offset) % step_x
+            x_offset = step_x - remaining_width if remaining_width > 0 else 0
+
+            y += step_y
+        return mask
+
+    def get_mask(self, width: int, height: int, text: str) -> Image.Image:
+        """Маска водяного знака для разрешения (из кэша WATERMARK_MASK_CACHE_SIZE последних)"""
+        # Размер шрифта: 4.9% от высоты изображения
+        font_size = int(height * self.font_size_ratio)
+        key = (width, height, text, font_size, self.opacity, self.interval_ratio)
+        with _cache_lock:
+            mask = _mask_cache.get(key)
+            if mask is not None:
+                _mask_cache.move_to_end(key)
+                return mask
+
+        mask = self._build_mask(width, height, text, font_size)
+        with _cache_lock:
+            _mask_cache[key] = mask
+            while len(_mask_cache) > max(0, settings.WATERMARK_MASK_CACHE_SIZE):
+                _mask_cache.popitem(last=False)
+        return mask
+
     def add_watermark(
         self,
         image_path: str,
         text: str = "hunter-photo.ru",
-        output_path: Optional[str] = None
+        output_path: Optional[str] = None,
+        image: Optional[Image.Image] = None
     ) -> str:
         """
         Добавить водяной знак на изображение
-        
+
         Параметры:
         - Прозрачность: 45%
         - Размер шрифта: 7% от высоты изображения (уменьшено на 30%)
         - Интервал: 10% от размера шрифта
         - Цвет: белый
+
+        image - уже декодированное изображение (utils.image_context), файл тогда не читается;
+        RGB изображение получает водяной знак на месте
         """
         if output_path is None:
             base, ext = os.path.splitext(image_path)
             output_path = f"{base}_watermarked.jpg"
-        
-        # Открываем изображение
-        img = Image.open(image_path).convert("RGBA")
-        width, height = img.size
-        
-        # Создаем слой для водяного знака
-        watermark = Image.new("RGBA", img.size, (255, 255, 255, 0))
-        draw = ImageDraw.Draw(watermark)
-        
-        # Вычисляем размер шрифта (7% от высоты, уменьшено на 30%)
-        font_size = int(height * self.font_size_ratio)
-        
-        # Пытаемся загрузить шрифт
-        try:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", font_size)
-        except:
-            try:
-                font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", font_size)
-            except:
-                font = ImageFont.load_default()
-        
-        # Получаем размер текста
-        bbox = draw.textbbox((0, 0), text, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
-        
-        # Интервал между водяными знаками (13% от размера шрифта, увеличен на 30%)
-        interval = int(font_size * self.interval_ratio)
-        
-        # Рисуем водяной знак по всей поверхности
-        # Текст повторяется с места остановки в строке (не как забор)
-        y = 0
-        x_offset = 0  # Смещение для продолжения текста в следующей строке
-        
-        while y < height:
-            x = -x_offset  # Начинаем с отрицательного смещения для продолжения текста
-            while x < width:
-                # Рисуем текст с прозрачностью
-                draw.text(
-                    (x, y),
-                    text,
-                    font=font,
-                    fill=(*self.color, int(255 * self.opacity))
-                )
-                x += text_width + interval
-            
-            # Вычисляем смещение для следующей строки (продолжение текста)
-            # Берем остаток от деления ширины на (text_width + interval)
-            remaining_width = (width + x_offset) % (text_width + interval)
-            x_offset = (text_width + interval) - remaining_width if remaining_width > 0 else 0
-            
-            y += text_height + interval
-        
-        # Накладываем водяной знак на изображение
-        watermarked = Image.alpha_composite(img, watermark)
-        
-        # Конвертируем обратно в RGB
-        watermarked = watermarked.convert("RGB")
-        
+
+        img = image if image is not None else Image.open(image_path)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+
+        # Белый цвет накладывается по маске прозрачности прямо в RGB кадр
+        # (то же, что alpha_composite полноразмерного RGBA слоя, без копий кадра)
+        mask = self.get_mask(img.width, img.height, text)
+        img.paste(self.color, (0, 0, img.width, img.height), mask)
+
         # Определяем формат по расширению файла
         ext = os.path.splitext(output_path)[1].lower()
         if ext == '.webp':
             # Сохраняем в WebP формате
-            watermarked.save(output_path, "WEBP", quality=85)
+            img.save(output_path, "WEBP", quality=85)
         else:
             # Сохраняем в JPEG формате
-            watermarked.save(output_path, "JPEG", quality=95)
-        
-        return output_path
-
+            img.save(output_path, "JPEG", quality=95)
 
+        return output_path
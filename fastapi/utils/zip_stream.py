@@ -0,0 +1,402 @@
+"""
+Zip фотографий события на лету (GET /events/{event_id}/download)
+
+Архив не собирается на диске: файлы читаются из локального storage или S3 и сразу
+отдаются клиенту кусками. Чтобы поддержать докачку (HTTP Range), байты архива должны
+быть одинаковыми при каждом запросе и вычисляться с любого смещения:
+- файлы пишутся без сжатия (ZIP_STORED, фото уже сжаты), поэтому размер и смещение
+  каждой записи известны заранее из имен и размеров файлов;
+- CRC32 записи идет в data descriptor после данных (флаг 3), а в локальном заголовке 0 -
+  начало архива отдается сразу, CRC считается при чтении файла;
+- для центрального каталога нужны CRC всех файлов: они сохраняются в кэш события
+  (по размеру и ETag / mtime файла), недостающие досчитываются чтением файлов;
+- больше 4 ГБ архива или 65535 файлов - zip64 для смещений и количества.
+"""
+import hashlib
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from app.config import settings
+from utils.s3_uploader import BASE_STORAGE_PATH
+
+logger = logging.getLogger(__name__)
+
+ZIP_KINDS = ('original_photo', 'custom_photo')
+CHUNK_SIZE = 1024 * 1024
+
+ZIP_STORED = 0
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_COUNT_LIMIT = 0xFFFF
+# Data descriptor (бит 3) и имена в UTF-8 (бит 11)
+ZIP_FLAGS = 0x08 | 0x800
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+DATA_DESCRIPTOR = struct.Struct('<IIII')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+ZIP64_EXTRA = struct.Struct('<HHQ')
+ZIP64_END = struct.Struct('<IQHHIIQQQQ')
+ZIP64_LOCATOR = struct.Struct('<IIQI')
+END_RECORD = struct.Struct('<IHHHHIIH')
+
+
+class ZipSourceChanged(IOError):
+    """Файл изменился после листинга: байты архива уже не совпадут с заявленными"""
+
+
+def _dos_datetime(timestamp: Optional[float]) -> Tuple[int, int]:
+    """Время файла в формате zip (как zipfile: локальное время, не раньше 1980)"""
+    t = time.localtime(timestamp or 0)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+class LocalZipSource:
+    """Файлы папки события в локальном storage"""
+
+    name = 'local'
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def list(self) -> List[Dict]:
+        """[{'name', 'size', 'modified', 'version', 'path'}] по имени файла"""
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for item in os.scandir(self.directory):
+            # Временные файлы атомарной записи (.tmp/.part) в архив не попадают
+            if item.name.startswith('.') or item.name.endswith(('.tmp', '.part')) or not item.is_file():
+                continue
+            stat = item.stat()
+            entries.append({
+                'name': item.name,
+                'size': stat.st_size,
+                'modified': stat.st_mtime,
+                'version': f"{stat.st_size}:{stat.st_mtime_ns}",
+                'path': item.path,
+            })
+        return sorted(entries, key=lambda entry: entry['name'])
+
+    def read(self, entry: Dict, start: int, end: int) -> Iterator[bytes]:
+        with open(entry['path'], 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if f"{stat.st_size}:{stat.st_mtime_ns}" != entry['version']:
+                raise ZipSourceChanged(f"{entry['path']} changed while streaming")
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ZipSourceChanged(f"{entry['path']} is shorter than listed")
+                remaining -= len(chunk)
+                yield chunk
+
+
+class S3ZipSource:
+    """Объекты события на S3 (папка hunter-photo/events/{event_id}/{kind}/)"""
+
+    name = 's3'
+
+    def __init__(self, s3_uploader, prefix: str):
+        self.s3_uploader = s3_uploader
+        self.prefix = prefix
+
+    def list(self) -> List[Dict]:
+        from utils.event_archiver import archive_name, list_objects
+
+        entries = [{
+            'name': archive_name(obj),
+            'size': obj['size'],
+            'modified': obj.get('modified'),
+            'version': f"{obj['size']}:{obj['etag']}",
+            'key': obj['key'],
+            'etag': obj['etag'],
+        } for obj in list_objects(self.s3_uploader, self.prefix)]
+        return sorted(entries, key=lambda entry: entry['name'])
+
+    def read(self, entry: Dict, start: int, end: int) -> Iterator[bytes]:
+        params = {
+            'Bucket': self.s3_uploader.bucket_name,
+            'Key': entry['key'],
+            'Range': f"bytes={start}-{end - 1}",
+        }
+        if entry.get('etag'):
+            # Объект перезаписан после листинга - S3 вернет 412 вместо других байтов
+            params['IfMatch'] = f'"{entry["etag"]}"'
+        body = self.s3_uploader.s3_client.get_object(**params)['Body']
+        try:
+            received = 0
+            for chunk in body.iter_chunks(CHUNK_SIZE):
+                received += len(chunk)
+                yield chunk
+            if received != end - start:
+                raise ZipSourceChanged(f"{entry['key']}: got {received} bytes, expected {end - start}")
+        finally:
+            body.close()
+
+
+class ZipCrcCache:
+    """
+    CRC32 файлов события для потоковых zip: {имя: [версия, crc]}
+
+    Версия - размер и ETag (S3) или mtime (локальный файл): измененный файл считается заново.
+    Запись атомарная (временный файл + os.replace), параллельные загрузки дописывают свое.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.crcs = self._read()
+        self._new: Dict[str, list] = {}
+
+    def _read(self) -> Dict[str, list]:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Zip CRC cache {self.path} is unreadable: {e}")
+            return {}
+
+    def get(self, entry: Dict) -> Optional[int]:
+        cached = self._new.get(entry['name']) or self.crcs.get(entry['name'])
+        if cached and cached[0] == entry['version']:
+            return cached[1]
+        return None
+
+    def put(self, entry: Dict, crc: int) -> None:
+        self._new[entry['name']] = [entry['version'], crc]
+
+    def save(self) -> None:
+        if not self._new:
+            return
+        try:
+            crcs = self._read()
+            crcs.update(self._new)
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = f"{self.path}.{os.getpid()}.{id(self)}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(crcs, f)
+            os.replace(temp_path, self.path)
+            self.crcs = crcs
+            self._new = {}
+        except OSError as e:
+            # Кэш не обязателен: без него CRC посчитаются при следующей загрузке
+            logger.warning(f"Failed to save zip CRC cache {self.path}: {e}")
+
+
+class ZipStream:
+    """
+    Zip архив файлов source, отдаваемый по диапазонам байтов
+
+    Разметка (смещения и размер архива) зависит только от имен и размеров файлов.
+    """
+
+    def __init__(self, entries: List[Dict], source, crc_cache: ZipCrcCache):
+        self.entries = entries
+        self.source = source
+        self.crc_cache = crc_cache
+
+        offset = 0
+        for entry in entries:
+            if entry['size'] >= ZIP64_LIMIT:
+                raise ValueError(f"{entry['name']} is too large for a streamed zip")
+            entry['name_bytes'] = entry['name'].encode('utf-8')
+            entry['dos_time'], entry['dos_date'] = _dos_datetime(entry.get('modified'))
+            entry['offset'] = offset
+            entry['data_start'] = offset + LOCAL_HEADER.size + len(entry['name_bytes'])
+            entry['data_end'] = entry['data_start'] + entry['size']
+            entry['end'] = entry['data_end'] + DATA_DESCRIPTOR.size
+            if entry['size'] == 0:
+                entry['crc'] = 0
+            else:
+                entry['crc'] = crc_cache.get(entry)
+            offset = entry['end']
+
+        self.cd_start = offset
+        self.cd_size = sum(
+            CENTRAL_HEADER.size + len(entry['name_bytes']) + (ZIP64_EXTRA.size if entry['offset'] >= ZIP64_LIMIT else 0)
+            for entry in entries
+        )
+        self.zip64 = len(entries) >= ZIP_COUNT_LIMIT or self.cd_start + self.cd_size >= ZIP64_LIMIT
+        self.size = self.cd_start + self.cd_size + END_RECORD.size
+        if self.zip64:
+            self.size += ZIP64_END.size + ZIP64_LOCATOR.size
+
+    @property
+    def etag(self) -> str:
+        """ETag архива: те же файлы тех же версий дают те же байты"""
+        digest = hashlib.sha1()
+        for entry in self.entries:
+            digest.update(f"{entry['name']}\0{entry['version']}\0{entry.get('modified')}\n".encode('utf-8'))
+        return f'"{digest.hexdigest()}"'
+
+    def _local_header(self, entry: Dict) -> bytes:
+        return LOCAL_HEADER.pack(
+            0x04034b50, 20, ZIP_FLAGS, ZIP_STORED, entry['dos_time'], entry['dos_date'],
+            0, 0, 0, len(entry['name_bytes']), 0
+        ) + entry['name_bytes']
+
+    def _descriptor(self, entry: Dict) -> bytes:
+        return DATA_DESCRIPTOR.pack(0x08074b50, entry['crc'], entry['size'], entry['size'])
+
+    def _tail(self) -> bytes:
+        """Центральный каталог и конец архива (нужны CRC всех файлов)"""
+        parts = []
+        for entry in self.entries:
+            extra = b''
+            offset = entry['offset']
+            if offset >= ZIP64_LIMIT:
+                extra = ZIP64_EXTRA.pack(0x0001, 8, offset)
+                offset = ZIP64_LIMIT
+            version = 45 if extra else 20
+            parts.append(CENTRAL_HEADER.pack(
+                0x02014b50, version, version, ZIP_FLAGS, ZIP_STORED, entry['dos_time'], entry['dos_date'],
+                entry['crc'], entry['size'], entry['size'], len(entry['name_bytes']), len(extra), 0, 0, 0,
+                0o100644 << 16, offset
+            ) + entry['name_bytes'] + extra)
+
+        count = len(self.entries)
+        if self.zip64:
+            zip64_end_offset = self.cd_start + self.cd_size
+            parts.append(ZIP64_END.pack(
+                0x06064b50, ZIP64_END.size - 12, 45, 45, 0, 0, count, count, self.cd_size, self.cd_start
+            ))
+            parts.append(ZIP64_LOCATOR.pack(0x07064b50, 0, zip64_end_offset, 1))
+        parts.append(END_RECORD.pack(
+            0x06054b50, 0, 0, min(count, ZIP_COUNT_LIMIT), min(count, ZIP_COUNT_LIMIT),
+            min(self.cd_size, ZIP64_LIMIT), min(self.cd_start, ZIP64_LIMIT), 0
+        ))
+        return b''.join(parts)
+
+    def _read_crc(self, entry: Dict) -> None:
+        crc = 0
+        for chunk in self.source.read(entry, 0, entry['size']):
+            crc = zlib.crc32(chunk, crc)
+        self._set_crc(entry, crc)
+
+    def _set_crc(self, entry: Dict, crc: int) -> None:
+        entry['crc'] = crc
+        self.crc_cache.put(entry, crc)
+
+    def _iter_entry(self, entry: Dict, start: int, end: int) -> Iterator[bytes]:
+        header_end = entry['data_start']
+        if start < header_end:
+            yield self._local_header(entry)[max(0, start - entry['offset']):end - entry['offset']]
+
+        # CRC нужен, если диапазон доходит до data descriptor (или дальше - до каталога)
+        need_crc = entry['crc'] is None and end > entry['data_end']
+        data_from = max(start, entry['data_start']) - entry['data_start']
+        data_to = min(end, entry['data_end']) - entry['data_start']
+        if data_from < data_to:
+            if need_crc:
+                # Файл читается с начала: CRC считается заодно, отдается только запрошенная часть
+                crc = 0
+                position = 0
+                for chunk in self.source.read(entry, 0, entry['size']):
+                    crc = zlib.crc32(chunk, crc)
+                    chunk_end = position + len(chunk)
+                    if chunk_end > data_from and position < data_to:
+                        yield chunk[max(0, data_from - position):data_to - position]
+                    position = chunk_end
+                self._set_crc(entry, crc)
+            else:
+                yield from self.source.read(entry, data_from, data_to)
+
+        if end > entry['data_end'] and start < entry['end']:
+            if entry['crc'] is None:
+                self._read_crc(entry)
+            yield self._descriptor(entry)[max(0, start - entry['data_end']):end - entry['data_end']]
+
+    def iter_range(self, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        """Байты архива [start, end)"""
+        end = self.size if end is None else end
+        try:
+            for entry in self.entries:
+                if entry['offset'] >= end:
+                    break
+                if entry['end'] <= start:
+                    continue
+                yield from self._iter_entry(entry, start, end)
+
+            if end > self.cd_start:
+                missing = [entry for entry in self.entries if entry['crc'] is None]
+                if missing:
+                    logger.info(f"Computing {len(missing)} missing CRCs for zip central directory")
+                    workers = max(1, min(settings.ARCHIVE_FETCH_CONCURRENCY, len(missing)))
+                    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='zip-crc') as executor:
+                        list(executor.map(self._read_crc, missing))
+                yield self._tail()[max(0, start - self.cd_start):end - self.cd_start]
+        finally:
+            self.crc_cache.save()
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Заголовок Range -> [start, end) или None (отдать весь архив)
+
+    Поддерживается один диапазон bytes=a-b, bytes=a-, bytes=-n; несколько диапазонов
+    и непонятный заголовок игнорируются (RFC 9110 это разрешает).
+    ValueError - диапазон за концом архива (416).
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, sep, last = header[len('bytes='):].strip().partition('-')
+    if not sep or not (first or last) or (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+    if not first:
+        suffix = int(last)
+        if suffix == 0:
+            raise ValueError("Empty suffix range")
+        return max(0, size - suffix), size
+    start = int(first)
+    if start >= size:
+        raise ValueError(f"Range starts after the end of the archive ({size} bytes)")
+    end = int(last) + 1 if last else size
+    if end <= start:
+        return None
+    return start, min(end, size)
+
+
+def open_event_zip(event_id: str, kind: str, source: str = 'auto') -> Optional[ZipStream]:
+    """
+    Потоковый zip папки kind события
+
+    source: local - storage FastAPI/Laravel, s3 - бакет, auto - локальная папка,
+    а если ее уже нет (удаляется после загрузки на S3) - S3.
+    Returns: None если файлов нет
+    """
+    if kind not in ZIP_KINDS:
+        raise ValueError(f"kind must be one of {', '.join(ZIP_KINDS)}")
+    if source not in ('auto', 'local', 's3'):
+        raise ValueError("source must be auto, local or s3")
+
+    event_dir = os.path.join(BASE_STORAGE_PATH, 'events', event_id)
+    zip_source = None
+    entries: List[Dict] = []
+    if source in ('auto', 'local'):
+        zip_source = LocalZipSource(os.path.join(event_dir, kind))
+        entries = zip_source.list()
+    if not entries and source in ('auto', 's3'):
+        from utils.s3_uploader import S3Uploader
+
+        s3_uploader = S3Uploader()
+        if s3_uploader.is_available():
+            zip_source = S3ZipSource(s3_uploader, f"hunter-photo/events/{event_id}/{kind}/")
+            entries = zip_source.list()
+        elif source == 's3':
+            raise RuntimeError("S3 uploader not available")
+
+    if not entries:
+        return None
+    crc_cache = ZipCrcCache(os.path.join(event_dir, f".zip_crc_{kind}_{zip_source.name}.json"))
+    return ZipStream(entries, zip_source, crc_cache)